@@ -1,17 +1,23 @@
-import google.generativeai as genai
-import os
-import json
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from models import FileClassification
+from utils.file_sniffer import SNIFF_PREFIX_SIZE, detect_file_type
+from utils.gemini import GEMINI_MODEL_NAME, generate_text
+from utils.llm_batcher import PromptBatcher
+from utils.llm_parsing import LLMParseError, parse_llm_json
+from utils.metrics import count_fallback
+from utils.prompt_budget import build_content_excerpt, get_token_budget
+from utils.deadline import DeadlineExceededError
+from utils.retry import CircuitBreakerOpenError, RateLimitExceededError
 
 logger = logging.getLogger(__name__)
 
 class ClassifierAgent:
     def __init__(self):
-        # Configure Gemini AI
-        api_key = os.getenv("GEMINI_API_KEY", "default_key")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.token_budget = get_token_budget(GEMINI_MODEL_NAME, "classification")
+        
+        # Gather concurrent classification prompts into batched calls
+        self.batcher = PromptBatcher(lambda prompt: generate_text(prompt, agent="classifier"), name="classifier")
         
         # Few-shot examples for classification
         self.classification_examples = """
@@ -38,8 +44,8 @@ Examples of file classification:
    Business Intent: Fraud Risk
 """
 
-    async def classify(self, file_path: str, filename: str, content: bytes) -> Dict[str, Any]:
-        """Classify file type and business intent"""
+    async def classify(self, file_path: Optional[str], filename: str, content: bytes) -> Dict[str, Any]:
+        """Classify file type and business intent from the file's leading bytes"""
         try:
             # Determine file type from extension and content
             file_type = self._detect_file_type(filename, content)
@@ -47,6 +53,9 @@ Examples of file classification:
             # Prepare content for AI analysis
             text_content = self._extract_text_content(content, file_type)
             
+            # Keep only the most informative segments within the token budget
+            content_excerpt = build_content_excerpt(text_content, self.token_budget, strip_quotes=file_type == "email")
+            
             # Create classification prompt
             prompt = f"""
 {self.classification_examples}
@@ -54,7 +63,8 @@ Examples of file classification:
 Analyze this {file_type} file and classify it:
 
 Filename: {filename}
-Content preview: {text_content[:2000]}...
+Content preview:
+{content_excerpt}
 
 Classify this file with:
 1. File Type: email, json, or pdf
@@ -69,12 +79,17 @@ Provide your response in JSON format:
 }}
 """
 
-            # Get AI classification
-            response = self.model.generate_content(prompt)
+            # Get AI classification; an open circuit or exhausted quota fails fast
+            try:
+                response_text = await self.batcher.submit(prompt)
+            except (CircuitBreakerOpenError, RateLimitExceededError, DeadlineExceededError) as e:
+                logger.warning(f"Gemini unavailable for {filename} ({str(e)}), using rule-based classification")
+                count_fallback("classifier", e)
+                return self._fallback_classification(filename, file_type, text_content, fallback_reason=str(e))
             
             try:
-                # Parse AI response
-                ai_result = json.loads(response.text.strip())
+                # Parse and validate AI response
+                ai_result = parse_llm_json(response_text, FileClassification, agent="classifier")
                 
                 # Validate and normalize the result
                 result = {
@@ -89,49 +104,25 @@ Provide your response in JSON format:
                 logger.info(f"Classified {filename} as {result['file_type']} with intent {result['business_intent']}")
                 return result
                 
-            except json.JSONDecodeError:
+            except LLMParseError:
                 # Fallback if AI response is not valid JSON
                 logger.warning(f"AI response not valid JSON for {filename}, using fallback classification")
-                return self._fallback_classification(filename, file_type, text_content)
+                count_fallback("classifier")
+                return self._fallback_classification(filename, file_type, text_content, fallback_reason="unparseable_llm_output")
                 
         except Exception as e:
             logger.error(f"Error classifying file {filename}: {str(e)}")
-            return self._fallback_classification(filename, file_type if 'file_type' in locals() else "unknown", "")
+            count_fallback("classifier", e)
+            return self._fallback_classification(
+                filename,
+                file_type if 'file_type' in locals() else "unknown",
+                text_content if 'text_content' in locals() else "",
+                fallback_reason=str(e)
+            )
 
     def _detect_file_type(self, filename: str, content: bytes) -> str:
-        """Detect file type from filename and content"""
-        filename_lower = filename.lower()
-        
-        if filename_lower.endswith('.pdf'):
-            return "pdf"
-        elif filename_lower.endswith('.json'):
-            return "json"
-        elif filename_lower.endswith(('.eml', '.msg', '.txt')):
-            return "email"
-        
-        # Try to detect from content
-        try:
-            text_content = content.decode('utf-8', errors='ignore')
-            
-            # Check for PDF signature
-            if content.startswith(b'%PDF'):
-                return "pdf"
-            
-            # Check for JSON structure
-            try:
-                json.loads(text_content)
-                return "json"
-            except json.JSONDecodeError:
-                pass
-            
-            # Check for email headers
-            if any(header in text_content.lower() for header in ['from:', 'to:', 'subject:', 'date:']):
-                return "email"
-                
-        except Exception:
-            pass
-        
-        return "unknown"
+        """Detect file type from filename and a bounded prefix of the content"""
+        return detect_file_type(filename, content[:SNIFF_PREFIX_SIZE])
 
     def _extract_text_content(self, content: bytes, file_type: str) -> str:
         """Extract text content for AI analysis"""
@@ -144,7 +135,8 @@ Provide your response in JSON format:
         except Exception:
             return "Could not extract text content"
 
-    def _fallback_classification(self, filename: str, file_type: str, content: str) -> Dict[str, Any]:
+    def _fallback_classification(self, filename: str, file_type: str, content: str,
+                                 fallback_reason: Optional[str] = None) -> Dict[str, Any]:
         """Fallback classification when AI fails"""
         # Enhanced rule-based classification with better keyword matching
         business_intent = "Unknown"
@@ -214,7 +206,7 @@ Provide your response in JSON format:
                 confidence = min(0.8, 0.4 + (max_score * 0.1))  # Scale confidence with keyword matches
                 reasoning = f"Content analysis: {max_score} relevant keywords found"
         
-        return {
+        result = {
             "file_type": file_type,
             "business_intent": business_intent,
             "confidence": confidence,
@@ -222,3 +214,8 @@ Provide your response in JSON format:
             "filename": filename,
             "detected_file_type": file_type
         }
+        
+        if fallback_reason:
+            result["fallback_reason"] = fallback_reason
+        
+        return result
@@ -1,27 +1,79 @@
 import re
 import logging
-from typing import Dict, Any
-import google.generativeai as genai
-import os
-import json
+from typing import Dict, Any, Optional
+from models import EmailAnalysis
+from utils.gemini import GEMINI_MODEL_NAME, generate_text
+from utils.llm_batcher import PromptBatcher
+from utils.llm_parsing import LLMParseError, parse_llm_json
+from utils.metrics import count_fallback
+from utils.prompt_budget import build_content_excerpt, get_token_budget, strip_quoted_reply
+from utils.deadline import DeadlineExceededError
+from utils.retry import CircuitBreakerOpenError, RateLimitExceededError
 
 logger = logging.getLogger(__name__)
 
+# Keyword rules for the rule-based fallback analysis, also used by the pipeline scheduler's pre-score
+URGENT_KEYWORDS = ["urgent", "asap", "immediately", "emergency"]
+HIGH_URGENCY_KEYWORDS = ["soon", "quickly", "priority"]
+MEDIUM_URGENCY_KEYWORDS = ["when possible", "convenient"]
+POLITE_TONE_KEYWORDS = ["please", "thank", "appreciate", "kind"]
+FRUSTRATED_TONE_KEYWORDS = ["disappointed", "frustrated", "upset"]
+ANGRY_TONE_KEYWORDS = ["angry", "outraged", "unacceptable"]
+THREATENING_TONE_KEYWORDS = ["lawyer", "legal", "sue", "lawsuit"]
+POSITIVE_SENTIMENT_KEYWORDS = ["happy", "satisfied", "excellent", "great"]
+NEGATIVE_SENTIMENT_KEYWORDS = ["problem", "issue", "complaint", "terrible"]
+
+# Least to most severe; a conversation keeps the most severe level any of its messages reached
+URGENCY_LEVELS = ["low", "medium", "high", "urgent"]
+TONE_LEVELS = ["polite", "neutral", "frustrated", "angry", "threatening"]
+
+# Open concerns carried along with a conversation (and into its next message's prompt)
+MAX_CONVERSATION_CONCERNS = 10
+
+def _more_severe(levels: list, current: Optional[str], new: Optional[str]) -> Optional[str]:
+    rank = {level: index for index, level in enumerate(levels)}
+    if str(new).lower() not in rank:
+        return current
+    if str(current).lower() not in rank:
+        return str(new).lower()
+    return max(str(current).lower(), str(new).lower(), key=rank.get)
+
+def merge_conversation_state(state: Optional[Dict[str, Any]], analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Conversation tone/urgency after one more message's analysis"""
+    state = state or {}
+    concerns = list(state.get("key_concerns") or [])
+    for concern in analysis.get("key_concerns") or []:
+        if concern not in concerns:
+            concerns.append(concern)
+    return {
+        "urgency": _more_severe(URGENCY_LEVELS, state.get("urgency"), analysis.get("urgency")),
+        "tone": _more_severe(TONE_LEVELS, state.get("tone"), analysis.get("tone")),
+        # Sentiment follows the latest message
+        "sentiment": analysis.get("sentiment") or state.get("sentiment"),
+        "key_concerns": concerns[-MAX_CONVERSATION_CONCERNS:]
+    }
+
 class EmailAgent:
     def __init__(self):
-        # Configure Gemini AI
-        api_key = os.getenv("GEMINI_API_KEY", "default_key")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.token_budget = get_token_budget(GEMINI_MODEL_NAME, "email_analysis")
+        
+        # Gather concurrent email analyses into batched calls
+        self.batcher = PromptBatcher(lambda prompt: generate_text(prompt, agent="email_agent"), name="email_agent")
+
+    async def process(self, content: str, classification: Dict[str, Any],
+                      context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Process email content and extract relevant information
 
-    async def process(self, content: str, classification: Dict[str, Any]) -> Dict[str, Any]:
-        """Process email content and extract relevant information"""
+        context may carry the email's conversation (see services/conversations.py); only the
+        message's own new content is analysed, and escalation is decided on the whole thread.
+        """
         try:
             # Extract basic email headers
             headers = self._extract_headers(content)
+            conversation = (context or {}).get("conversation")
             
-            # Use AI to analyze tone and urgency
-            ai_analysis = await self._analyze_with_ai(content)
+            # Use AI to analyze tone and urgency of the new content, without the quoted history
+            ai_analysis = await self._analyze_with_ai(strip_quoted_reply(content), conversation)
             
             # Combine extracted data
             extracted_data = {
@@ -34,19 +86,16 @@ class EmailAgent:
             # Generate flags based on analysis
             flags = self._generate_flags(extracted_data, classification)
             
-            # Determine if CRM escalation is needed
-            needs_escalation = (
-                extracted_data.get("urgency", "").lower() in ["high", "urgent"] and
-                extracted_data.get("tone", "").lower() in ["angry", "threatening"]
-            )
+            metadata = {
+                "processing_agent": "email_agent",
+                "analysis_confidence": ai_analysis.get("confidence", 0.5),
+                "ai_fallback_reason": ai_analysis.get("fallback_reason")
+            }
+            metadata.update(self._escalation_metadata(extracted_data, conversation))
             
             result = {
                 "extracted_data": extracted_data,
-                "metadata": {
-                    "needs_crm_escalation": needs_escalation,
-                    "processing_agent": "email_agent",
-                    "analysis_confidence": ai_analysis.get("confidence", 0.5)
-                },
+                "metadata": metadata,
                 "flags": flags,
                 "confidence": ai_analysis.get("confidence", 0.7)
             }
@@ -58,6 +107,44 @@ class EmailAgent:
             logger.error(f"Error processing email: {str(e)}")
             return self._fallback_processing(content)
 
+    def reuse(self, content: str, classification: Dict[str, Any], earlier: Dict[str, Any],
+              prepared: Optional[Any] = None, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Result for a near-duplicate of an earlier email: its analysis, with this email's own headers and flags"""
+        extracted_data = {key: value for key, value in earlier["extracted_data"].items()
+                          if key not in ("sender", "recipient", "subject", "date")}
+        extracted_data.update({
+            **self._extract_headers(content),
+            "content_length": len(content),
+            "has_attachments": self._check_attachments(content)
+        })
+        # The earlier email's conversation is not this one's
+        metadata = {key: value for key, value in earlier["metadata"].items() if key != "conversation"}
+        metadata.update(self._escalation_metadata(extracted_data, (context or {}).get("conversation")))
+        return {
+            "extracted_data": extracted_data,
+            "metadata": metadata,
+            "flags": self._generate_flags(extracted_data, classification),
+            "confidence": earlier.get("confidence", 0.7)
+        }
+
+    def _escalation_metadata(self, extracted_data: Dict[str, Any],
+                             conversation: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """CRM escalation decision, on the conversation's running tone/urgency when there is one"""
+        metadata = {}
+        analysis = extracted_data
+        if conversation is not None:
+            analysis = merge_conversation_state(conversation, extracted_data)
+            metadata["conversation"] = {
+                "id": conversation["id"],
+                "message_count": conversation.get("message_count", 1),
+                **analysis
+            }
+        metadata["needs_crm_escalation"] = (
+            str(analysis.get("urgency", "")).lower() in ["high", "urgent"] and
+            str(analysis.get("tone", "")).lower() in ["angry", "threatening"]
+        )
+        return metadata
+
     def _extract_headers(self, content: str) -> Dict[str, str]:
         """Extract email headers using regex"""
         headers = {}
@@ -84,14 +171,17 @@ class EmailAgent:
         
         return headers
 
-    async def _analyze_with_ai(self, content: str) -> Dict[str, Any]:
-        """Use AI to analyze email tone and urgency"""
+    async def _analyze_with_ai(self, content: str, conversation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Use AI to analyze email tone and urgency; content is already without its quoted history"""
         try:
+            # Fit the token budget
+            content_excerpt = build_content_excerpt(content, self.token_budget)
+            
             prompt = f"""
 Analyze this email and extract the following information:
-
+{self._conversation_summary(conversation)}
 Email Content:
-{content[:2000]}...
+{content_excerpt}
 
 Provide analysis in JSON format:
 {{
@@ -104,51 +194,70 @@ Provide analysis in JSON format:
 }}
 """
             
-            response = self.model.generate_content(prompt)
+            response_text = await self.batcher.submit(prompt)
             
             try:
-                result = json.loads(response.text.strip())
+                result = parse_llm_json(response_text, EmailAnalysis, agent="email_agent")
                 return result
-            except json.JSONDecodeError:
+            except LLMParseError:
                 # Fallback analysis
-                return self._fallback_ai_analysis(content)
+                count_fallback("email_agent")
+                return self._fallback_ai_analysis(content, fallback_reason="unparseable_llm_output")
                 
+        except (CircuitBreakerOpenError, RateLimitExceededError, DeadlineExceededError) as e:
+            logger.warning(f"Gemini unavailable ({str(e)}), using rule-based analysis")
+            count_fallback("email_agent", e)
+            return self._fallback_ai_analysis(content, fallback_reason=str(e))
         except Exception as e:
             logger.error(f"AI analysis failed: {str(e)}")
-            return self._fallback_ai_analysis(content)
+            count_fallback("email_agent", e)
+            return self._fallback_ai_analysis(content, fallback_reason=str(e))
+
+    def _conversation_summary(self, conversation: Optional[Dict[str, Any]]) -> str:
+        """A few lines of thread state standing in for the quoted history of a reply"""
+        earlier_messages = (conversation or {}).get("message_count", 1) - 1
+        if earlier_messages < 1:
+            return ""
+        concerns = ", ".join(conversation.get("key_concerns") or []) or "none recorded"
+        return (
+            f"\nThis is a reply in a conversation with {earlier_messages} earlier message(s). "
+            f"So far its urgency is {conversation.get('urgency') or 'unknown'} and its tone "
+            f"{conversation.get('tone') or 'unknown'}; open concerns: {concerns}. "
+            f"Rate only this new message.\n"
+        )
 
-    def _fallback_ai_analysis(self, content: str) -> Dict[str, Any]:
+    def _fallback_ai_analysis(self, content: str, fallback_reason: Optional[str] = None) -> Dict[str, Any]:
         """Fallback analysis using rule-based approach"""
         content_lower = content.lower()
         
         # Determine urgency
         urgency = "low"
-        if any(word in content_lower for word in ["urgent", "asap", "immediately", "emergency"]):
+        if any(word in content_lower for word in URGENT_KEYWORDS):
             urgency = "urgent"
-        elif any(word in content_lower for word in ["soon", "quickly", "priority"]):
+        elif any(word in content_lower for word in HIGH_URGENCY_KEYWORDS):
             urgency = "high"
-        elif any(word in content_lower for word in ["when possible", "convenient"]):
+        elif any(word in content_lower for word in MEDIUM_URGENCY_KEYWORDS):
             urgency = "medium"
         
         # Determine tone
         tone = "neutral"
-        if any(word in content_lower for word in ["please", "thank", "appreciate", "kind"]):
+        if any(word in content_lower for word in POLITE_TONE_KEYWORDS):
             tone = "polite"
-        elif any(word in content_lower for word in ["disappointed", "frustrated", "upset"]):
+        elif any(word in content_lower for word in FRUSTRATED_TONE_KEYWORDS):
             tone = "frustrated"
-        elif any(word in content_lower for word in ["angry", "outraged", "unacceptable"]):
+        elif any(word in content_lower for word in ANGRY_TONE_KEYWORDS):
             tone = "angry"
-        elif any(word in content_lower for word in ["lawyer", "legal", "sue", "lawsuit"]):
+        elif any(word in content_lower for word in THREATENING_TONE_KEYWORDS):
             tone = "threatening"
         
         # Determine sentiment
         sentiment = "neutral"
-        if any(word in content_lower for word in ["happy", "satisfied", "excellent", "great"]):
+        if any(word in content_lower for word in POSITIVE_SENTIMENT_KEYWORDS):
             sentiment = "positive"
-        elif any(word in content_lower for word in ["problem", "issue", "complaint", "terrible"]):
+        elif any(word in content_lower for word in NEGATIVE_SENTIMENT_KEYWORDS):
             sentiment = "negative"
         
-        return {
+        analysis = {
             "urgency": urgency,
             "tone": tone,
             "sentiment": sentiment,
@@ -156,6 +265,11 @@ Provide analysis in JSON format:
             "key_concerns": [],
             "contact_info": self._extract_contact_info(content)
         }
+        
+        if fallback_reason:
+            analysis["fallback_reason"] = fallback_reason
+        
+        return analysis
 
     def _extract_contact_info(self, content: str) -> str:
         """Extract contact information from email"""
@@ -1,8 +1,6 @@
 import json
 import logging
 from typing import Dict, Any
-import jsonschema
-from jsonschema import validate, ValidationError
 
 logger = logging.getLogger(__name__)
 
@@ -83,6 +81,9 @@ class JSONAgent:
 
     def _validate_structure(self, json_data: Dict[str, Any], classification: Dict[str, Any]) -> Dict[str, Any]:
         """Validate JSON against expected schemas"""
+        # Deferred so jsonschema only loads once a JSON document is seen
+        from jsonschema import validate, ValidationError
+        
         validation_result = {
             "is_valid": True,
             "schema_matches": [],
@@ -1,32 +1,114 @@
-import PyPDF2
 import logging
-from typing import Dict, Any
+import mmap
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Any, Optional
 import re
 import os
-import google.generativeai as genai
-import json
+from models import PDFAnalysis
+from utils.gemini import GEMINI_MODEL_NAME, generate_text
+from utils.llm_parsing import LLMParseError, parse_llm_json
+from utils.metrics import count_fallback
+from utils.prompt_budget import build_content_excerpt, get_token_budget
+from utils.deadline import DeadlineExceededError
+from utils.retry import CircuitBreakerOpenError, RateLimitExceededError
+
+if TYPE_CHECKING:
+    import PyPDF2
 
 logger = logging.getLogger(__name__)
 
+@contextmanager
+def _open_pdf(file_path: str):
+    """Open a PDF through a read-only memory map so pages are paged in on demand"""
+    # Imported on first use so PyPDF2 only loads once a PDF is seen (and in pool workers)
+    import PyPDF2
+    
+    with open(file_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield PyPDF2.PdfReader(mapped)
+
+def _extract_text(pdf_reader: "PyPDF2.PdfReader") -> str:
+    """Extract text content from PDF"""
+    page_texts = []
+    text_length = 0
+
+    for page_num, page in enumerate(pdf_reader.pages):
+        try:
+            page_text = page.extract_text() or ""
+            page_texts.append(page_text)
+            text_length += len(page_text) + 1
+
+            # Limit extraction to prevent memory issues
+            if text_length > 50000:  # 50KB limit
+                logger.warning("PDF text extraction truncated due to size limit")
+                break
+
+        except Exception as e:
+            logger.warning(f"Error extracting text from page {page_num}: {str(e)}")
+            continue
+
+    return "\n".join(page_texts).strip()
+
+def _extract_metadata(pdf_reader: "PyPDF2.PdfReader", file_path: str) -> Dict[str, Any]:
+    """Extract PDF metadata"""
+    metadata = {}
+
+    try:
+        metadata["page_count"] = len(pdf_reader.pages)
+
+        # Extract document info
+        if pdf_reader.metadata:
+            metadata["title"] = pdf_reader.metadata.get('/Title', '')
+            metadata["author"] = pdf_reader.metadata.get('/Author', '')
+            metadata["subject"] = pdf_reader.metadata.get('/Subject', '')
+            metadata["creator"] = pdf_reader.metadata.get('/Creator', '')
+            metadata["producer"] = pdf_reader.metadata.get('/Producer', '')
+
+            # Convert dates if present
+            creation_date = pdf_reader.metadata.get('/CreationDate')
+            if creation_date:
+                metadata["creation_date"] = str(creation_date)
+
+        # Check for encryption
+        metadata["is_encrypted"] = pdf_reader.is_encrypted
+
+        # File size
+        metadata["file_size"] = os.path.getsize(file_path)
+
+    except Exception as e:
+        logger.error(f"Error extracting PDF metadata: {str(e)}")
+        metadata["extraction_error"] = str(e)
+
+    return metadata
+
+def extract_pdf_content(file_path: str) -> Dict[str, Any]:
+    """Extract text and metadata from one memory-mapped read of a PDF
+
+    CPU-bound and picklable, so the agent dispatcher can run it in a worker process.
+    """
+    with _open_pdf(file_path) as pdf_reader:
+        return {
+            "text": _extract_text(pdf_reader),
+            "metadata": _extract_metadata(pdf_reader, file_path)
+        }
+
 class PDFAgent:
     def __init__(self):
-        # Configure Gemini AI
-        api_key = os.getenv("GEMINI_API_KEY", "default_key")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.token_budget = get_token_budget(GEMINI_MODEL_NAME, "pdf_analysis")
 
-    async def process(self, file_path: str, classification: Dict[str, Any]) -> Dict[str, Any]:
+    async def process(self, file_path: str, classification: Dict[str, Any],
+                      prepared: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Process PDF file and extract relevant information"""
         try:
-            # Extract text from PDF
-            text_content = self._extract_text(file_path)
+            # Text and metadata may already have been extracted in a worker process
+            if prepared is None:
+                prepared = extract_pdf_content(file_path)
+            text_content = prepared["text"]
+            metadata = prepared["metadata"]
             
             if not text_content.strip():
                 logger.warning("No text content extracted from PDF")
-                return self._handle_empty_pdf(file_path)
-            
-            # Get PDF metadata
-            metadata = self._extract_metadata(file_path)
+                return self._handle_empty_pdf(metadata)
             
             # Use AI to extract structured data
             ai_analysis = await self._analyze_with_ai(text_content, classification)
@@ -52,7 +134,8 @@ class PDFAgent:
                     "processing_agent": "pdf_agent",
                     "pdf_metadata": metadata,
                     "text_extraction_successful": True,
-                    "ai_analysis_confidence": ai_analysis.get("confidence", 0.5)
+                    "ai_analysis_confidence": ai_analysis.get("confidence", 0.5),
+                    "ai_fallback_reason": ai_analysis.get("fallback_reason")
                 },
                 "flags": flags,
                 "confidence": 0.8 if text_content else 0.3
@@ -65,79 +148,42 @@ class PDFAgent:
             logger.error(f"Error processing PDF: {str(e)}")
             return self._fallback_processing(file_path, str(e))
 
-    def _extract_text(self, file_path: str) -> str:
-        """Extract text content from PDF"""
-        text_content = ""
+    def reuse(self, file_path: str, classification: Dict[str, Any], earlier: Dict[str, Any],
+              prepared: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Result for a near-duplicate of an earlier PDF: its AI analysis, with this document's own fields"""
+        if prepared is None:
+            prepared = extract_pdf_content(file_path)
+        text_content = prepared["text"]
+        metadata = prepared["metadata"]
         
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    try:
-                        page_text = page.extract_text()
-                        text_content += page_text + "\n"
-                        
-                        # Limit extraction to prevent memory issues
-                        if len(text_content) > 50000:  # 50KB limit
-                            logger.warning("PDF text extraction truncated due to size limit")
-                            break
-                            
-                    except Exception as e:
-                        logger.warning(f"Error extracting text from page {page_num}: {str(e)}")
-                        continue
-                        
-        except Exception as e:
-            logger.error(f"Error opening PDF file: {str(e)}")
-            raise
-        
-        return text_content.strip()
-
-    def _extract_metadata(self, file_path: str) -> Dict[str, Any]:
-        """Extract PDF metadata"""
-        metadata = {}
-        
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
-                metadata["page_count"] = len(pdf_reader.pages)
-                
-                # Extract document info
-                if pdf_reader.metadata:
-                    metadata["title"] = pdf_reader.metadata.get('/Title', '')
-                    metadata["author"] = pdf_reader.metadata.get('/Author', '')
-                    metadata["subject"] = pdf_reader.metadata.get('/Subject', '')
-                    metadata["creator"] = pdf_reader.metadata.get('/Creator', '')
-                    metadata["producer"] = pdf_reader.metadata.get('/Producer', '')
-                    
-                    # Convert dates if present
-                    creation_date = pdf_reader.metadata.get('/CreationDate')
-                    if creation_date:
-                        metadata["creation_date"] = str(creation_date)
-                
-                # Check for encryption
-                metadata["is_encrypted"] = pdf_reader.is_encrypted
-                
-                # File size
-                metadata["file_size"] = os.path.getsize(file_path)
-                
-        except Exception as e:
-            logger.error(f"Error extracting PDF metadata: {str(e)}")
-            metadata["extraction_error"] = str(e)
-        
-        return metadata
+        # Amounts and numbers are this document's own, whatever the earlier analysis found
+        extracted_data = {
+            **earlier["extracted_data"],
+            **self._extract_business_fields(text_content),
+            "text_length": len(text_content),
+            "page_count": metadata.get("page_count", 0),
+            "content_preview": text_content[:500]
+        }
+        return {
+            "extracted_data": extracted_data,
+            "metadata": {**earlier["metadata"], "pdf_metadata": metadata},
+            "flags": self._generate_flags(text_content, extracted_data, classification),
+            "confidence": earlier.get("confidence", 0.8)
+        }
 
     async def _analyze_with_ai(self, text_content: str, classification: Dict[str, Any]) -> Dict[str, Any]:
         """Use AI to analyze PDF content and extract structured data"""
         try:
             business_intent = classification.get("business_intent", "Unknown")
             
+            # Keep only the most informative segments within the token budget
+            content_excerpt = build_content_excerpt(text_content, self.token_budget)
+            
             prompt = f"""
 Analyze this PDF document content and extract relevant information based on the business intent: {business_intent}
 
 Document Content:
-{text_content[:3000]}...
+{content_excerpt}
 
 Extract the following information in JSON format:
 {{
@@ -154,19 +200,25 @@ Extract the following information in JSON format:
 }}
 """
             
-            response = self.model.generate_content(prompt)
+            response_text = await generate_text(prompt, agent="pdf_agent")
             
             try:
-                result = json.loads(response.text.strip())
+                result = parse_llm_json(response_text, PDFAnalysis, agent="pdf_agent")
                 return result
-            except json.JSONDecodeError:
-                return self._fallback_ai_analysis(text_content)
+            except LLMParseError:
+                count_fallback("pdf_agent")
+                return self._fallback_ai_analysis(text_content, fallback_reason="unparseable_llm_output")
                 
+        except (CircuitBreakerOpenError, RateLimitExceededError, DeadlineExceededError) as e:
+            logger.warning(f"Gemini unavailable ({str(e)}), using rule-based analysis")
+            count_fallback("pdf_agent", e)
+            return self._fallback_ai_analysis(text_content, fallback_reason=str(e))
         except Exception as e:
             logger.error(f"AI analysis failed: {str(e)}")
-            return self._fallback_ai_analysis(text_content)
+            count_fallback("pdf_agent", e)
+            return self._fallback_ai_analysis(text_content, fallback_reason=str(e))
 
-    def _fallback_ai_analysis(self, text_content: str) -> Dict[str, Any]:
+    def _fallback_ai_analysis(self, text_content: str, fallback_reason: Optional[str] = None) -> Dict[str, Any]:
         """Fallback analysis using rule-based extraction"""
         extracted_fields = {}
         
@@ -195,11 +247,16 @@ Extract the following information in JSON format:
         if compliance_mentions:
             extracted_fields["compliance_mentions"] = compliance_mentions
         
-        return {
+        analysis = {
             "extracted_fields": extracted_fields,
             "confidence": 0.6,
             "summary": "Rule-based extraction performed"
         }
+        
+        if fallback_reason:
+            analysis["fallback_reason"] = fallback_reason
+        
+        return analysis
 
     def _extract_business_fields(self, text_content: str) -> Dict[str, Any]:
         """Extract business-specific fields using regex patterns"""
@@ -282,10 +339,8 @@ Extract the following information in JSON format:
         
         return flags
 
-    def _handle_empty_pdf(self, file_path: str) -> Dict[str, Any]:
+    def _handle_empty_pdf(self, metadata: Dict[str, Any]) -> Dict[str, Any]:
         """Handle PDFs with no extractable text"""
-        metadata = self._extract_metadata(file_path)
-        
         return {
             "extracted_data": {
                 "text_content": "",
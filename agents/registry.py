@@ -0,0 +1,114 @@
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# How an agent's blocking preparation stage is executed
+EXECUTION_ASYNC = "async"      # inline on the event loop (I/O-bound agents)
+EXECUTION_THREAD = "thread"    # in a dedicated thread pool
+EXECUTION_PROCESS = "process"  # in a dedicated process pool (CPU-bound agents)
+
+EXECUTION_KINDS = (EXECUTION_ASYNC, EXECUTION_THREAD, EXECUTION_PROCESS)
+
+class AgentSpec:
+    """Declares how documents of one format are handled by an agent"""
+
+    def __init__(self, name: str, file_type: str, factory: Callable[[], Any],
+                 input_kind: str = "text", execution: str = EXECUTION_ASYNC,
+                 max_concurrency: int = 8, prepare: Optional[Callable[[Any], Any]] = None,
+                 pool_size: Optional[int] = None):
+        """
+        Args:
+            name: Agent name used in logs and environment overrides
+            file_type: Classified file type routed to this agent
+            factory: Builds the agent; called once, on first use
+            input_kind: "text" to receive the decoded document, "path" for a file path
+            execution: Where the prepare stage runs: async, thread or process
+            max_concurrency: Maximum documents this agent handles at once
+            prepare: Optional blocking, picklable function run on the input before
+                agent.process(); its output is passed as the `prepared` argument
+            pool_size: Workers in the thread/process pool (defaults to max_concurrency)
+        """
+        if execution not in EXECUTION_KINDS:
+            raise ValueError(f"Unknown execution kind for {name}: {execution}")
+        if execution != EXECUTION_ASYNC and prepare is None:
+            raise ValueError(f"Agent {name} needs a prepare stage to run in a {execution} pool")
+
+        self.name = name
+        self.file_type = file_type
+        self.factory = factory
+        self.input_kind = input_kind
+        self.execution = execution
+        self.max_concurrency = max_concurrency
+        self.prepare = prepare
+        self.pool_size = pool_size or max_concurrency
+
+class AgentRegistry:
+    """Maps classified file types to agent specs"""
+
+    def __init__(self):
+        self._specs: Dict[str, AgentSpec] = {}
+
+    def register(self, spec: AgentSpec):
+        """Register (or replace) the agent for a file type"""
+        if spec.file_type in self._specs:
+            logger.info(f"Replacing agent for {spec.file_type}: {self._specs[spec.file_type].name} -> {spec.name}")
+        self._specs[spec.file_type] = spec
+
+    def get(self, file_type: str) -> Optional[AgentSpec]:
+        """Get the agent spec for a file type, if any"""
+        return self._specs.get(file_type)
+
+    def specs(self) -> List[AgentSpec]:
+        """All registered agent specs"""
+        return list(self._specs.values())
+
+def _configured(spec: AgentSpec) -> AgentSpec:
+    """Apply AGENT_<NAME>_CONCURRENCY / _POOL_SIZE / _EXECUTION environment overrides"""
+    prefix = f"AGENT_{spec.name.upper()}"
+    concurrency = os.getenv(f"{prefix}_CONCURRENCY")
+    if concurrency:
+        spec.max_concurrency = int(concurrency)
+    pool_size = os.getenv(f"{prefix}_POOL_SIZE")
+    if pool_size:
+        spec.pool_size = int(pool_size)
+    execution = os.getenv(f"{prefix}_EXECUTION")
+    if execution and (execution == EXECUTION_ASYNC or spec.prepare is not None):
+        spec.execution = execution
+    return spec
+
+def default_registry() -> AgentRegistry:
+    """Build the registry of built-in agents"""
+    from agents.email_agent import EmailAgent
+    from agents.json_agent import JSONAgent
+    from agents.pdf_agent import PDFAgent, extract_pdf_content
+
+    registry = AgentRegistry()
+    registry.register(_configured(AgentSpec(
+        name="email_agent",
+        file_type="email",
+        factory=EmailAgent,
+        input_kind="text",
+        execution=EXECUTION_ASYNC,
+        max_concurrency=32
+    )))
+    registry.register(_configured(AgentSpec(
+        name="json_agent",
+        file_type="json",
+        factory=JSONAgent,
+        input_kind="text",
+        execution=EXECUTION_ASYNC,
+        max_concurrency=64
+    )))
+    registry.register(_configured(AgentSpec(
+        name="pdf_agent",
+        file_type="pdf",
+        factory=PDFAgent,
+        input_kind="path",
+        execution=EXECUTION_PROCESS,
+        max_concurrency=16,
+        prepare=extract_pdf_content,
+        pool_size=max(1, (os.cpu_count() or 2) - 1)
+    )))
+    return registry
@@ -0,0 +1,83 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile (0-100) of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(len(sorted_values) * p / 100.0 + 0.999999))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(samples_ms: List[float]) -> Dict[str, Any]:
+    """Count, mean and tail percentiles of latency samples in milliseconds"""
+    ordered = sorted(samples_ms)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "min_ms": round(ordered[0], 3),
+        "p50_ms": round(percentile(ordered, 50), 3),
+        "p90_ms": round(percentile(ordered, 90), 3),
+        "p95_ms": round(percentile(ordered, 95), 3),
+        "p99_ms": round(percentile(ordered, 99), 3),
+        "max_ms": round(ordered[-1], 3)
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_info(benchmark: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Metadata identifying a benchmark run, so results can be compared later"""
+    return {
+        "benchmark": benchmark,
+        "started_at": datetime.utcnow().isoformat(),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config
+    }
+
+def emit(report: Dict[str, Any], output: Optional[str]):
+    """Print a report as JSON, and write it to a file if requested"""
+    text = json.dumps(report, indent=2, default=str)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process (Linux /proc), or None if unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+def child_pids(pid: int) -> List[int]:
+    """Direct children of a process (Linux /proc), e.g. uvicorn workers or agent pool processes"""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
@@ -0,0 +1,72 @@
+"""Compare two benchmark reports written by benchmarks.load or benchmarks.micro.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 5]
+
+Prints every shared numeric result with its relative change; changes beyond the threshold are marked.
+"""
+import argparse
+import json
+from typing import Any, Dict
+
+# Metrics where a larger value is better; everything else (latencies, error rates, memory) is lower-is-better
+HIGHER_IS_BETTER = ("throughput_rps", "goodput_rps", "ops_per_sec")
+
+def flatten(value: Any, prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a nested report keyed by dotted path"""
+    leaves: Dict[str, float] = {}
+    if isinstance(value, dict):
+        for key, child in value.items():
+            leaves.update(flatten(child, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        leaves[prefix] = float(value)
+    return leaves
+
+def compare(baseline: Dict[str, Any], candidate: Dict[str, Any], threshold: float) -> Dict[str, Any]:
+    before = flatten(baseline.get("results", {}))
+    after = flatten(candidate.get("results", {}))
+    rows = []
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        change = (new - old) / old * 100 if old else None
+        verdict = "same"
+        if change is not None and abs(change) >= threshold:
+            better = change > 0 if key.endswith(HIGHER_IS_BETTER) else change < 0
+            verdict = "better" if better else "worse"
+        rows.append({"metric": key, "baseline": old, "candidate": new,
+                     "change_pct": round(change, 2) if change is not None else None, "verdict": verdict})
+    return {
+        "baseline_commit": baseline.get("git_commit"),
+        "candidate_commit": candidate.get("git_commit"),
+        "threshold_pct": threshold,
+        "worse": sum(1 for row in rows if row["verdict"] == "worse"),
+        "better": sum(1 for row in rows if row["verdict"] == "better"),
+        "rows": rows
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark JSON reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=5.0, help="Percent change reported as better/worse")
+    parser.add_argument("--json", action="store_true", help="Print the comparison as JSON")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    result = compare(baseline, candidate, args.threshold)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{result['baseline_commit']} -> {result['candidate_commit']}: "
+          f"{result['better']} better, {result['worse']} worse (threshold {args.threshold:g}%)")
+    for row in result["rows"]:
+        change = "n/a" if row["change_pct"] is None else f"{row['change_pct']:+.1f}%"
+        marker = {"better": "+", "worse": "!", "same": " "}[row["verdict"]]
+        print(f"{marker} {row['metric']:<70} {row['baseline']:>12.3f} {row['candidate']:>12.3f} {change:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Generate a synthetic document corpus (emails, JSON payloads, PDFs) for the benchmarks.
+
+Usage:
+    python -m benchmarks.corpus --output benchmarks/corpus --count 300 [--seed 7] [--pdf-pages 3]
+
+Writes the files plus manifest.json listing each file with its expected type and intent.
+"""
+import argparse
+import json
+import os
+import random
+import zlib
+from typing import Any, Dict, List, Optional
+
+INTENTS = ("RFQ", "Complaint", "Invoice", "Regulation", "Fraud Risk")
+
+# File type mix of a typical inbox
+TYPE_WEIGHTS = {"email": 0.5, "json": 0.3, "pdf": 0.2}
+
+_COMPANIES = ("Acme Corp", "Globex", "Initech", "Umbrella Ltd", "Stark Industries", "Wayne Enterprises")
+_PRODUCTS = ("steel brackets", "laptop batteries", "office chairs", "network switches", "safety gloves")
+_NAMES = ("Jordan Lee", "Sam Patel", "Alex Kim", "Robin Garcia", "Taylor Chen")
+
+_EMAIL_BODIES = {
+    "RFQ": "We would like a quotation for {qty} units of {product}. Please include pricing and delivery times.",
+    "Complaint": "This is unacceptable. The {product} we received were damaged and nobody has replied to us. "
+                 "We expect a refund immediately or we will contact our lawyer.",
+    "Invoice": "Please find the invoice for {qty} units of {product}. The amount due is ${amount:,.2f}.",
+    "Regulation": "Following the latest GDPR guidance, please confirm your compliance procedures for {product} data.",
+    "Fraud Risk": "We noticed a suspicious transfer of ${amount:,.2f} from our account that we did not authorize. "
+                  "Please investigate this fraud urgently.",
+}
+
+_PDF_BODIES = {
+    "RFQ": ["REQUEST FOR QUOTATION", "Items: {qty} x {product}", "Deadline: 2024-07-01"],
+    "Complaint": ["FORMAL COMPLAINT", "Product: {product}", "The delivery was damaged and late."],
+    "Invoice": ["INVOICE {number}", "Vendor: {company}", "{qty} x {product}", "Total: ${amount:,.2f}"],
+    "Regulation": ["COMPLIANCE NOTICE", "This policy covers GDPR and FDA requirements.", "Scope: {product}"],
+    "Fraud Risk": ["INCIDENT REPORT", "Unauthorized transaction of ${amount:,.2f}", "Account flagged for review."],
+}
+
+def _fields(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "qty": rng.randint(1, 500),
+        "product": rng.choice(_PRODUCTS),
+        "company": rng.choice(_COMPANIES),
+        "name": rng.choice(_NAMES),
+        # Mostly small amounts with a tail over the 10,000 high-value threshold
+        "amount": round(rng.lognormvariate(7.5, 1.2), 2),
+        "number": f"INV-{rng.randint(10000, 99999)}",
+    }
+
+def make_email(intent: str, rng: random.Random, padding: int = 0) -> bytes:
+    """A plain-text RFC 822 style email"""
+    fields = _fields(rng)
+    sender = fields["name"].lower().replace(" ", ".")
+    subject = {"Complaint": "URGENT: damaged delivery", "Fraud Risk": "Suspicious transaction"}.get(
+        intent, f"{intent} - {fields['product']}"
+    )
+    body = _EMAIL_BODIES[intent].format(**fields)
+    filler = " ".join(rng.choice(_PRODUCTS) for _ in range(padding))
+    return (
+        f"From: {fields['name']} <{sender}@example.com>\n"
+        f"To: orders@example.com\n"
+        f"Subject: {subject}\n"
+        f"Date: Mon, 3 Jun 2024 09:{rng.randint(10, 59)}:00 +0000\n\n"
+        f"Hello,\n\n{body}\n\n{filler}\n\nRegards,\n{fields['name']}\n{fields['company']}\n"
+    ).encode()
+
+def make_json(intent: str, rng: random.Random, items: int = 3) -> bytes:
+    """An invoice, transaction or RFQ payload matching (or, sometimes, breaking) the JSON agent schemas"""
+    fields = _fields(rng)
+    line_items = [
+        {"sku": f"SKU-{rng.randint(100, 999)}", "description": rng.choice(_PRODUCTS),
+         "quantity": rng.randint(1, 50), "unit_price": round(rng.uniform(1, 500), 2)}
+        for _ in range(items)
+    ]
+    if intent == "Fraud Risk":
+        document = {
+            "transaction_id": f"TX-{rng.randint(100000, 999999)}", "amount": fields["amount"],
+            "timestamp": "2024-06-03T09:15:00Z", "account": f"ACC-{rng.randint(1000, 9999)}",
+            "type": "wire_transfer", "flags": ["suspicious", "new_beneficiary"]
+        }
+    elif intent == "RFQ":
+        document = {
+            "rfq_id": f"RFQ-{rng.randint(1000, 9999)}", "items": line_items, "deadline": "2024-07-01",
+            "contact": {"name": fields["name"], "email": "buyer@example.com"}
+        }
+    else:
+        document = {
+            "invoice_number": fields["number"], "amount": fields["amount"], "date": "2024-06-03",
+            "vendor": fields["company"], "items": line_items, "notes": f"{intent} related document"
+        }
+    # A few payloads with a wrong type or a missing required field, for the validation paths
+    if rng.random() < 0.1:
+        document["amount"] = str(document.get("amount", ""))
+    return json.dumps(document, indent=2).encode()
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(lines_per_page: List[List[str]]) -> bytes:
+    """A minimal valid PDF with one Helvetica text page per list of lines, written without any PDF library"""
+    objects: List[bytes] = []
+    page_count = len(lines_per_page)
+    # Object numbers: 1 catalog, 2 pages, 3 font, then a (page, content) pair per page
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(page_count))
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>".encode())
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for index, lines in enumerate(lines_per_page):
+        text = "BT /F1 11 Tf 72 740 Td 14 TL " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        stream = zlib.compress(text.encode("latin-1", "replace"))
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {5 + 2 * index} 0 R >>".encode()
+        )
+        objects.append(
+            f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode() + stream + b"\nendstream"
+        )
+
+    output = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    return bytes(output)
+
+def make_pdf_document(intent: str, rng: random.Random, pages: int = 1) -> bytes:
+    """A business PDF for an intent, padded with line-item pages"""
+    fields = _fields(rng)
+    first_page = [line.format(**fields) for line in _PDF_BODIES[intent]]
+    page_lines = [first_page]
+    for page in range(1, pages):
+        page_lines.append([
+            f"Line {page * 40 + row}: {rng.randint(1, 20)} x {rng.choice(_PRODUCTS)} @ ${rng.uniform(1, 900):,.2f}"
+            for row in range(40)
+        ])
+    return make_pdf(page_lines)
+
+def generate_corpus(output_dir: str, count: int, seed: int = 7, pdf_pages: int = 2,
+                    type_weights: Optional[Dict[str, float]] = None) -> List[Dict[str, Any]]:
+    """Write count documents to output_dir and return the manifest entries"""
+    rng = random.Random(seed)
+    weights = type_weights or TYPE_WEIGHTS
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = []
+
+    for index in range(count):
+        file_type = rng.choices(list(weights), weights=list(weights.values()))[0]
+        intent = rng.choice(INTENTS)
+        slug = intent.lower().replace(" ", "_")
+        if file_type == "email":
+            filename = f"{index:05d}_{slug}.eml"
+            data = make_email(intent, rng, padding=rng.randint(0, 200))
+        elif file_type == "json":
+            filename = f"{index:05d}_{slug}.json"
+            data = make_json(intent, rng, items=rng.randint(1, 20))
+        else:
+            filename = f"{index:05d}_{slug}.pdf"
+            data = make_pdf_document(intent, rng, pages=rng.randint(1, pdf_pages))
+
+        with open(os.path.join(output_dir, filename), "wb") as f:
+            f.write(data)
+        manifest.append({"filename": filename, "file_type": file_type, "business_intent": intent, "bytes": len(data)})
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump({"seed": seed, "documents": manifest}, f, indent=2)
+    return manifest
+
+def load_corpus(corpus_dir: str) -> List[Dict[str, Any]]:
+    """Manifest entries of a generated corpus, each with its full path"""
+    with open(os.path.join(corpus_dir, "manifest.json")) as f:
+        documents = json.load(f)["documents"]
+    for document in documents:
+        document["path"] = os.path.join(corpus_dir, document["filename"])
+    return documents
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic benchmark corpus")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "corpus"))
+    parser.add_argument("--count", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--pdf-pages", type=int, default=3, help="Maximum pages per generated PDF")
+    args = parser.parse_args()
+
+    manifest = generate_corpus(args.output, args.count, args.seed, args.pdf_pages)
+    by_type: Dict[str, int] = {}
+    for document in manifest:
+        by_type[document["file_type"]] = by_type.get(document["file_type"], 0) + 1
+    print(json.dumps({"output": args.output, "documents": len(manifest), "by_type": by_type}))
+
+if __name__ == "__main__":
+    main()
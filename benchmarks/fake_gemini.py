@@ -0,0 +1,239 @@
+"""Local stand-in for the Gemini generateContent REST API, for load tests without quota.
+
+Usage:
+    python -m benchmarks.fake_gemini --port 8089 --latency lognormal --median-ms 800 --sigma 0.6 \
+        --tail-rate 0.01 --tail-ms 20000 --error-rate 0.02
+
+Then start the app with GEMINI_API_ENDPOINT=http://127.0.0.1:8089. Answers are plausible
+JSON for the classifier, email and PDF prompts, including batched multi-task prompts.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_TASK_HEADER = re.compile(r'^### TASK \d+\s*$', re.MULTILINE)
+_FILE_TYPE = re.compile(r'Analyze this (\w+) file')
+_CONTENT_START = re.compile(r'(?:Content preview|Email Content|Document Content):\s*\n', re.IGNORECASE)
+
+_INTENT_KEYWORDS = [
+    ("Fraud Risk", ("fraud", "suspicious", "unauthorized", "chargeback")),
+    ("Complaint", ("complaint", "unacceptable", "disappointed", "refund", "lawyer")),
+    ("Regulation", ("gdpr", "fda", "compliance", "regulation", "regulatory")),
+    ("Invoice", ("invoice", "amount due", "payment", "total")),
+    ("RFQ", ("quotation", "quote", "rfq", "pricing")),
+]
+
+class LatencyModel:
+    """Response delay distribution with an optional slow tail"""
+
+    def __init__(self, kind: str = "lognormal", median_ms: float = 800.0, sigma: float = 0.5,
+                 low_ms: float = 200.0, high_ms: float = 1500.0, tail_rate: float = 0.0, tail_ms: float = 20000.0):
+        self.kind = kind
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.low_ms = low_ms
+        self.high_ms = high_ms
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+
+    def sample_seconds(self) -> float:
+        if self.tail_rate and random.random() < self.tail_rate:
+            return self.tail_ms / 1000.0
+        if self.kind == "constant":
+            return self.median_ms / 1000.0
+        if self.kind == "uniform":
+            return random.uniform(self.low_ms, self.high_ms) / 1000.0
+        return random.lognormvariate(0.0, self.sigma) * self.median_ms / 1000.0
+
+def _content_of(task: str) -> str:
+    match = _CONTENT_START.search(task)
+    return (task[match.end():] if match else task).lower()
+
+def _intent_of(text: str) -> str:
+    for intent, keywords in _INTENT_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            return intent
+    return "RFQ"
+
+def answer_task(task: str) -> Dict[str, Any]:
+    """A plausible JSON answer for one of the app's prompts"""
+    content = _content_of(task)
+    if "Classify this file" in task:
+        file_type = _FILE_TYPE.search(task)
+        return {
+            "file_type": file_type.group(1) if file_type else "email",
+            "business_intent": _intent_of(content),
+            "confidence": 0.9,
+            "reasoning": "fake-gemini keyword match"
+        }
+    if "Analyze this email" in task:
+        urgent = any(word in content for word in ("urgent", "asap", "immediately"))
+        angry = any(word in content for word in ("unacceptable", "angry", "lawyer"))
+        return {
+            "urgency": "urgent" if urgent else "medium",
+            "tone": "angry" if angry else "polite",
+            "sentiment": "negative" if angry else "neutral",
+            "confidence": 0.85,
+            "key_concerns": ["fake-gemini"],
+            "contact_info": ""
+        }
+    if "Analyze this PDF document" in task:
+        return {
+            "extracted_fields": {
+                "document_type": "invoice" if "invoice" in content else "letter",
+                "key_amounts": re.findall(r'\$[\d,]+(?:\.\d{2})?', content)[:5],
+                "dates": [],
+                "contact_info": "",
+                "key_entities": [],
+                "compliance_mentions": [word.upper() for word in ("gdpr", "fda") if word in content]
+            },
+            "confidence": 0.8,
+            "summary": "fake-gemini summary"
+        }
+    return {"answer": "fake-gemini", "confidence": 0.5}
+
+def answer_prompt(prompt: str) -> Any:
+    """Answer a prompt, returning a JSON array for batched multi-task prompts"""
+    if _TASK_HEADER.search(prompt):
+        tasks = _TASK_HEADER.split(prompt)[1:]
+        return [answer_task(task) for task in tasks]
+    return answer_task(prompt)
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: LatencyModel, error_rate: float = 0.0,
+                 error_statuses: Optional[List[int]] = None, malformed_rate: float = 0.0):
+        super().__init__(address, FakeGeminiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [500, 503, 429]
+        self.malformed_rate = malformed_rate
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "malformed": 0}
+
+    def count(self, key: str):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    server: FakeGeminiServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, body: Dict[str, Any]):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.startswith("/stats"):
+            with self.server.stats_lock:
+                self._send_json(200, dict(self.server.stats))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.server.count("requests")
+
+        if ":generateContent" not in self.path:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unsupported path {self.path}"}})
+            return
+
+        time.sleep(self.server.latency.sample_seconds())
+
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count("errors")
+            status = random.choice(self.server.error_statuses)
+            self._send_json(status, {"error": {"code": status, "message": "fake-gemini injected error", "status": "UNAVAILABLE"}})
+            return
+
+        prompt = "\n".join(
+            part.get("text", "")
+            for content in body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        text = json.dumps(answer_prompt(prompt))
+        if self.server.malformed_rate and random.random() < self.server.malformed_rate:
+            self.server.count("malformed")
+            text = text[: len(text) // 2]
+
+        self._send_json(200, {
+            "candidates": [{
+                "content": {"parts": [{"text": text}], "role": "model"},
+                "finishReason": "STOP",
+                "index": 0
+            }],
+            "usageMetadata": {
+                "promptTokenCount": len(prompt) // 4,
+                "candidatesTokenCount": len(text) // 4,
+                "totalTokenCount": (len(prompt) + len(text)) // 4
+            }
+        })
+
+def start_server(host: str = "127.0.0.1", port: int = 8089, **options) -> FakeGeminiServer:
+    """Start the fake server on a background thread and return it"""
+    error_rate = options.pop("error_rate", 0.0)
+    malformed_rate = options.pop("malformed_rate", 0.0)
+    server = FakeGeminiServer((host, port), LatencyModel(**options), error_rate=error_rate, malformed_rate=malformed_rate)
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server
+
+def add_latency_arguments(parser: argparse.ArgumentParser):
+    """Command line options shared by the fake server and the load driver that spawns it"""
+    parser.add_argument("--latency", choices=("lognormal", "uniform", "constant"), default="lognormal")
+    parser.add_argument("--median-ms", type=float, default=800.0, help="Median (lognormal) or fixed (constant) delay")
+    parser.add_argument("--sigma", type=float, default=0.5, help="Lognormal shape; larger means a heavier tail")
+    parser.add_argument("--low-ms", type=float, default=200.0, help="Uniform lower bound")
+    parser.add_argument("--high-ms", type=float, default=1500.0, help="Uniform upper bound")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="Fraction of calls taking --tail-ms")
+    parser.add_argument("--tail-ms", type=float, default=20000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 429/500/503")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of answers truncated mid-JSON")
+
+def server_options(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "kind": args.latency,
+        "median_ms": args.median_ms,
+        "sigma": args.sigma,
+        "low_ms": args.low_ms,
+        "high_ms": args.high_ms,
+        "tail_rate": args.tail_rate,
+        "tail_ms": args.tail_ms,
+        "error_rate": args.error_rate,
+        "malformed_rate": args.malformed_rate
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini generateContent server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = start_server(args.host, args.port, **server_options(args))
+    logger.info(f"Fake Gemini listening on http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Load driver for /upload: throughput, latency percentiles, status mix and memory per worker.
+
+Usage:
+    # Against a running server
+    python -m benchmarks.load --url http://127.0.0.1:5000 --corpus benchmarks/corpus --concurrency 32 --duration 60
+
+    # Start the fake Gemini server and uvicorn (on a throwaway SQLite database) first
+    python -m benchmarks.load --spawn --workers 4 --concurrency 64 --requests 2000 --median-ms 800 --error-rate 0.02
+
+A corpus is generated on the fly when --corpus does not exist yet. The report is printed as JSON
+and written to --output when given; compare runs with benchmarks/compare.py.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.common import PROJECT_ROOT, child_pids, emit, rss_bytes, run_info, summarize
+from benchmarks.corpus import generate_corpus, load_corpus
+from benchmarks.fake_gemini import add_latency_arguments, server_options, start_server
+
+class MemorySampler:
+    """Samples the RSS of a server process and its children (uvicorn workers, agent pools) in the background"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_by_pid: Dict[int, int] = {}
+        self.last_by_pid: Dict[int, int] = {}
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _pids(self) -> List[int]:
+        pids = [self.pid]
+        for pid in pids:
+            pids.extend(child for child in child_pids(pid) if child not in pids)
+        return pids
+
+    def _run(self):
+        while not self._stop.is_set():
+            total = 0
+            for pid in self._pids():
+                rss = rss_bytes(pid)
+                if rss is None:
+                    continue
+                total += rss
+                self.last_by_pid[pid] = rss
+                self.peak_by_pid[pid] = max(self.peak_by_pid.get(pid, 0), rss)
+            self.peak_total = max(self.peak_total, total)
+            self._stop.wait(self.interval)
+
+    def report(self) -> Dict[str, Any]:
+        mib = 1024 * 1024
+        return {
+            "processes": len(self.peak_by_pid),
+            "peak_total_mib": round(self.peak_total / mib, 1),
+            "per_process": [
+                {"pid": pid, "peak_mib": round(peak / mib, 1), "last_mib": round(self.last_by_pid.get(pid, 0) / mib, 1)}
+                for pid, peak in sorted(self.peak_by_pid.items())
+            ]
+        }
+
+async def _worker(client: httpx.AsyncClient, url: str, documents: itertools.cycle, state: Dict[str, Any],
+                  stop_at: Optional[float], remaining: Optional[List[int]]):
+    """One closed-loop client: upload, wait for the response, repeat"""
+    while True:
+        if stop_at is not None and time.perf_counter() >= stop_at:
+            return
+        if remaining is not None:
+            if remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+
+        document = next(documents)
+        started = time.perf_counter()
+        try:
+            response = await client.post(
+                f"{url}/upload",
+                files={"file": (document["filename"], document["data"], "application/octet-stream")}
+            )
+            status = str(response.status_code)
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        state["statuses"][status] = state["statuses"].get(status, 0) + 1
+        state["latencies"].append(elapsed_ms)
+        bucket = state["by_type"].setdefault(document["file_type"], [])
+        bucket.append(elapsed_ms)
+        if status == "200":
+            state["ok_latencies"].append(elapsed_ms)
+
+async def run_load(url: str, documents: List[Dict[str, Any]], concurrency: int, duration: Optional[float],
+                   requests: Optional[int], timeout: float) -> Dict[str, Any]:
+    """Drive /upload with a fixed number of concurrent clients and summarize the results"""
+    for document in documents:
+        with open(document["path"], "rb") as f:
+            document["data"] = f.read()
+
+    state: Dict[str, Any] = {"statuses": {}, "latencies": [], "ok_latencies": [], "by_type": {}}
+    cycle = itertools.cycle(documents)
+    stop_at = time.perf_counter() + duration if duration else None
+    remaining = [requests] if requests else None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        await asyncio.gather(*(
+            _worker(client, url, cycle, state, stop_at, remaining) for _ in range(concurrency)
+        ))
+    elapsed = time.perf_counter() - started
+
+    completed = len(state["latencies"])
+    ok = state["statuses"].get("200", 0)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "requests": completed,
+        "throughput_rps": round(completed / elapsed, 3) if elapsed else None,
+        "goodput_rps": round(ok / elapsed, 3) if elapsed else None,
+        "error_rate": round(1 - ok / completed, 4) if completed else None,
+        "statuses": state["statuses"],
+        "latency": summarize(state["latencies"]),
+        "latency_ok": summarize(state["ok_latencies"]),
+        "latency_by_type": {file_type: summarize(samples) for file_type, samples in sorted(state["by_type"].items())}
+    }
+
+def _wait_ready(url: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health/ready", timeout=1.0) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.1)
+    return False
+
+def spawn_server(port: int, workers: int, gemini_url: str, database_url: str, log_file) -> subprocess.Popen:
+    """Start uvicorn for main:app pointed at the fake Gemini server"""
+    env = dict(os.environ)
+    env.setdefault("PYTHONPATH", PROJECT_ROOT)
+    env.update({
+        "GEMINI_API_KEY": env.get("GEMINI_API_KEY", "benchmark"),
+        "GEMINI_API_ENDPOINT": gemini_url,
+        "DATABASE_URL": database_url,
+        "WEB_CONCURRENCY": str(workers)
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=log_file
+    )
+
+def _fetch(url: str) -> Optional[str]:
+    try:
+        with urllib.request.urlopen(url, timeout=5.0) as response:
+            return response.read().decode()
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the /upload endpoint")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="Server to test (ignored with --spawn)")
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_ROOT, "benchmarks", "corpus"))
+    parser.add_argument("--corpus-size", type=int, default=300, help="Documents to generate if the corpus is missing")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run (default: 30 unless --requests)")
+    parser.add_argument("--requests", type=int, default=None, help="Total uploads to send")
+    parser.add_argument("--timeout", type=float, default=180.0, help="Per-request client timeout")
+    parser.add_argument("--warmup", type=int, default=0, help="Uploads sent (sequentially) before measuring")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    parser.add_argument("--server-pid", type=int, help="Sample the memory of an already running server")
+
+    spawn = parser.add_argument_group("spawned server")
+    spawn.add_argument("--spawn", action="store_true", help="Start the fake Gemini server and uvicorn")
+    spawn.add_argument("--port", type=int, default=8766)
+    spawn.add_argument("--gemini-port", type=int, default=8089)
+    spawn.add_argument("--workers", type=int, default=1)
+    spawn.add_argument("--startup-timeout", type=float, default=60.0)
+    add_latency_arguments(spawn)
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.corpus, "manifest.json")):
+        generate_corpus(args.corpus, args.corpus_size)
+    documents = load_corpus(args.corpus)
+    duration = args.duration if args.duration or args.requests else 30.0
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    report = run_info("load", config)
+
+    url = args.url
+    server = None
+    fake_gemini = None
+    scratch = tempfile.TemporaryDirectory()
+    # A file rather than a pipe, so a chatty server can never block on a full pipe buffer
+    server_log = tempfile.TemporaryFile()
+    try:
+        if args.spawn:
+            fake_gemini = start_server("127.0.0.1", args.gemini_port, **server_options(args))
+            url = f"http://127.0.0.1:{args.port}"
+            server = spawn_server(
+                args.port, args.workers, f"http://127.0.0.1:{args.gemini_port}",
+                f"sqlite:///{os.path.join(scratch.name, 'load_benchmark.db')}", server_log
+            )
+            if not _wait_ready(url, args.startup_timeout):
+                server_log.seek(0)
+                raise SystemExit(f"Server did not become ready:\n{server_log.read().decode(errors='ignore')[-2000:]}")
+
+        sampler = None
+        pid = server.pid if server else args.server_pid
+        if pid:
+            sampler = MemorySampler(pid)
+            sampler.start()
+
+        if args.warmup:
+            asyncio.run(run_load(url, documents, 1, None, args.warmup, args.timeout))
+        report["results"] = asyncio.run(
+            run_load(url, documents, args.concurrency, duration, args.requests, args.timeout)
+        )
+
+        if sampler:
+            sampler.stop()
+            report["memory"] = sampler.report()
+        if fake_gemini:
+            report["fake_gemini"] = dict(fake_gemini.stats)
+        # Server-side stage breakdown from one worker, when the endpoint is available
+        stages = _fetch(f"{url}/metrics/latency?file_type=*")
+        if stages:
+            report["server_stages"] = json.loads(stages)["stages"]
+    finally:
+        if server and server.poll() is None:
+            server.terminate()
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if fake_gemini:
+            fake_gemini.shutdown()
+        server_log.close()
+        scratch.cleanup()
+
+    emit(report, args.output)
+
+if __name__ == "__main__":
+    main()
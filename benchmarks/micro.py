@@ -0,0 +1,204 @@
+"""Micro-benchmarks for the CPU-bound and database hot paths that do not call Gemini.
+
+Usage:
+    python -m benchmarks.micro [--only json_validate,pdf_extract,...] [--min-time 2] [--rows 5000] [--output micro.json]
+
+Cases: json_validate (JSONAgent._validate_structure), pdf_extract (pdf_agent._extract_text),
+route_actions (ActionRouter.route_actions with webhooks stubbed out) and memory_store_*
+(MemoryStore queries against a seeded throwaway SQLite database, or --database-url).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from benchmarks.common import PROJECT_ROOT, emit, run_info, summarize
+from benchmarks.corpus import make_json, make_pdf_document
+
+def measure(call: Callable[[], Any], min_time: float, min_runs: int = 20, warmup: int = 3) -> Dict[str, Any]:
+    """Time repeated calls of a synchronous function"""
+    for _ in range(warmup):
+        call()
+    samples: List[float] = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_runs or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return _with_rate(summarize(samples), samples)
+
+async def measure_async(call: Callable[[], Awaitable[Any]], min_time: float, min_runs: int = 20,
+                        warmup: int = 3) -> Dict[str, Any]:
+    """Time repeated awaits of a coroutine function"""
+    for _ in range(warmup):
+        await call()
+    samples: List[float] = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < min_runs or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return _with_rate(summarize(samples), samples)
+
+def _with_rate(summary: Dict[str, Any], samples: List[float]) -> Dict[str, Any]:
+    total_ms = sum(samples)
+    summary["ops_per_sec"] = round(len(samples) / (total_ms / 1000), 1) if total_ms else None
+    return summary
+
+def bench_json_validate(min_time: float) -> Dict[str, Any]:
+    from agents.json_agent import JSONAgent
+
+    agent = JSONAgent()
+    rng = random.Random(1)
+    results = {}
+    for intent, items in (("Invoice", 5), ("Invoice", 200), ("Fraud Risk", 0), ("RFQ", 50)):
+        document = json.loads(make_json(intent, rng, items=items))
+        classification = {"file_type": "json", "business_intent": intent}
+        results[f"{intent.lower().replace(' ', '_')}_{items}_items"] = measure(
+            lambda: agent._validate_structure(document, classification), min_time
+        )
+    return results
+
+def bench_pdf_extract(min_time: float, scratch: str) -> Dict[str, Any]:
+    from agents.pdf_agent import _extract_text, _open_pdf
+
+    rng = random.Random(2)
+    results = {}
+    for pages in (1, 10, 50):
+        path = os.path.join(scratch, f"bench_{pages}.pdf")
+        with open(path, "wb") as f:
+            f.write(make_pdf_document("Invoice", rng, pages=pages))
+
+        def extract():
+            with _open_pdf(path) as reader:
+                return _extract_text(reader)
+
+        results[f"{pages}_pages"] = measure(extract, min_time, min_runs=5)
+    return results
+
+async def bench_route_actions(min_time: float) -> Dict[str, Any]:
+    from services.action_router import ActionRouter
+
+    router = ActionRouter()
+
+    async def no_webhook(url: str, payload: Dict[str, Any]) -> int:
+        return 200
+
+    # Measures rule evaluation and the breaker/retry wrapper, not the network
+    router._post_webhook = no_webhook
+    cases = {
+        "email_escalation": (
+            {"file_type": "email", "business_intent": "Complaint", "confidence": 0.9},
+            {"extracted_data": {"urgency": "urgent", "tone": "angry", "sentiment": "negative"},
+             "metadata": {"needs_crm_escalation": True}, "flags": ["URGENT_RESPONSE_REQUIRED"]}
+        ),
+        "json_high_value": (
+            {"file_type": "json", "business_intent": "Fraud Risk", "confidence": 0.9},
+            {"extracted_data": {"monetary_value": "25,000.00"}, "metadata": {"validation_result": {"is_valid": True}},
+             "flags": ["HIGH_VALUE_TRANSACTION", "FRAUD_RISK"]}
+        ),
+        "pdf_no_action": (
+            {"file_type": "pdf", "business_intent": "RFQ", "confidence": 0.9},
+            {"extracted_data": {"total_amount": 120.0, "compliance_mentions": []}, "flags": []}
+        ),
+    }
+    results = {}
+    for name, (classification, agent_result) in cases.items():
+        results[name] = await measure_async(
+            lambda: router.route_actions(classification, agent_result, 1), min_time
+        )
+    return results
+
+async def _seed(store, rows: int):
+    rng = random.Random(3)
+    intents = ("RFQ", "Complaint", "Invoice", "Regulation", "Fraud Risk")
+    for index in range(rows):
+        await store.store_processing_result(
+            filename=f"seed_{index}.eml",
+            file_type=rng.choice(("email", "json", "pdf")),
+            business_intent=rng.choice(intents),
+            status=rng.choice(("completed", "completed", "completed", "failed")),
+            metadata={"flags": rng.sample(["URGENT", "HIGH_VALUE", "GDPR", "FRAUD_RISK"], k=rng.randint(0, 2))},
+            extracted_data={"amount": round(rng.uniform(1, 50000), 2)},
+            actions_taken=rng.sample(["crm_escalation", "risk_alert"], k=rng.randint(0, 1))
+        )
+
+async def bench_memory_store(min_time: float, rows: int) -> Dict[str, Any]:
+    from database import init_db
+    from services.memory_store import MemoryStore
+
+    init_db()
+    store = MemoryStore()
+    seeding_started = time.perf_counter()
+    await _seed(store, rows)
+    seed_ms = (time.perf_counter() - seeding_started) * 1000
+
+    processing_id = rows // 2
+    return {
+        "rows": rows,
+        "store_processing_result_ms_per_row": round(seed_ms / rows, 3) if rows else None,
+        "get_result": await measure_async(lambda: store.get_result(processing_id), min_time),
+        "get_all_results_100": await measure_async(lambda: store.get_all_results(limit=100), min_time),
+        "get_all_results_by_status": await measure_async(
+            lambda: store.get_all_results(limit=100, status="failed"), min_time
+        ),
+        "get_results_by_file_type": await measure_async(lambda: store.get_results_by_file_type("pdf"), min_time),
+        "get_results_by_business_intent": await measure_async(
+            lambda: store.get_results_by_business_intent("Invoice"), min_time
+        ),
+        "get_flagged_results": await measure_async(lambda: store.get_flagged_results("gdpr"), min_time),
+        "get_statistics": await measure_async(store.get_statistics, min_time, min_runs=5),
+        "update_processing_result": await measure_async(
+            lambda: store.update_processing_result(processing_id, metadata={"benchmark": True}), min_time
+        )
+    }
+
+CASES = ("json_validate", "pdf_extract", "route_actions", "memory_store")
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for agent, routing and storage hot paths")
+    parser.add_argument("--only", help=f"Comma-separated subset of: {', '.join(CASES)}")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds to spend per measurement")
+    parser.add_argument("--rows", type=int, default=2000, help="Rows seeded for the MemoryStore benchmarks")
+    parser.add_argument("--database-url", help="Benchmark database (it gets seeded rows); default a temporary SQLite file")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args()
+
+    selected = args.only.split(",") if args.only else list(CASES)
+    unknown = set(selected) - set(CASES)
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown))}")
+
+    # Per-call info logs would dominate the measurements
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # Must be set before database.py is imported
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(scratch, 'micro_benchmark.db')}"
+        if PROJECT_ROOT not in sys.path:
+            sys.path.insert(0, PROJECT_ROOT)
+
+        report = run_info("micro", {"cases": selected, "min_time": args.min_time, "rows": args.rows,
+                                    "database": os.environ["DATABASE_URL"].split(":", 1)[0]})
+        results: Dict[str, Optional[Dict[str, Any]]] = {}
+        if "json_validate" in selected:
+            results["json_validate"] = bench_json_validate(args.min_time)
+        if "pdf_extract" in selected:
+            results["pdf_extract"] = bench_pdf_extract(args.min_time, scratch)
+        if "route_actions" in selected:
+            results["route_actions"] = asyncio.run(bench_route_actions(args.min_time))
+        if "memory_store" in selected:
+            results["memory_store"] = asyncio.run(bench_memory_store(args.min_time, args.rows))
+        report["results"] = results
+
+    emit(report, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, JSON
+from sqlalchemy import create_engine, inspect, text, BigInteger, Column, Integer, String, Text, DateTime, JSON, Float, LargeBinary
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+from typing import List, Tuple
+import logging
 import os
+from utils.metrics import CallbackMetric
+
+logger = logging.getLogger(__name__)
 
 # Database configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./business_processor.db")
@@ -10,6 +16,16 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./business_processor.db")
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _pool_usage():
+    """Connection pool usage for pools that report it (QueuePool); others export nothing"""
+    pool = engine.pool
+    for state, method in (("size", "size"), ("checked_out", "checkedout"), ("checked_in", "checkedin"), ("overflow", "overflow")):
+        if hasattr(pool, method):
+            # QueuePool reports overflow as negative until the base pool has been filled
+            yield (state,), max(0, getattr(pool, method)())
+
+CallbackMetric("db_pool_connections", "Database connection pool usage by state", ("state",), _pool_usage)
+
 Base = declarative_base()
 
 class ProcessingResult(Base):
@@ -23,12 +39,321 @@ class ProcessingResult(Base):
     extracted_data = Column(JSON, nullable=True)
     processing_metadata = Column(JSON, nullable=True)
     actions_taken = Column(JSON, nullable=True)
+    # Compressed replacements for the two JSON columns (see services/storage_codec.py)
+    extracted_data_blob = Column(LargeBinary, nullable=True)
+    metadata_blob = Column(LargeBinary, nullable=True)
+    # Original upload in the document store (see services/document_store.py)
+    document_sha256 = Column(String(64), nullable=True, index=True)
+    # Worker running the pipeline for an unfinished result, until the lease expires (epoch seconds)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(Float, nullable=True)
+    # MinHash signature of the normalized text and the result whose near-duplicate cluster it
+    # belongs to (see services/near_duplicates.py); the first result of a cluster points at itself
+    minhash = Column(LargeBinary, nullable=True)
+    duplicate_cluster_id = Column(Integer, nullable=True, index=True)
+    # int8 hashed n-gram embedding for similarity search (see services/similarity.py)
+    embedding = Column(LargeBinary, nullable=True)
+    # Email conversation the message belongs to (see services/conversations.py)
+    conversation_id = Column(Integer, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class StoredDocument(Base):
+    """An original document in the content-addressed store and how many results reference it"""
+    __tablename__ = "stored_documents"
+    
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    stored_size = Column(Integer, nullable=False)
+    encoding = Column(String, nullable=False)  # zstd, gzip or raw
+    refcount = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_referenced_at = Column(DateTime, default=datetime.utcnow)
+
+class ReprocessingJob(Base):
+    """Progress of a bulk reprocessing run, so an interrupted run can resume"""
+    __tablename__ = "reprocessing_jobs"
+    
+    id = Column(String, primary_key=True)
+    params = Column(JSON, nullable=False)
+    status = Column(String, nullable=False, default="running")  # running, completed, interrupted, failed
+    checkpoint_id = Column(Integer, nullable=False, default=0)  # every matching result up to here is done
+    processed = Column(Integer, nullable=False, default=0)
+    changed = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ClusterAction(Base):
+    """An action taken once on behalf of a whole near-duplicate cluster"""
+    __tablename__ = "cluster_actions"
+    
+    cluster_id = Column(Integer, primary_key=True)
+    action = Column(String, primary_key=True)
+    processing_id = Column(Integer, nullable=False)  # the result that triggered it
     created_at = Column(DateTime, default=datetime.utcnow)
+
+class Conversation(Base):
+    """An email thread and its running tone/urgency, updated once per new message"""
+    __tablename__ = "conversations"
+    
+    id = Column(Integer, primary_key=True)
+    subject_key = Column(String, nullable=False, index=True)  # normalized subject, without Re:/Fwd: prefixes
+    participants = Column(JSON, nullable=True)
+    message_count = Column(Integer, nullable=False, default=0)
+    urgency = Column(String, nullable=True)
+    tone = Column(String, nullable=True)
+    sentiment = Column(String, nullable=True)
+    key_concerns = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ConversationMessage(Base):
+    """A Message-ID seen in a conversation, either received or only referenced by a reply"""
+    __tablename__ = "conversation_messages"
+    
+    message_id = Column(String, primary_key=True)
+    conversation_id = Column(Integer, nullable=False, index=True)
+    processing_id = Column(Integer, nullable=True)  # None until the message itself is received
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ConversationAction(Base):
+    """An action taken once on behalf of a whole email conversation"""
+    __tablename__ = "conversation_actions"
+    
+    conversation_id = Column(Integer, primary_key=True)
+    action = Column(String, primary_key=True)
+    processing_id = Column(Integer, nullable=False)  # the result that triggered it
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class IngestionCheckpoint(Base):
+    """How far an ingestion source (e.g. an mbox archive) has been read and fully processed"""
+    __tablename__ = "ingestion_checkpoints"
+    
+    source = Column(String, primary_key=True)
+    read_offset = Column(BigInteger, nullable=False, default=0)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class IngestedItem(Base):
+    """A message or file an ingestion source has already fed through the pipeline"""
+    __tablename__ = "ingested_items"
+    
+    source = Column(String, primary_key=True)
+    item_key = Column(String, primary_key=True)
+    processing_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(Base):
+    """An upload request's idempotency key: claimed while it runs, then its stored response"""
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)  # sha256 of the file name and content
+    owner = Column(String, nullable=True)  # claim token of the run in progress
+    expires_at = Column(Float, nullable=False, index=True)  # epoch seconds
+    processing_id = Column(Integer, nullable=True)
+    response = Column(JSON, nullable=True)  # None while in progress
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CodecDictionary(Base):
+    """A trained zstd dictionary shared by all workers for result blobs"""
+    __tablename__ = "codec_dictionaries"
+    
+    id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    sample_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CircuitBreakerState(Base):
+    """Last open/close transition of a circuit breaker, shared by all workers"""
+    __tablename__ = "circuit_breaker_states"
+    
+    service = Column(String, primary_key=True)
+    state = Column(String, nullable=False, default="closed")
+    opened_at = Column(Float, nullable=True)  # epoch seconds
+    changed_at = Column(Float, nullable=False, default=0.0)  # epoch seconds
+
+class RateLimitBucket(Base):
+    """Token bucket for a rate-limited service, shared by all workers"""
+    __tablename__ = "rate_limit_buckets"
+    
+    service = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    refilled_at = Column(Float, nullable=False)  # epoch seconds
+    version = Column(Integer, nullable=False, default=0)
+
+class Lease(Base):
+    """A named, expiring lease used for leader election"""
+    __tablename__ = "leases"
+    
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)  # epoch seconds
+
+# Arbitrary application-wide key for the schema advisory lock
+SCHEMA_LOCK_KEY = 727240901
+
+# Monthly partitions created ahead of time on Postgres
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+
+# On Postgres processing_results is range-partitioned by month so retention is a partition drop.
+# The primary key must include the partition key; ids stay unique through the shared sequence.
+PARTITIONED_RESULTS_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS processing_results (
+        id SERIAL,
+        filename VARCHAR(255) NOT NULL,
+        file_type VARCHAR(50) NOT NULL,
+        business_intent VARCHAR(100) NOT NULL,
+        status VARCHAR(50) NOT NULL DEFAULT 'pending',
+        extracted_data JSONB,
+        processing_metadata JSONB,
+        actions_taken JSONB,
+        extracted_data_blob BYTEA,
+        metadata_blob BYTEA,
+        document_sha256 VARCHAR(64),
+        lease_owner VARCHAR,
+        lease_expires_at DOUBLE PRECISION,
+        minhash BYTEA,
+        duplicate_cluster_id INTEGER,
+        embedding BYTEA,
+        conversation_id INTEGER,
+        created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+        updated_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'utc'),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    # Catches rows outside every monthly partition, e.g. if maintenance has not run for months
+    "CREATE TABLE IF NOT EXISTS processing_results_default PARTITION OF processing_results DEFAULT",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_id ON processing_results(id)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_status ON processing_results(status)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_file_type ON processing_results(file_type)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_business_intent ON processing_results(business_intent)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_created_at ON processing_results(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_document_sha256 ON processing_results(document_sha256)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_duplicate_cluster_id ON processing_results(duplicate_cluster_id)",
+    "CREATE INDEX IF NOT EXISTS idx_processing_results_conversation_id ON processing_results(conversation_id)",
+    # The blobs are compressed already; skip pglz and just move large ones out of line
+    "ALTER TABLE processing_results ALTER COLUMN extracted_data_blob SET STORAGE EXTERNAL",
+    "ALTER TABLE processing_results ALTER COLUMN metadata_blob SET STORAGE EXTERNAL",
+]
+
+PARTITION_PREFIX = "processing_results_p"
+
 def init_db():
-    """Initialize the database"""
-    Base.metadata.create_all(bind=engine)
+    """Initialize the database; safe to call from several workers at once"""
+    if engine.dialect.name == "postgresql":
+        # Serialize schema creation across workers and nodes
+        with engine.connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            try:
+                if not _table_exists(connection, "processing_results"):
+                    for statement in PARTITIONED_RESULTS_DDL:
+                        connection.execute(text(statement))
+                elif not is_partitioned(connection):
+                    logger.warning("processing_results is not partitioned; retention falls back to chunked deletes. "
+                                   "Run scripts/partition_results.py to migrate it")
+                # Creates the remaining tables; the partitioned one already exists
+                Base.metadata.create_all(bind=connection)
+                add_missing_columns(connection)
+                ensure_partitions(connection)
+                connection.commit()
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+                connection.commit()
+        return
+    
+    try:
+        Base.metadata.create_all(bind=engine)
+    except (OperationalError, ProgrammingError) as e:
+        # Another worker created a table between our existence check and CREATE
+        logger.info(f"Concurrent schema creation detected, retrying: {str(e)}")
+        Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        try:
+            add_missing_columns(connection)
+        except (OperationalError, ProgrammingError) as e:
+            # Another worker added the column first
+            logger.info(f"Concurrent column upgrade detected: {str(e)}")
+
+def add_missing_columns(connection, table_name: str = "processing_results"):
+    """Add columns the model gained since the table was created (nullable columns only)"""
+    existing = {col["name"] for col in inspect(connection).get_columns(table_name)}
+    for col in ProcessingResult.__table__.columns:
+        if col.name in existing:
+            continue
+        column_type = col.type.compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {col.name} {column_type}"))
+        if connection.dialect.name == "postgresql" and isinstance(col.type, LargeBinary):
+            connection.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {col.name} SET STORAGE EXTERNAL"))
+        if col.index:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table_name}_{col.name} ON {table_name} ({col.name})"))
+        logger.info(f"Added column {table_name}.{col.name}")
+
+def _table_exists(connection, name: str) -> bool:
+    return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+def is_partitioned(connection) -> bool:
+    """Whether processing_results is a partitioned table (Postgres only)"""
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'processing_results' AND c.relnamespace = 'public'::regnamespace"
+    )).scalar())
+
+def add_months(year: int, month: int, months: int) -> Tuple[int, int]:
+    """(year, month) shifted by a number of months"""
+    index = year * 12 + (month - 1) + months
+    return index // 12, index % 12 + 1
+
+def partition_name(year: int, month: int) -> str:
+    return f"{PARTITION_PREFIX}{year:04d}_{month:02d}"
+
+def create_partition(connection, year: int, month: int):
+    """Create the monthly partition holding [year-month-01, next month)"""
+    next_year, next_month = add_months(year, month, 1)
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(year, month)} PARTITION OF processing_results "
+        f"FOR VALUES FROM ('{year:04d}-{month:02d}-01') TO ('{next_year:04d}-{next_month:02d}-01')"
+    ))
+
+def ensure_partitions(connection, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Create this month's partition and the next few, so inserts never land in the default partition"""
+    if not is_partitioned(connection):
+        return
+    now = datetime.utcnow()
+    for offset in range(months_ahead + 1):
+        year, month = add_months(now.year, now.month, offset)
+        try:
+            with connection.begin_nested():
+                create_partition(connection, year, month)
+        except (OperationalError, ProgrammingError) as e:
+            # Rows for this month already sit in the default partition; they stay queryable there
+            logger.error(f"Could not create partition {partition_name(year, month)}: {str(e)}")
+
+def list_partitions(connection) -> List[Tuple[str, int, int]]:
+    """Monthly partitions of processing_results as (name, year, month), oldest first"""
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'processing_results' AND c.relname LIKE :prefix"
+    ), {"prefix": PARTITION_PREFIX + "%"}).scalars()
+    partitions = []
+    for name in rows:
+        try:
+            year, month = name[len(PARTITION_PREFIX):].split("_")
+            partitions.append((name, int(year), int(month)))
+        except ValueError:
+            continue
+    return sorted(partitions, key=lambda partition: (partition[1], partition[2]))
+
+def ping_db() -> bool:
+    """Check the database is reachable"""
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    return True
 
 def get_db():
     """Get database session"""
@@ -1,29 +1,93 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import os
-import tempfile
 import logging
-from typing import List
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
 import json
 from datetime import datetime
 
-from database import init_db
+from database import init_db, ping_db
 from models import ProcessingResult
 from agents.classifier import ClassifierAgent
-from agents.email_agent import EmailAgent
-from agents.json_agent import JSONAgent
-from agents.pdf_agent import PDFAgent
+from agents.registry import default_registry
 from services.action_router import ActionRouter
+from services.agent_dispatcher import AgentDispatcher
+from services.conversations import conversation_index
+from services.coordination import Coordinator
+from services.document_store import document_store
+from services.idempotency import IdempotencyConflictError, idempotency_store
 from services.memory_store import MemoryStore
-from utils.retry import retry_with_backoff
+from services.near_duplicates import near_duplicate_index
+from services.pipeline import DocumentPipeline, RecoverySweeper
+from services.scheduler import PriorityScheduler, estimate_priority
+from services.similarity import similarity_index
+from utils.deadline import DeadlineExceededError, deadline_scope
+from utils.metrics import CONTENT_TYPE, CallbackMetric, documents_processed, metrics_registry, uploads_in_flight
+from utils.profiling import ProfilingMiddleware, list_profiles, profile_path
+from utils.timing import StageTimer, latency_registry, record_stage, timed_stage, timing_scope
+from utils.upload_spool import SpooledUpload, UploadTooLargeError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Multi-Agent Business Document Processor", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Per-worker startup and shutdown; nothing stateful is built at import time"""
+    # Schema creation is serialized across workers and nodes
+    await asyncio.to_thread(init_db)
+    
+    # Components live on app.state, one set per worker process
+    app.state.memory_store = MemoryStore()
+    app.state.document_store = document_store
+    app.state.classifier_agent = ClassifierAgent()
+    app.state.agent_dispatcher = AgentDispatcher(default_registry())
+    app.state.action_router = ActionRouter()
+    app.state.pipeline_scheduler = PriorityScheduler()
+    app.state.near_duplicates = near_duplicate_index
+    # Loads existing clusters in the background; uploads before it finishes may start new ones
+    app.state.near_duplicates.schedule_refresh(force=True)
+    app.state.similarity = similarity_index
+    # Loads stored embeddings (and trains the IVF index once there are enough) in the background
+    app.state.similarity.schedule_refresh(force=True)
+    app.state.conversations = conversation_index
+    app.state.idempotency = idempotency_store
+    
+    # Shares breaker and rate limit state with other workers and runs leader-elected maintenance
+    app.state.coordinator = Coordinator(app.state.memory_store)
+    await app.state.coordinator.start()
+    
+    # Runs each upload with stage checkpoints under a lease held by this worker,
+    # and resumes uploads whose worker died mid-pipeline
+    app.state.pipeline = DocumentPipeline(
+        app.state.memory_store, app.state.classifier_agent, app.state.agent_dispatcher,
+        app.state.action_router, app.state.document_store, app.state.near_duplicates,
+        app.state.similarity, app.state.conversations, owner=app.state.coordinator.worker_id
+    )
+    app.state.recovery_sweeper = RecoverySweeper(app.state.pipeline, app.state.pipeline_scheduler)
+    await app.state.recovery_sweeper.start()
+    try:
+        yield
+    finally:
+        await app.state.recovery_sweeper.stop()
+        await app.state.coordinator.stop()
+        app.state.agent_dispatcher.shutdown()
+
+app = FastAPI(title="Multi-Agent Business Document Processor", version="1.0.0", lifespan=lifespan)
+
+def _pipeline_occupancy():
+    """Scheduler slots in use and uploads waiting for one"""
+    scheduler = getattr(app.state, "pipeline_scheduler", None)
+    if scheduler is not None:
+        stats = scheduler.stats()
+        yield ("active",), stats["active"]
+        yield ("queued",), stats["queued"]
+
+CallbackMetric("pipeline_uploads", "Uploads holding or waiting for a pipeline slot", ("state",), _pipeline_occupancy)
 
 # Add CORS middleware
 app.add_middleware(
@@ -34,19 +98,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in stack profiling of slow or explicitly requested uploads (X-Profile header, PROFILE_SAMPLE_RATE)
+app.add_middleware(ProfilingMiddleware)
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Initialize database
-init_db()
+# Per-upload processing deadline, kept below the nginx upload proxy timeout
+UPLOAD_DEADLINE_SECONDS = float(os.getenv("UPLOAD_DEADLINE_SECONDS", "50"))
+
+# Maximum accepted upload size
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
 
-# Initialize components
-memory_store = MemoryStore()
-classifier_agent = ClassifierAgent()
-email_agent = EmailAgent()
-json_agent = JSONAgent()
-pdf_agent = PDFAgent()
-action_router = ActionRouter()
+# Longest the readiness probe waits for the database
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
@@ -55,123 +120,219 @@ async def read_root():
         return HTMLResponse(content=f.read())
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request, file: UploadFile = File(...)):
     """Upload and process a file through the multi-agent system"""
-    try:
-        # Validate file size (10MB limit)
-        if file.size and file.size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
-        
-        # Read file content
-        content = await file.read()
+    # Everything awaited below shares one deadline, including LLM and webhook calls,
+    # and records its stage timings against this upload
+    with deadline_scope(UPLOAD_DEADLINE_SECONDS), timing_scope() as timer, timed_stage("total"):
+        uploads_in_flight.inc()
+        try:
+            # Validate file size (10MB limit)
+            if file.size and file.size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
         
-        # Save to temporary file for processing
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}") as temp_file:
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+            # Stream the upload in chunks, hashing and sniffing as it arrives;
+            # only large uploads spill to disk
+            upload = SpooledUpload(file.filename, max_size=MAX_UPLOAD_BYTES)
+            try:
+                with timed_stage("spool"):
+                    await upload.write_from(file)
+            except UploadTooLargeError as e:
+                upload.close()
+                raise HTTPException(status_code=400, detail=str(e))
         
-        try:
-            # Step 1: Classify the file
-            classification_result = await retry_with_backoff(
-                classifier_agent.classify,
-                temp_file_path,
-                file.filename,
-                content
-            )
-            
-            # Step 2: Store initial metadata
-            processing_id = await memory_store.store_processing_result(
-                filename=file.filename,
-                file_type=classification_result["file_type"],
-                business_intent=classification_result["business_intent"],
-                status="processing",
-                metadata=classification_result
-            )
-            
-            # Step 3: Route to specialized agent
-            agent_result = None
-            if classification_result["file_type"] == "email":
-                agent_result = await retry_with_backoff(
-                    email_agent.process,
-                    content.decode('utf-8', errors='ignore'),
-                    classification_result
+            state = request.app.state
+            try:
+                # An Idempotency-Key header, or else the file name and content within a short window
+                request_key = state.idempotency.request_key(
+                    request.headers.get("Idempotency-Key"), file.filename, upload.sha256
                 )
-            elif classification_result["file_type"] == "json":
-                agent_result = await retry_with_backoff(
-                    json_agent.process,
-                    content.decode('utf-8', errors='ignore'),
-                    classification_result
-                )
-            elif classification_result["file_type"] == "pdf":
-                agent_result = await retry_with_backoff(
-                    pdf_agent.process,
-                    temp_file_path,
-                    classification_result
-                )
-            
-            # Step 4: Update with agent results
-            if agent_result:
-                await memory_store.update_processing_result(
-                    processing_id,
-                    status="processed",
-                    extracted_data=agent_result["extracted_data"],
-                    metadata={**classification_result, **agent_result["metadata"]}
-                )
-            
-            # Step 5: Route actions
-            actions_taken = await action_router.route_actions(
-                classification_result,
-                agent_result if agent_result else {},
-                processing_id
-            )
-            
-            # Step 6: Final update with actions
-            await memory_store.update_processing_result(
-                processing_id,
-                status="completed",
-                actions_taken=actions_taken
+            except ValueError as e:
+                upload.close()
+                raise HTTPException(status_code=400, detail=str(e))
+
+            if request_key is None:
+                try:
+                    response = await process_upload(state, upload, file.filename, timer)
+                finally:
+                    # Release the spooled upload and its temp file
+                    upload.close()
+                return JSONResponse({"success": True, **response})
+
+            # Retries and concurrent copies of an upload share one pipeline run, which releases
+            # the spooled upload when done even if this request stops waiting first
+            key, fingerprint, ttl = request_key
+            response, replayed = await state.idempotency.run(
+                key, fingerprint, ttl, lambda: process_upload(state, upload, file.filename, timer),
+                release=upload.close
             )
+            if not replayed:
+                return JSONResponse({"success": True, **response})
+            classification = response.get("classification") or {}
+            timer.label(classification.get("file_type"), classification.get("business_intent"))
+            documents_processed.labels(timer.file_type, timer.business_intent, "replayed").inc()
+            return JSONResponse({"success": True, **response}, headers={"Idempotent-Replayed": "true"})
             
-            return JSONResponse({
-                "success": True,
-                "processing_id": processing_id,
-                "classification": classification_result,
-                "agent_result": agent_result,
-                "actions_taken": actions_taken
-            })
-            
+        except HTTPException:
+            documents_processed.labels(timer.file_type, timer.business_intent, "rejected").inc()
+            raise
+        except IdempotencyConflictError as e:
+            documents_processed.labels(timer.file_type, timer.business_intent, "rejected").inc()
+            raise HTTPException(status_code=422, detail=str(e))
+        except DeadlineExceededError:
+            logger.warning(f"Deadline exceeded while processing {file.filename}")
+            documents_processed.labels(timer.file_type, timer.business_intent, "timed_out").inc()
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        except Exception as e:
+            logger.error(f"Error processing file {file.filename}: {str(e)}")
+            documents_processed.labels(timer.file_type, timer.business_intent, "failed").inc()
+            raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
         finally:
-            # Clean up temporary file
-            os.unlink(temp_file_path)
-            
-    except Exception as e:
-        logger.error(f"Error processing file {file.filename}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+            uploads_in_flight.dec()
+
+async def process_upload(state, upload: SpooledUpload, filename: str, timer: StageTimer) -> Dict[str, Any]:
+    """Admit a spooled upload and run it through classification, its agent and action routing"""
+    # Cheap pre-score so likely escalations and high-value documents
+    # are admitted ahead of the backlog
+    priority, priority_reasons = estimate_priority(filename, upload.sniffed_type, upload.head)
+    async with state.pipeline_scheduler.slot(priority) as queue_wait:
+        record_stage("queue", queue_wait * 1000)
+        scheduling = {
+            "priority": priority,
+            "priority_reasons": priority_reasons,
+            "queue_wait_ms": round(queue_wait * 1000, 1)
+        }
+        response = await state.pipeline.run(upload, filename, scheduling, timer)
+    documents_processed.labels(timer.file_type, timer.business_intent, "completed").inc()
+    return response
 
 @app.get("/results")
-async def get_all_results():
+async def get_all_results(request: Request):
     """Get all processing results"""
     try:
-        results = await memory_store.get_all_results()
+        results = await request.app.state.memory_store.get_all_results()
         return JSONResponse({"success": True, "results": results})
     except Exception as e:
         logger.error(f"Error fetching results: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching results: {str(e)}")
 
 @app.get("/results/{processing_id}")
-async def get_result(processing_id: int):
+async def get_result(processing_id: int, request: Request):
     """Get a specific processing result"""
     try:
-        result = await memory_store.get_result(processing_id)
+        result = await request.app.state.memory_store.get_result(processing_id)
+        archived = False
+        if not result:
+            # Results past retention are still readable from the archive
+            result = await request.app.state.memory_store.get_archived_result(processing_id)
+            archived = result is not None
         if not result:
             raise HTTPException(status_code=404, detail="Result not found")
-        return JSONResponse({"success": True, "result": result})
+        return JSONResponse({"success": True, "result": result, "archived": archived})
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error fetching result {processing_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching result: {str(e)}")
 
+@app.get("/results/{processing_id}/document")
+async def get_result_document(processing_id: int, request: Request):
+    """Download the original document a result was produced from"""
+    memory_store = request.app.state.memory_store
+    result = await memory_store.get_result(processing_id) or await memory_store.get_archived_result(processing_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Result not found")
+    sha256 = result.get("document_sha256")
+    info = await asyncio.to_thread(request.app.state.document_store.get_info, sha256) if sha256 else None
+    if not info:
+        raise HTTPException(status_code=404, detail="Original document not stored")
+    filename = os.path.basename(result["filename"] or "document").replace('"', "")
+    return StreamingResponse(
+        request.app.state.document_store.iter_chunks(sha256),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Content-Length": str(info["size"]),
+                 "ETag": f'"{sha256}"'}
+    )
+
+@app.get("/results/{processing_id}/duplicates")
+async def get_result_duplicates(processing_id: int, request: Request, limit: int = 50):
+    """Get the near-duplicate cluster a result belongs to"""
+    memory_store = request.app.state.memory_store
+    result = await memory_store.get_result(processing_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Result not found")
+    cluster_id = result.get("duplicate_cluster_id")
+    members = await memory_store.get_cluster_results(cluster_id, limit) if cluster_id else []
+    return JSONResponse({
+        "success": True,
+        "cluster_id": cluster_id,
+        "results": [
+            {key: member[key] for key in ("id", "filename", "business_intent", "status", "actions_taken", "created_at")}
+            for member in members
+        ]
+    })
+
+@app.get("/conversations/{conversation_id}")
+async def get_conversation(conversation_id: int, request: Request, limit: int = 100):
+    """Get an email conversation's running tone/urgency and its messages"""
+    conversation = await request.app.state.conversations.get_conversation(conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    messages = await request.app.state.memory_store.get_conversation_results(conversation_id, limit)
+    return JSONResponse({
+        "success": True,
+        "conversation": conversation,
+        "messages": [
+            {
+                **{key: message[key] for key in ("id", "filename", "business_intent", "status", "actions_taken", "created_at")},
+                "sender": message["extracted_data"].get("sender"),
+                "urgency": message["extracted_data"].get("urgency"),
+                "tone": message["extracted_data"].get("tone")
+            }
+            for message in messages
+        ]
+    })
+
+@app.get("/results/{processing_id}/similar")
+async def get_similar_results(processing_id: int, request: Request, limit: int = 10):
+    """Get the processed documents most similar to a result"""
+    similarity = request.app.state.similarity
+    if not similarity.enabled:
+        raise HTTPException(status_code=503, detail="Similarity search is disabled")
+    limit = max(1, min(limit, 100))
+    embedding = await asyncio.to_thread(similarity.embedding_of, processing_id)
+    if embedding is None:
+        raise HTTPException(status_code=404, detail="Result not found or has no text to compare")
+
+    # Over-fetch: some neighbours may be deleted or near-duplicates of a better match
+    neighbours = similarity.search(embedding, limit * 3, exclude=processing_id)
+    results = await request.app.state.memory_store.get_results_by_ids(
+        [processing_id] + [neighbour_id for neighbour_id, _ in neighbours]
+    )
+    if processing_id not in results:
+        raise HTTPException(status_code=404, detail="Result not found")
+    similar = []
+    # The result's own near-duplicates are listed by /results/{id}/duplicates
+    seen_clusters = {results[processing_id].get("duplicate_cluster_id")} - {None}
+    for neighbour_id, score in neighbours:
+        result = results.get(neighbour_id)
+        if result is None:
+            continue
+        # A near-duplicate cluster is shown once, by its best match
+        cluster_id = result.get("duplicate_cluster_id")
+        if cluster_id is not None:
+            if cluster_id in seen_clusters:
+                continue
+            seen_clusters.add(cluster_id)
+        similar.append({
+            **{key: result[key] for key in ("id", "filename", "file_type", "business_intent", "status", "created_at")},
+            "duplicate_cluster_id": cluster_id,
+            "similarity": score
+        })
+        if len(similar) == limit:
+            break
+    return JSONResponse({"success": True, "processing_id": processing_id, "results": similar})
+
 # Mock webhook endpoints for testing actions
 @app.post("/webhooks/crm/escalate")
 async def crm_escalate_webhook(request: Request):
@@ -199,12 +360,13 @@ async def retry_action(request: Request):
             raise HTTPException(status_code=400, detail="Missing processing_id or action_type")
         
         # Get the processing result
+        memory_store = request.app.state.memory_store
         result = await memory_store.get_result(processing_id)
         if not result:
             raise HTTPException(status_code=404, detail="Processing result not found")
         
-        # Re-trigger the specific action
-        action_router = ActionRouter()
+        # Re-trigger the specific action through the worker's router and its webhook breaker
+        action_router = request.app.state.action_router
         
         # Build context for action retry
         context = {
@@ -236,10 +398,64 @@ async def retry_action(request: Request):
         logger.error(f"Error retrying action: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error retrying action: {str(e)}")
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition of this worker's counters, gauges and histograms"""
+    return Response(content=metrics_registry.expose(), media_type=CONTENT_TYPE)
+
+@app.get("/metrics/latency")
+async def latency_metrics(stage: Optional[str] = None, file_type: Optional[str] = None,
+                          business_intent: Optional[str] = None):
+    """p50/p95/p99 stage latencies for this worker, per stage and per file type and intent ("*" = all)"""
+    return JSONResponse({
+        "stages": latency_registry.snapshot(stage, file_type, business_intent),
+        "generated_at": datetime.utcnow().isoformat()
+    })
+
+@app.get("/debug/profiles")
+async def get_profiles(limit: int = 50):
+    """Saved request profiles, newest first"""
+    return JSONResponse({"profiles": await asyncio.to_thread(list_profiles, limit)})
+
+@app.get("/debug/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "speedscope"):
+    """A saved profile as speedscope JSON (open in speedscope.app) or collapsed stacks (flamegraph.pl)"""
+    if format not in ("speedscope", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be 'speedscope' or 'collapsed'")
+    path = profile_path(profile_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "application/json" if format == "speedscope" else "text/plain; charset=utf-8"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
 @app.get("/health")
-async def health_check():
-    """Health check endpoint"""
-    return JSONResponse({"status": "healthy", "timestamp": datetime.utcnow().isoformat()})
+async def health_check(request: Request):
+    """Liveness check: the worker is up and serving; no dependencies are touched"""
+    return JSONResponse({
+        "status": "healthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "pipeline": request.app.state.pipeline_scheduler.stats(),
+        "worker": {
+            "id": request.app.state.coordinator.worker_id,
+            "leader": request.app.state.coordinator.is_leader
+        }
+    })
+
+@app.get("/health/ready")
+async def readiness_check(request: Request):
+    """Readiness check: startup has finished and the database is reachable"""
+    checks = {"startup": hasattr(request.app.state, "coordinator")}
+    try:
+        checks["database"] = await asyncio.wait_for(asyncio.to_thread(ping_db), timeout=READINESS_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Readiness database check failed: {str(e)}")
+        checks["database"] = False
+    
+    ready = all(checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "not_ready", "checks": checks},
+        status_code=200 if ready else 503
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -14,6 +14,19 @@ class AgentResult(BaseModel):
     flags: List[str] = []
     confidence: float
 
+class EmailAnalysis(BaseModel):
+    urgency: str
+    tone: str
+    sentiment: str = "neutral"
+    confidence: float = 0.5
+    key_concerns: List[str] = []
+    contact_info: Any = ""
+
+class PDFAnalysis(BaseModel):
+    extracted_fields: Dict[str, Any] = {}
+    confidence: float = 0.5
+    summary: str = ""
+
 class ProcessingResult(BaseModel):
     id: Optional[int] = None
     filename: str
@@ -0,0 +1,118 @@
+"""Rewrite stored results into the compressed blob columns (see services/storage_codec.py).
+
+Usage:
+    DATABASE_URL=... python scripts/compress_results.py [--batch-size 500] [--train-dictionary]
+                                                        [--samples 5000] [--dictionary-size 65536] [--recompress]
+
+Rows still in the JSON columns are encoded in id order, one batch per transaction, so the
+application can keep running. --train-dictionary first trains a shared zstd dictionary on a
+sample of existing results; --recompress also rewrites rows that already have blobs (e.g. to
+move them onto a newly trained dictionary). updated_at is left as it was, except on tables
+with the updated_at trigger from scripts/init-db.sql. On Postgres the freed JSON space is
+reused after (auto)vacuum; run VACUUM FULL or pg_repack to return it to the filesystem.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import update
+from database import ProcessingResult, SessionLocal, init_db
+from services.storage_codec import storage_codec
+
+logger = logging.getLogger("compress_results")
+
+def _pending(query, recompress: bool):
+    if recompress:
+        return query
+    return query.filter(ProcessingResult.metadata_blob.is_(None))
+
+def _sample(samples: int):
+    """Decoded extracted_data and metadata values from a random spread of rows"""
+    db = SessionLocal()
+    try:
+        ids = [row_id for (row_id,) in db.query(ProcessingResult.id).all()]
+        chosen = random.sample(ids, min(samples, len(ids)))
+        values = []
+        for start in range(0, len(chosen), 500):
+            rows = db.query(ProcessingResult).filter(ProcessingResult.id.in_(chosen[start:start + 500])).all()
+            for row in rows:
+                extracted_data, metadata = storage_codec.unpack(row)
+                values.extend((extracted_data, metadata))
+        return values
+    finally:
+        db.close()
+
+def _stored_size(row) -> int:
+    """Bytes the row's data currently takes, as JSON text or blobs"""
+    if row.metadata_blob is not None or row.extracted_data_blob is not None:
+        return len(row.extracted_data_blob or b"") + len(row.metadata_blob or b"")
+    return len(json.dumps(row.extracted_data or {})) + len(json.dumps(row.processing_metadata or {}))
+
+def compress(batch_size: int, recompress: bool) -> int:
+    last_id = 0
+    rewritten = 0
+    before_bytes = after_bytes = 0
+    while True:
+        db = SessionLocal()
+        try:
+            # Step 1: Lock the next batch in id order (ids only ever grow, so new rows are never missed);
+            # the lock keeps a concurrent update from being overwritten with stale data
+            rows = _pending(db.query(ProcessingResult), recompress).filter(
+                ProcessingResult.id > last_id
+            ).order_by(ProcessingResult.id).limit(batch_size).with_for_update().all()
+            if not rows:
+                break
+
+            # Step 2: Re-encode through the same codec the application uses
+            changes = []
+            for row in rows:
+                extracted_data, metadata = storage_codec.unpack(row)
+                values = storage_codec.columns(row, extracted_data, metadata)
+                before_bytes += _stored_size(row)
+                after_bytes += len(values["extracted_data_blob"]) + len(values["metadata_blob"])
+                # Passing updated_at keeps the original timestamp instead of the model's onupdate
+                changes.append({"id": row.id, "updated_at": row.updated_at, **values})
+
+            # Step 3: One short transaction per batch
+            db.execute(update(ProcessingResult), changes)
+            db.commit()
+            last_id = rows[-1].id
+            rewritten += len(rows)
+            logger.info(f"Rewrote {rewritten} results (up to id {last_id})")
+        finally:
+            db.close()
+
+    if rewritten:
+        logger.info(f"Data columns: {before_bytes} bytes before, {after_bytes} after "
+                    f"({before_bytes / max(after_bytes, 1):.1f}x smaller)")
+    return rewritten
+
+def main():
+    parser = argparse.ArgumentParser(description="Move stored results into compressed blob columns")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows rewritten per transaction")
+    parser.add_argument("--train-dictionary", action="store_true", help="Train a shared zstd dictionary first")
+    parser.add_argument("--samples", type=int, default=5000, help="Rows sampled to train the dictionary")
+    parser.add_argument("--dictionary-size", type=int, default=64 * 1024, help="Dictionary size in bytes")
+    parser.add_argument("--recompress", action="store_true", help="Also rewrite rows that already have blobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not storage_codec.enabled:
+        raise SystemExit("STORAGE_CODEC=json: results are kept in the JSON columns")
+
+    # Adds the blob columns to tables created before them
+    init_db()
+    if args.train_dictionary:
+        values = _sample(args.samples)
+        if len(values) < 100:
+            raise SystemExit(f"Only {len(values)} sample values; store more results before training a dictionary")
+        storage_codec.train_dictionary(values, args.dictionary_size)
+    compress(max(1, args.batch_size), args.recompress)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Embed stored results for similarity search (see services/similarity.py).
+
+Usage:
+    DATABASE_URL=... python scripts/embed_results.py [--batch-size 200] [--reembed]
+
+Results processed before similarity search existed have no embedding. Their text is
+re-read from the stored original (services/document_store.py), in id order, one batch per
+transaction; results whose original is not stored are skipped. --reembed also rewrites
+results that already have one (e.g. after changing SIMILARITY_DIMENSIONS). Running workers
+pick the new embeddings up on their next refresh.
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import update
+from agents.pdf_agent import extract_pdf_content
+from database import ProcessingResult, SessionLocal, init_db
+from services.document_store import document_store
+from services.similarity import embed, quantize, similarity_index
+
+logger = logging.getLogger("embed_results")
+
+def _document_text(row) -> str:
+    """Text of a result's stored original, extracted the way its agent does"""
+    upload = document_store.to_upload(row.document_sha256, row.filename)
+    try:
+        if row.file_type == "pdf":
+            return extract_pdf_content(upload.ensure_on_disk()).get("text", "")
+        return upload.read_text()
+    finally:
+        upload.close()
+
+def embed_results(batch_size: int, reembed: bool) -> int:
+    last_id = 0
+    embedded = skipped = 0
+    while True:
+        db = SessionLocal()
+        try:
+            # Step 1: Next batch in id order; ids only ever grow, so new rows are never missed
+            query = db.query(
+                ProcessingResult.id, ProcessingResult.filename, ProcessingResult.file_type,
+                ProcessingResult.document_sha256
+            ).filter(ProcessingResult.id > last_id, ProcessingResult.document_sha256.isnot(None))
+            if not reembed:
+                query = query.filter(ProcessingResult.embedding.is_(None))
+            rows = query.order_by(ProcessingResult.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            # Step 2: Embed each original's text
+            changes = []
+            for row in rows:
+                try:
+                    vector = embed(_document_text(row))
+                except Exception as e:
+                    logger.warning(f"Skipping result {row.id}: {str(e)}")
+                    vector = None
+                if vector is None:
+                    skipped += 1
+                    continue
+                changes.append({"id": row.id, "embedding": quantize(vector)})
+
+            # Step 3: One short transaction per batch
+            if changes:
+                db.execute(update(ProcessingResult), changes)
+                db.commit()
+            last_id = rows[-1].id
+            embedded += len(changes)
+            logger.info(f"Embedded {embedded} results, skipped {skipped} (up to id {last_id})")
+        finally:
+            db.close()
+    return embedded
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed stored results for similarity search")
+    parser.add_argument("--batch-size", type=int, default=200, help="Results embedded per transaction")
+    parser.add_argument("--reembed", action="store_true", help="Also rewrite results that already have an embedding")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not similarity_index.enabled:
+        raise SystemExit("Similarity search is disabled (SIMILARITY_ENABLED=false, or numpy is not installed)")
+
+    # Adds the embedding column to tables created before it
+    init_db()
+    embed_results(max(1, args.batch_size), args.reembed)
+
+if __name__ == "__main__":
+    main()
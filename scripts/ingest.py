@@ -0,0 +1,85 @@
+"""Ingest mail archives and dropped files straight into the pipeline, without going through /upload.
+
+Usage:
+    python scripts/ingest.py [--mbox PATH ...] [--maildir PATH ...] [--watch DIR ...] [--concurrency 4]
+
+mbox archives and Maildirs are read once, a message at a time, and the script exits when they
+are done; watch folders are followed until interrupted. Each message or file is streamed into
+the pipeline with at most --concurrency in flight per source, so memory stays flat however
+large an archive is. Progress is saved in the database (see services/ingestion.py): a rerun
+skips everything already processed, and an interrupted mbox resumes from its saved offset.
+Results left unfinished by an interrupted run are resumed by the application's recovery sweeper.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import init_db
+from services.ingestion import INGEST_CONCURRENCY, IngestionRunner, MaildirSource, MboxSource, WatchFolderSource
+
+logger = logging.getLogger("ingest")
+
+def build_pipeline():
+    """The same pipeline components an application worker runs"""
+    from agents.classifier import ClassifierAgent
+    from agents.registry import default_registry
+    from services.action_router import ActionRouter
+    from services.agent_dispatcher import AgentDispatcher
+    from services.conversations import conversation_index
+    from services.coordination import worker_id
+    from services.document_store import document_store
+    from services.memory_store import MemoryStore
+    from services.near_duplicates import near_duplicate_index
+    from services.pipeline import DocumentPipeline
+    from services.similarity import similarity_index
+
+    dispatcher = AgentDispatcher(default_registry())
+    pipeline = DocumentPipeline(
+        MemoryStore(), ClassifierAgent(), dispatcher, ActionRouter(), document_store,
+        near_duplicate_index, similarity_index, conversation_index, owner=f"ingest-{worker_id()}"
+    )
+    return pipeline, dispatcher
+
+async def ingest(sources, concurrency: int):
+    pipeline, dispatcher = build_pipeline()
+    pipeline.near_duplicates.schedule_refresh(force=True)
+    pipeline.similarity.schedule_refresh(force=True)
+    try:
+        runner = IngestionRunner(pipeline, concurrency)
+        outcomes = await asyncio.gather(*(runner.run(source) for source in sources))
+        return {source.name: outcome for source, outcome in zip(sources, outcomes)}
+    finally:
+        dispatcher.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest mbox archives, Maildirs and watch folders")
+    parser.add_argument("--mbox", action="append", default=[], help="mbox archive to ingest")
+    parser.add_argument("--maildir", action="append", default=[], help="Maildir to ingest")
+    parser.add_argument("--watch", action="append", default=[], help="Folder to watch for dropped files")
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY, help="Documents in flight per source")
+    args = parser.parse_args()
+
+    sources = ([MboxSource(path) for path in args.mbox] + [MaildirSource(path) for path in args.maildir] +
+               [WatchFolderSource(path) for path in args.watch])
+    if not sources:
+        parser.error("give at least one --mbox, --maildir or --watch")
+    for source in sources:
+        if not os.path.exists(source.path):
+            parser.error(f"{source.path} does not exist")
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    try:
+        summary = asyncio.run(ingest(sources, max(1, args.concurrency)))
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; run the same command again to continue")
+        sys.exit(130)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
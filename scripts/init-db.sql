@@ -1,9 +1,10 @@
 -- Initialize the database for the document processor
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
--- Create the processing_results table if it doesn't exist
+-- Create the processing_results table if it doesn't exist, range-partitioned by month
+-- so retention drops whole partitions (the application creates upcoming months)
 CREATE TABLE IF NOT EXISTS processing_results (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     filename VARCHAR(255) NOT NULL,
     file_type VARCHAR(50) NOT NULL,
     business_intent VARCHAR(100) NOT NULL,
@@ -11,15 +12,35 @@ CREATE TABLE IF NOT EXISTS processing_results (
     extracted_data JSONB,
     processing_metadata JSONB,
     actions_taken JSONB,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-);
+    extracted_data_blob BYTEA,
+    metadata_blob BYTEA,
+    document_sha256 VARCHAR(64),
+    lease_owner VARCHAR,
+    lease_expires_at DOUBLE PRECISION,
+    minhash BYTEA,
+    duplicate_cluster_id INTEGER,
+    embedding BYTEA,
+    conversation_id INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+    updated_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'utc'),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS processing_results_default PARTITION OF processing_results DEFAULT;
 
 -- Create indexes for better performance
+CREATE INDEX IF NOT EXISTS idx_processing_results_id ON processing_results(id);
 CREATE INDEX IF NOT EXISTS idx_processing_results_status ON processing_results(status);
 CREATE INDEX IF NOT EXISTS idx_processing_results_file_type ON processing_results(file_type);
 CREATE INDEX IF NOT EXISTS idx_processing_results_business_intent ON processing_results(business_intent);
 CREATE INDEX IF NOT EXISTS idx_processing_results_created_at ON processing_results(created_at);
+CREATE INDEX IF NOT EXISTS idx_processing_results_document_sha256 ON processing_results(document_sha256);
+CREATE INDEX IF NOT EXISTS idx_processing_results_duplicate_cluster_id ON processing_results(duplicate_cluster_id);
+CREATE INDEX IF NOT EXISTS idx_processing_results_conversation_id ON processing_results(conversation_id);
+
+-- Result blobs are compressed by the application; store them out of line without pglz
+ALTER TABLE processing_results ALTER COLUMN extracted_data_blob SET STORAGE EXTERNAL;
+ALTER TABLE processing_results ALTER COLUMN metadata_blob SET STORAGE EXTERNAL;
 
 -- Create trigger to update the updated_at column
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -33,4 +54,123 @@ $$ language 'plpgsql';
 CREATE TRIGGER update_processing_results_updated_at
     BEFORE UPDATE ON processing_results
     FOR EACH ROW
-    EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- Shared state for multi-worker deployments
+CREATE TABLE IF NOT EXISTS stored_documents (
+    sha256 VARCHAR(64) PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    encoding VARCHAR NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT NOW(),
+    last_referenced_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS reprocessing_jobs (
+    id VARCHAR PRIMARY KEY,
+    params JSONB NOT NULL,
+    status VARCHAR NOT NULL DEFAULT 'running',
+    checkpoint_id INTEGER NOT NULL DEFAULT 0,
+    processed INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS codec_dictionaries (
+    id SERIAL PRIMARY KEY,
+    data BYTEA NOT NULL,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS circuit_breaker_states (
+    service VARCHAR PRIMARY KEY,
+    state VARCHAR NOT NULL DEFAULT 'closed',
+    opened_at DOUBLE PRECISION,
+    changed_at DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    service VARCHAR PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    refilled_at DOUBLE PRECISION NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name VARCHAR PRIMARY KEY,
+    holder VARCHAR NOT NULL,
+    expires_at DOUBLE PRECISION NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cluster_actions (
+    cluster_id INTEGER NOT NULL,
+    action VARCHAR NOT NULL,
+    processing_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (cluster_id, action)
+);
+
+-- Email threads (see services/conversations.py)
+CREATE TABLE IF NOT EXISTS conversations (
+    id SERIAL PRIMARY KEY,
+    subject_key VARCHAR NOT NULL,
+    participants JSONB,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    urgency VARCHAR,
+    tone VARCHAR,
+    sentiment VARCHAR,
+    key_concerns JSONB,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_subject_key ON conversations(subject_key);
+
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    message_id VARCHAR PRIMARY KEY,
+    conversation_id INTEGER NOT NULL,
+    processing_id INTEGER,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversation_messages_conversation_id ON conversation_messages(conversation_id);
+
+CREATE TABLE IF NOT EXISTS conversation_actions (
+    conversation_id INTEGER NOT NULL,
+    action VARCHAR NOT NULL,
+    processing_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (conversation_id, action)
+);
+
+-- Progress of the ingestion connectors (see services/ingestion.py)
+CREATE TABLE IF NOT EXISTS ingestion_checkpoints (
+    source VARCHAR PRIMARY KEY,
+    read_offset BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS ingested_items (
+    source VARCHAR NOT NULL,
+    item_key VARCHAR NOT NULL,
+    processing_id INTEGER,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (source, item_key)
+);
+
+-- Idempotency keys of /upload requests and their stored responses (see services/idempotency.py)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR PRIMARY KEY,
+    fingerprint VARCHAR(64) NOT NULL,
+    owner VARCHAR,
+    expires_at DOUBLE PRECISION NOT NULL,
+    processing_id INTEGER,
+    response JSON,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
@@ -0,0 +1,115 @@
+"""Convert an existing (unpartitioned) Postgres processing_results table to monthly range partitions.
+
+Usage:
+    DATABASE_URL=postgresql://... python scripts/partition_results.py [--batch-months 1] [--drop-legacy]
+
+Stop the application first: the old table is renamed to processing_results_legacy, a partitioned
+processing_results is created with partitions covering all existing rows, and the rows are copied
+one month per transaction. The legacy table is kept unless --drop-legacy is given.
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from database import (
+    PARTITIONED_RESULTS_DDL, SCHEMA_LOCK_KEY, add_missing_columns, add_months, create_partition, engine, ensure_partitions, is_partitioned
+)
+
+logger = logging.getLogger("partition_results")
+
+COLUMNS = ("id, filename, file_type, business_intent, status, extracted_data, processing_metadata, "
+           "actions_taken, extracted_data_blob, metadata_blob, document_sha256, lease_owner, lease_expires_at, "
+           "minhash, duplicate_cluster_id, embedding, conversation_id, created_at, updated_at")
+
+def _rename_legacy(connection):
+    """Move the old table, its indexes and its id sequence out of the way of the new names"""
+    connection.execute(text("ALTER TABLE processing_results RENAME TO processing_results_legacy"))
+    indexes = connection.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'processing_results_legacy'"
+    )).scalars().all()
+    for index in indexes:
+        connection.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_legacy"'))
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence('processing_results_legacy', 'id')")).scalar()
+    if sequence:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO processing_results_legacy_id_seq"))
+
+def migrate(batch_months: int, drop_legacy: bool):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            if is_partitioned(connection):
+                logger.info("processing_results is already partitioned")
+                return
+
+            # Step 1: Swap in an empty partitioned table
+            with connection.begin_nested():
+                # Tables from before the blob columns get them, so both sides have the same columns
+                add_missing_columns(connection)
+                _rename_legacy(connection)
+                for statement in PARTITIONED_RESULTS_DDL:
+                    connection.execute(text(statement))
+            connection.commit()
+
+            # Step 2: Partitions for every month that has rows, plus the months ahead
+            first, last = connection.execute(text(
+                "SELECT min(created_at), max(created_at) FROM processing_results_legacy"
+            )).one()
+            ensure_partitions(connection)
+            connection.commit()
+            if first is None:
+                logger.info("Legacy table is empty")
+            else:
+                year, month = first.year, first.month
+                while (year, month) <= (last.year, last.month):
+                    for offset in range(batch_months):
+                        create_partition(connection, *add_months(year, month, offset))
+                    next_year, next_month = add_months(year, month, batch_months)
+
+                    # Step 3: Copy one batch of months per transaction
+                    connection.execute(text(
+                        f"INSERT INTO processing_results ({COLUMNS}) SELECT {COLUMNS} FROM processing_results_legacy "
+                        f"WHERE created_at >= :start AND created_at < :end"
+                    ), {"start": f"{year:04d}-{month:02d}-01", "end": f"{next_year:04d}-{next_month:02d}-01"})
+                    connection.commit()
+                    logger.info(f"Copied results from {year:04d}-{month:02d}")
+                    year, month = next_year, next_month
+
+                # Rows without a timestamp cannot be partitioned; they go in at migration time
+                connection.execute(text(
+                    f"INSERT INTO processing_results ({COLUMNS}) SELECT id, filename, file_type, business_intent, status, "
+                    f"extracted_data, processing_metadata, actions_taken, extracted_data_blob, metadata_blob, document_sha256, "
+                    f"lease_owner, lease_expires_at, minhash, duplicate_cluster_id, embedding, conversation_id, NOW() AT TIME ZONE 'utc', updated_at "
+                    f"FROM processing_results_legacy WHERE created_at IS NULL"
+                ))
+                connection.commit()
+
+            # Step 4: New ids continue after the copied ones
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('processing_results', 'id'), "
+                "GREATEST((SELECT max(id) FROM processing_results), 1))"
+            ))
+            if drop_legacy:
+                connection.execute(text("DROP TABLE processing_results_legacy"))
+            connection.commit()
+            logger.info("processing_results is now partitioned by month")
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            connection.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition processing_results by month (Postgres)")
+    parser.add_argument("--batch-months", type=int, default=1, help="Months copied per transaction")
+    parser.add_argument("--drop-legacy", action="store_true", help="Drop processing_results_legacy afterwards")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if engine.dialect.name != "postgresql":
+        raise SystemExit("Partitioning is only used on Postgres; other databases use chunked retention deletes")
+    migrate(max(1, args.batch_months), args.drop_legacy)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Re-run stored results through the pipeline after a prompt, model or routing rule change.
+
+Usage:
+    python scripts/reprocess.py --stage routing|agent|classify [--file-type pdf] [--business-intent Invoice]
+        [--status completed] [--since 2026-01-01] [--until 2026-02-01] [--ids 1,2,3]
+        [--workers 4] [--concurrency 8] [--chunk-size 50] [--gemini-rpm 30]
+        [--dry-run] [--execute-actions] [--allow-fallback]
+    python scripts/reprocess.py --resume JOB_ID
+    python scripts/reprocess.py --list
+
+--stage picks the first stage re-run: "classify" re-runs everything from the stored original,
+"agent" keeps the stored classification and "routing" only re-evaluates the action rules.
+Webhooks are not fired unless --execute-actions is given, and then only for actions a result
+has not had yet. Results whose re-run fell back to rule-based analysis are left untouched
+unless --allow-fallback is given. The diff report lands in REPROCESS_REPORT_DIR (./reports).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import init_db
+from services.reprocessing import (
+    REPROCESS_CHUNK_SIZE, REPROCESS_CONCURRENCY, REPROCESS_GEMINI_RPM, STAGES, ReprocessingRun, list_jobs
+)
+
+logger = logging.getLogger("reprocess")
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk reprocessing of stored results")
+    parser.add_argument("--stage", choices=STAGES, help="First stage to re-run")
+    parser.add_argument("--file-type", help="Only results of this file type")
+    parser.add_argument("--business-intent", help="Only results with this business intent")
+    parser.add_argument("--status", help="Only results with this status")
+    parser.add_argument("--since", help="Only results created at or after this ISO date")
+    parser.add_argument("--until", help="Only results created before this ISO date")
+    parser.add_argument("--ids", help="Comma-separated result ids")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="Worker processes")
+    parser.add_argument("--concurrency", type=int, default=REPROCESS_CONCURRENCY, help="Results in flight per worker")
+    parser.add_argument("--chunk-size", type=int, default=REPROCESS_CHUNK_SIZE, help="Results per worker task")
+    parser.add_argument("--gemini-rpm", type=float, default=REPROCESS_GEMINI_RPM,
+                        help="Gemini requests per minute for the whole run")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    parser.add_argument("--execute-actions", action="store_true", help="Fire webhooks for newly triggered actions")
+    parser.add_argument("--allow-fallback", action="store_true", help="Accept rule-based fallback output")
+    parser.add_argument("--resume", metavar="JOB_ID", help="Continue an interrupted job")
+    parser.add_argument("--list", action="store_true", help="List recent jobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    if args.list:
+        print(json.dumps(list_jobs(), indent=2))
+        return
+
+    options = {"workers": max(1, args.workers), "concurrency": max(1, args.concurrency),
+               "chunk_size": max(1, args.chunk_size), "gemini_rpm": args.gemini_rpm}
+    if args.resume:
+        run = ReprocessingRun.resume(args.resume, **options)
+    else:
+        if not args.stage:
+            parser.error("--stage is required unless resuming")
+        params = {
+            "stage": args.stage,
+            "file_type": args.file_type,
+            "business_intent": args.business_intent,
+            "status": args.status,
+            "since": args.since,
+            "until": args.until,
+            "ids": [int(value) for value in args.ids.split(",")] if args.ids else None,
+            "dry_run": args.dry_run,
+            "execute_actions": args.execute_actions,
+            "allow_fallback": args.allow_fallback
+        }
+        run = ReprocessingRun(params, **options)
+
+    try:
+        summary = run.run()
+    except KeyboardInterrupt:
+        logger.warning(f"Interrupted; continue with: python scripts/reprocess.py --resume {run.job_id}")
+        sys.exit(130)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
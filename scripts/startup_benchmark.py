@@ -0,0 +1,167 @@
+"""Measure cold start: import time of main, time until the server is live and ready, and first-request latency.
+
+Usage:
+    python scripts/startup_benchmark.py [--runs 5] [--port 8765] [--sample "assests/sample email.txt"]
+
+Prints a JSON report. Uses a throwaway SQLite database unless DATABASE_URL is set.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+from typing import Any, Dict, List, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _timed_run(args: List[str], env: Dict[str, str]) -> float:
+    """Run a fresh interpreter and return its wall time in seconds"""
+    started = time.perf_counter()
+    result = subprocess.run(args, cwd=PROJECT_ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise SystemExit(f"{' '.join(args[1:])} failed:\n{result.stderr[-2000:]}")
+    return elapsed
+
+def _slowest_imports(env: Dict[str, str], top: int) -> List[Dict[str, Any]]:
+    """Top-level packages by cumulative import time, from python -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=PROJECT_ROOT, env=env, check=True, capture_output=True, text=True
+    )
+    packages: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        # A package's outermost import line carries its full cumulative time
+        package = name.split(".")[0]
+        packages[package] = max(packages.get(package, 0), int(cumulative))
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": package, "cumulative_ms": round(micros / 1000, 1)} for package, micros in ranked]
+
+def measure_import(runs: int, env: Dict[str, str], top: int) -> Dict[str, Any]:
+    """Wall time of `import main` in a fresh interpreter, net of interpreter startup"""
+    baseline = [_timed_run([sys.executable, "-c", "pass"], env) for _ in range(runs)]
+    imports = [_timed_run([sys.executable, "-c", "import main"], env) for _ in range(runs)]
+    baseline_ms = statistics.median(baseline) * 1000
+    return {
+        "interpreter_ms": round(baseline_ms, 1),
+        "import_main_ms": round(statistics.median(imports) * 1000 - baseline_ms, 1),
+        "import_main_min_ms": round(min(imports) * 1000 - baseline_ms, 1),
+        "slowest_imports": _slowest_imports(env, top)
+    }
+
+def _get(url: str, timeout: float = 1.0) -> Optional[int]:
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
+
+def _wait_for(url: str, deadline: float, expected: int = 200) -> Optional[float]:
+    """Poll a URL until it returns the expected status; returns the time it did, or None"""
+    while time.perf_counter() < deadline:
+        if _get(url) == expected:
+            return time.perf_counter()
+        time.sleep(0.02)
+    return None
+
+def _upload(base_url: str, sample_path: str, timeout: float) -> Dict[str, Any]:
+    """POST a file to /upload as multipart/form-data and time it"""
+    boundary = uuid.uuid4().hex
+    with open(sample_path, "rb") as f:
+        content = f.read()
+    filename = os.path.basename(sample_path)
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(
+        f"{base_url}/upload",
+        data=body,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        method="POST"
+    )
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return {"status": status, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+def measure_server(port: int, sample_path: str, env: Dict[str, str], startup_timeout: float,
+                   request_timeout: float) -> Dict[str, Any]:
+    """Start uvicorn and time liveness, readiness and the first two uploads"""
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    try:
+        deadline = started + startup_timeout
+        live_at = _wait_for(f"{base_url}/health", deadline)
+        ready_at = _wait_for(f"{base_url}/health/ready", deadline) if live_at else None
+        if ready_at is None:
+            server.terminate()
+            _, stderr = server.communicate(timeout=10)
+            return {"error": "server did not become ready", "stderr_tail": stderr.decode(errors="ignore")[-2000:]}
+
+        report = {
+            "time_to_live_ms": round((live_at - started) * 1000, 1),
+            "time_to_ready_ms": round((ready_at - started) * 1000, 1)
+        }
+        if sample_path:
+            # The first upload pays for lazily loaded SDKs and agents; the second shows the warm path
+            report["first_upload"] = _upload(base_url, sample_path, request_timeout)
+            report["second_upload"] = _upload(base_url, sample_path, request_timeout)
+            report["time_to_first_response_ms"] = round(
+                report["time_to_ready_ms"] + report["first_upload"]["latency_ms"], 1
+            )
+        return report
+    finally:
+        if server.poll() is None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure application cold start")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh-interpreter import runs")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--sample", default=os.path.join(PROJECT_ROOT, "assests", "sample email.txt"),
+                        help="File uploaded as the first request; empty to skip")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imported packages to report")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--skip-server", action="store_true", help="Only measure import time")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("PYTHONPATH", PROJECT_ROOT)
+    with tempfile.TemporaryDirectory() as scratch:
+        env.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(scratch, 'startup_benchmark.db')}")
+
+        report = {"import": measure_import(args.runs, env, args.top)}
+        if not args.skip_server:
+            report["server"] = measure_server(args.port, args.sample, env, args.startup_timeout, args.request_timeout)
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import logging
-import httpx
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import json
 from datetime import datetime
+from services.conversations import CONVERSATION_COLLAPSED_ACTIONS, conversation_index
+from services.near_duplicates import CLUSTER_COLLAPSED_ACTIONS, near_duplicate_index
+from utils.deadline import with_deadline
+from utils.retry import CircuitBreakerOpenError, retry_with_circuit_breaker
+from utils.metrics import webhook_requests
+from utils.timing import timed_stage
 
 logger = logging.getLogger(__name__)
 
@@ -30,18 +35,39 @@ class ActionRouter:
             }
         }
 
-    async def route_actions(self, classification: Dict[str, Any], agent_result: Dict[str, Any], processing_id: int) -> List[str]:
-        """Route actions based on classification and agent results"""
+    async def route_actions(self, classification: Dict[str, Any], agent_result: Dict[str, Any], processing_id: int,
+                            completed_actions: Optional[List[str]] = None) -> List[str]:
+        """Route actions based on classification and agent results
+
+        Actions in completed_actions (e.g. from an interrupted earlier run) are not executed again,
+        and escalations are taken once per email conversation and near-duplicate cluster.
+        """
         actions_taken = []
         
         try:
             # Prepare decision context
             context = self._build_decision_context(classification, agent_result)
+            metadata = (agent_result or {}).get("metadata", {})
+            # Groups whose members share one escalation: (index, group id, collapsed actions, description)
+            groups = [
+                (conversation_index, metadata.get("conversation", {}).get("id"), CONVERSATION_COLLAPSED_ACTIONS, "conversation"),
+                (near_duplicate_index, metadata.get("near_duplicate", {}).get("cluster_id"), CLUSTER_COLLAPSED_ACTIONS,
+                 "near-duplicate cluster")
+            ]
             
             # Check each routing rule
             for action_name, rule in self.routing_rules.items():
                 if self._should_trigger_action(context, rule):
+                    if completed_actions and action_name in completed_actions:
+                        actions_taken.append(action_name)
+                        continue
+                    claimed = await self._claim_for_groups(groups, action_name, processing_id)
+                    if claimed is None:
+                        continue
                     success = await self._execute_action(action_name, rule, context, processing_id)
+                    if not success:
+                        for index, group_id in claimed:
+                            await index.release_action(group_id, action_name, processing_id)
                     if success:
                         actions_taken.append(action_name)
                         logger.info(f"Action executed: {action_name} for processing_id: {processing_id}")
@@ -58,6 +84,27 @@ class ActionRouter:
             logger.error(f"Error in action routing: {str(e)}")
             return ["routing_error"]
 
+    async def _claim_for_groups(self, groups: List[tuple], action_name: str, processing_id: int) -> Optional[List[tuple]]:
+        """Claim an action for every group the result belongs to; None (claims given back) if one already took it"""
+        claimed = []
+        for index, group_id, collapsed_actions, description in groups:
+            if group_id is None or action_name not in collapsed_actions:
+                continue
+            if not await index.claim_action(group_id, action_name, processing_id):
+                logger.info(f"Action {action_name} for processing_id: {processing_id} collapsed into "
+                            f"{description} {group_id}")
+                for claimed_index, claimed_id in claimed:
+                    await claimed_index.release_action(claimed_id, action_name, processing_id)
+                return None
+            claimed.append((index, group_id))
+        return claimed
+
+    def plan_actions(self, classification: Dict[str, Any], agent_result: Dict[str, Any]) -> List[str]:
+        """Actions the routing rules call for, without executing any"""
+        context = self._build_decision_context(classification, agent_result)
+        planned = [name for name, rule in self.routing_rules.items() if self._should_trigger_action(context, rule)]
+        return planned + self._check_additional_actions(context, None)
+
     def _build_decision_context(self, classification: Dict[str, Any], agent_result: Dict[str, Any]) -> Dict[str, Any]:
         """Build context for action routing decisions"""
         context = {
@@ -70,12 +117,13 @@ class ActionRouter:
         if agent_result and "extracted_data" in agent_result:
             extracted_data = agent_result["extracted_data"]
             
-            # Email-specific context
+            # Email-specific context, on the whole conversation's tone and urgency when it is threaded
             if classification.get("file_type") == "email":
+                analysis = {**extracted_data, **agent_result.get("metadata", {}).get("conversation", {})}
                 context.update({
-                    "urgency": extracted_data.get("urgency", "medium"),
-                    "tone": extracted_data.get("tone", "neutral"),
-                    "sentiment": extracted_data.get("sentiment", "neutral"),
+                    "urgency": analysis.get("urgency") or "medium",
+                    "tone": analysis.get("tone") or "neutral",
+                    "sentiment": analysis.get("sentiment") or "neutral",
                     "needs_crm_escalation": agent_result.get("metadata", {}).get("needs_crm_escalation", False)
                 })
             
@@ -134,42 +182,68 @@ class ActionRouter:
 
     async def _execute_action(self, action_name: str, rule: Dict[str, Any], context: Dict[str, Any], processing_id: int) -> bool:
         """Execute the specified action"""
-        try:
-            webhook_path = rule.get("webhook")
-            if not webhook_path:
-                logger.error(f"No webhook configured for action: {action_name}")
-                return False
+        # httpx is imported on first use to keep application startup fast
+        import httpx
+        
+        with timed_stage(f"action.{action_name}"):
+            try:
+                webhook_path = rule.get("webhook")
+                if not webhook_path:
+                    logger.error(f"No webhook configured for action: {action_name}")
+                    return False
             
-            # Prepare webhook payload
-            payload = {
-                "action": action_name,
-                "processing_id": processing_id,
-                "context": context,
-                "timestamp": datetime.utcnow().isoformat(),
-                "trigger_conditions": rule.get("conditions", [])
-            }
+                # Prepare webhook payload
+                payload = {
+                    "action": action_name,
+                    "processing_id": processing_id,
+                    "context": context,
+                    "timestamp": datetime.utcnow().isoformat(),
+                    "trigger_conditions": rule.get("conditions", [])
+                }
             
-            # Send webhook request
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
+                # Send webhook request through the shared webhook circuit breaker
+                status_code = await retry_with_circuit_breaker(
+                    self._post_webhook,
+                    "webhook",
                     f"{self.base_url}{webhook_path}",
-                    json=payload,
-                    timeout=10.0
+                    payload,
+                    max_retries=1,
+                    base_delay=0.5
                 )
-                
-                if response.status_code == 200:
-                    logger.info(f"Webhook successful for {action_name}: {response.status_code}")
-                    return True
-                else:
-                    logger.error(f"Webhook failed for {action_name}: {response.status_code}")
-                    return False
+            
+                logger.info(f"Webhook successful for {action_name}: {status_code}")
+                webhook_requests.labels(action_name, "success").inc()
+                return True
                     
-        except httpx.TimeoutException:
-            logger.error(f"Webhook timeout for action: {action_name}")
-            return False
-        except Exception as e:
-            logger.error(f"Error executing action {action_name}: {str(e)}")
-            return False
+            except CircuitBreakerOpenError:
+                logger.error(f"Webhook circuit open, skipping action: {action_name}")
+                webhook_requests.labels(action_name, "circuit_open").inc()
+                return False
+            except httpx.TimeoutException:
+                logger.error(f"Webhook timeout for action: {action_name}")
+                webhook_requests.labels(action_name, "timeout").inc()
+                return False
+            except Exception as e:
+                logger.error(f"Error executing action {action_name}: {str(e)}")
+                webhook_requests.labels(action_name, "failure").inc()
+                return False
+
+    async def _post_webhook(self, url: str, payload: Dict[str, Any]) -> int:
+        """POST a webhook payload, raising on any non-200 response"""
+        import httpx
+        
+        async with httpx.AsyncClient() as client:
+            # Bounded by the upload deadline as well as the webhook timeout
+            response = await with_deadline(client.post(url, json=payload, timeout=10.0), cap=10.0)
+            
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    f"Webhook returned {response.status_code}",
+                    request=response.request,
+                    response=response
+                )
+            
+            return response.status_code
 
     def _check_additional_actions(self, context: Dict[str, Any], processing_id: int) -> List[str]:
         """Check for additional business logic actions"""
@@ -206,6 +280,8 @@ class ActionRouter:
 
     async def test_webhooks(self) -> Dict[str, bool]:
         """Test webhook endpoints availability"""
+        import httpx
+        
         results = {}
         
         for action_name, rule in self.routing_rules.items():
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+from agents.registry import EXECUTION_ASYNC, EXECUTION_PROCESS, AgentRegistry, AgentSpec
+from utils.profiling import bind_profile
+from utils.timing import timed_stage
+from utils.upload_spool import SpooledUpload
+
+logger = logging.getLogger(__name__)
+
+class AgentDispatcher:
+    """Routes classified documents to agents, each with its own concurrency cap and worker pool"""
+
+    def __init__(self, registry: AgentRegistry):
+        self.registry = registry
+        self._agents: Dict[str, Any] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._executors: Dict[str, Executor] = {}
+
+    def supports(self, file_type: str) -> bool:
+        """Whether an agent is registered for a file type"""
+        return self.registry.get(file_type) is not None
+
+    async def dispatch(self, file_type: str, upload: SpooledUpload, classification: Dict[str, Any],
+                       inspect_text: Optional[Callable[[str], Awaitable[Optional[Dict[str, Any]]]]] = None,
+                       context: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Run the agent registered for a file type; returns None if there is none
+
+        inspect_text is given the document text once it is extracted; if it returns an earlier
+        agent result (a near-duplicate's), that result is reused (refreshed by the agent's reuse(), if it has one)
+        instead of processing the document again. context (e.g. an email's conversation) is
+        passed on to the agent.
+        """
+        spec = self.registry.get(file_type)
+        if spec is None:
+            logger.info(f"No agent registered for file type: {file_type}")
+            return None
+
+        # Each agent has its own cap, so a backlog in one format cannot starve the others
+        async with self._get_semaphore(spec):
+            payload = upload.read_text() if spec.input_kind == "text" else upload.ensure_on_disk()
+            agent = self._get_agent(spec)
+
+            prepared = None
+            if spec.prepare is not None:
+                try:
+                    with timed_stage(f"{spec.name}.prepare"):
+                        prepared = await self._run_prepare(spec, payload)
+                except Exception as e:
+                    # Let the agent redo the work inline and apply its own error handling
+                    logger.warning(f"Prepare stage failed for {spec.name}, processing inline: {str(e)}")
+
+            options = {"context": context} if context is not None else {}
+            if inspect_text is not None:
+                text = payload if spec.input_kind == "text" else (prepared or {}).get("text")
+                earlier = await inspect_text(text) if text else None
+                if earlier is not None:
+                    if not hasattr(agent, "reuse"):
+                        return earlier
+                    with timed_stage(f"{spec.name}.reuse"):
+                        return agent.reuse(payload, classification, earlier, prepared=prepared, **options)
+
+            with timed_stage(f"{spec.name}.process"):
+                if prepared is not None:
+                    options["prepared"] = prepared
+                return await agent.process(payload, classification, **options)
+
+    async def _run_prepare(self, spec: AgentSpec, payload: Any) -> Any:
+        """Run an agent's blocking preparation stage where its spec says"""
+        if spec.execution == EXECUTION_ASYNC:
+            return spec.prepare(payload)
+        loop = asyncio.get_running_loop()
+        prepare = spec.prepare if spec.execution == EXECUTION_PROCESS else bind_profile(spec.prepare)
+        return await loop.run_in_executor(self._get_executor(spec), prepare, payload)
+
+    def _get_agent(self, spec: AgentSpec) -> Any:
+        """Build agents on first use"""
+        agent = self._agents.get(spec.name)
+        if agent is None:
+            agent = spec.factory()
+            self._agents[spec.name] = agent
+        return agent
+
+    def _get_semaphore(self, spec: AgentSpec) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(spec.name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(spec.max_concurrency)
+            self._semaphores[spec.name] = semaphore
+        return semaphore
+
+    def _get_executor(self, spec: AgentSpec) -> Executor:
+        executor = self._executors.get(spec.name)
+        if executor is None:
+            if spec.execution == EXECUTION_PROCESS:
+                # spawn, not fork: the parent runs an event loop and helper threads
+                executor = ProcessPoolExecutor(
+                    max_workers=spec.pool_size,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                executor = ThreadPoolExecutor(max_workers=spec.pool_size, thread_name_prefix=spec.name)
+            self._executors[spec.name] = executor
+            logger.info(f"Started {spec.execution} pool for {spec.name} with {spec.pool_size} workers")
+        return executor
+
+    def shutdown(self):
+        """Stop all worker pools"""
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors.clear()
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from email.parser import HeaderParser
+from email.utils import getaddresses
+from typing import Any, Dict, Optional
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from agents.email_agent import merge_conversation_state
+from database import Conversation, ConversationAction, ConversationMessage, ProcessingResult, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Group emails into conversations and analyse each reply against its thread's running state
+CONVERSATIONS_ENABLED = os.getenv("CONVERSATIONS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# A reply without Message-ID threading headers joins the latest conversation with the same
+# subject and a shared participant, if that conversation was active within this many days
+CONVERSATION_SUBJECT_WINDOW_DAYS = int(os.getenv("CONVERSATION_SUBJECT_WINDOW_DAYS", "14"))
+
+# Actions taken once per conversation rather than once per message
+CONVERSATION_COLLAPSED_ACTIONS = ("crm_escalation",)
+
+_MESSAGE_ID_PATTERN = re.compile(r"<[^<>\s]+>")
+_SUBJECT_PREFIX_PATTERN = re.compile(r"^\s*(?:(?:re|fwd?|aw|wg|sv|vs|tr|antw)(?:\[\d+\])?\s*:|\[[^\]]*\])\s*", re.IGNORECASE)
+_REPLY_PREFIX_PATTERN = re.compile(r"^\s*(?:re|aw|sv|vs|antw)(?:\[\d+\])?\s*:", re.IGNORECASE)
+
+def normalize_subject(subject: str) -> str:
+    """Subject without reply/forward prefixes and list tags, lowercased"""
+    previous = None
+    while previous != subject:
+        previous = subject
+        subject = _SUBJECT_PREFIX_PATTERN.sub("", subject)
+    return " ".join(subject.lower().split())
+
+def thread_headers(content: str) -> Dict[str, Any]:
+    """Message-ID threading headers, subject and participants of a raw email"""
+    # Only the header block is parsed, however long the body
+    headers = HeaderParser().parsestr(content, headersonly=True)
+    subject = str(headers.get("Subject") or "")
+    references = _MESSAGE_ID_PATTERN.findall(str(headers.get("References") or ""))
+    references += _MESSAGE_ID_PATTERN.findall(str(headers.get("In-Reply-To") or ""))
+    message_ids = _MESSAGE_ID_PATTERN.findall(str(headers.get("Message-ID") or ""))
+    addresses = getaddresses([str(value) for field in ("From", "To", "Cc") for value in headers.get_all(field, [])])
+    return {
+        "message_id": message_ids[0] if message_ids else None,
+        "references": list(dict.fromkeys(references)),
+        "subject_key": normalize_subject(subject),
+        "is_reply": bool(_REPLY_PREFIX_PATTERN.match(subject)),
+        "participants": sorted({address.lower() for _, address in addresses if "@" in address})
+    }
+
+class ConversationIndex:
+    """Email conversations built from Message-ID/In-Reply-To/References and normalized subjects
+
+    Each received email is placed in a conversation before its agent runs, so the agent sees
+    the thread's running tone, urgency and open concerns instead of re-reading the quoted
+    history. Message-IDs a reply refers to are recorded even before those messages arrive, so
+    threads assemble correctly whatever order their messages are uploaded in.
+    """
+
+    def __init__(self, enabled: bool = CONVERSATIONS_ENABLED):
+        self.enabled = enabled
+
+    def applies(self, file_type: str) -> bool:
+        return self.enabled and file_type == "email"
+
+    async def resolve(self, processing_id: int, content: str) -> Optional[Dict[str, Any]]:
+        """Put an email in its conversation; returns the conversation's state, or None if it cannot be threaded"""
+        headers = thread_headers(content)
+        if not headers["message_id"] and not headers["references"] and not headers["subject_key"]:
+            return None
+        # A Message-ID raced in by another worker's reply is found on the second attempt
+        for attempt in range(2):
+            try:
+                return await asyncio.to_thread(self._resolve, processing_id, headers)
+            except IntegrityError:
+                if attempt:
+                    raise
+        return None
+
+    def _resolve(self, processing_id: int, headers: Dict[str, Any]) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            # Step 1: A resumed result keeps the conversation it was put in
+            conversation_id = db.query(ProcessingResult.conversation_id).filter(
+                ProcessingResult.id == processing_id
+            ).scalar()
+            if conversation_id is not None:
+                conversation = db.get(Conversation, conversation_id)
+                if conversation is not None:
+                    return self._state(conversation)
+
+            # Step 2: Thread by Message-ID: this message's own (referenced by an earlier reply) or those it replies to
+            message_ids = [headers["message_id"]] if headers["message_id"] else []
+            known = {
+                row.message_id: row for row in db.query(ConversationMessage).filter(
+                    ConversationMessage.message_id.in_(message_ids + headers["references"])
+                ).all()
+            } if message_ids or headers["references"] else {}
+            conversation = None
+            if known:
+                # A message linking two conversations joins the older one
+                conversation = db.get(Conversation, min(row.conversation_id for row in known.values()))
+
+            # Step 3: Without threading headers, a reply joins a recent conversation on the same subject
+            if conversation is None and headers["is_reply"] and headers["subject_key"] and not headers["references"]:
+                conversation = self._match_subject(db, headers)
+
+            # Step 4: Otherwise the message starts a conversation
+            if conversation is None:
+                conversation = Conversation(subject_key=headers["subject_key"], participants=[], message_count=0)
+                db.add(conversation)
+                db.flush()
+
+            # Step 5: Record the message and the ones it refers to
+            own = known.get(headers["message_id"]) if headers["message_id"] else None
+            if own is None:
+                if headers["message_id"]:
+                    db.add(ConversationMessage(message_id=headers["message_id"], conversation_id=conversation.id,
+                                               processing_id=processing_id))
+                conversation.message_count += 1
+            elif own.processing_id is None:
+                own.processing_id = processing_id
+                conversation.message_count += 1
+            for reference in headers["references"]:
+                if reference not in known and reference != headers["message_id"]:
+                    db.add(ConversationMessage(message_id=reference, conversation_id=conversation.id))
+            conversation.participants = sorted(set(conversation.participants or []) | set(headers["participants"]))
+            db.execute(
+                update(ProcessingResult).where(ProcessingResult.id == processing_id).values(
+                    conversation_id=conversation.id
+                ).execution_options(synchronize_session=False)
+            )
+            db.commit()
+            return self._state(conversation)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _match_subject(self, db, headers: Dict[str, Any]) -> Optional[Conversation]:
+        since = datetime.utcnow() - timedelta(days=CONVERSATION_SUBJECT_WINDOW_DAYS)
+        candidates = db.query(Conversation).filter(
+            Conversation.subject_key == headers["subject_key"], Conversation.updated_at >= since
+        ).order_by(Conversation.updated_at.desc()).limit(20).all()
+        participants = set(headers["participants"])
+        for candidate in candidates:
+            if participants & set(candidate.participants or []):
+                return candidate
+        return None
+
+    async def record_analysis(self, conversation_id: int, analysis: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Merge one message's analysis into its conversation; returns the updated state"""
+        def _record() -> Optional[Dict[str, Any]]:
+            db = SessionLocal()
+            try:
+                # Row lock: replies to the same thread processed at once all count
+                conversation = db.query(Conversation).filter(Conversation.id == conversation_id).with_for_update().first()
+                if conversation is None:
+                    return None
+                merged = merge_conversation_state(self._state(conversation), analysis)
+                conversation.urgency = merged["urgency"]
+                conversation.tone = merged["tone"]
+                conversation.sentiment = merged["sentiment"]
+                conversation.key_concerns = merged["key_concerns"]
+                db.commit()
+                return self._state(conversation)
+            finally:
+                db.close()
+        return await asyncio.to_thread(_record)
+
+    async def get_conversation(self, conversation_id: int) -> Optional[Dict[str, Any]]:
+        """A conversation's state"""
+        def _get() -> Optional[Dict[str, Any]]:
+            db = SessionLocal()
+            try:
+                conversation = db.get(Conversation, conversation_id)
+                return self._state(conversation) if conversation is not None else None
+            finally:
+                db.close()
+        return await asyncio.to_thread(_get)
+
+    async def claim_action(self, conversation_id: int, action: str, processing_id: int) -> bool:
+        """Claim an action for a whole conversation; False if another of its messages already took it"""
+        def _claim() -> bool:
+            db = SessionLocal()
+            try:
+                db.add(ConversationAction(conversation_id=conversation_id, action=action, processing_id=processing_id))
+                db.commit()
+                return True
+            except IntegrityError:
+                db.rollback()
+                # A resumed result keeps the claim it made before its worker died
+                holder = db.query(ConversationAction.processing_id).filter(
+                    ConversationAction.conversation_id == conversation_id, ConversationAction.action == action
+                ).scalar()
+                return holder == processing_id
+            finally:
+                db.close()
+        return await asyncio.to_thread(_claim)
+
+    async def release_action(self, conversation_id: int, action: str, processing_id: int):
+        """Give back a claim whose action failed, so the conversation's next message retries it"""
+        def _release():
+            db = SessionLocal()
+            try:
+                db.query(ConversationAction).filter(
+                    ConversationAction.conversation_id == conversation_id, ConversationAction.action == action,
+                    ConversationAction.processing_id == processing_id
+                ).delete(synchronize_session=False)
+                db.commit()
+            finally:
+                db.close()
+        await asyncio.to_thread(_release)
+
+    def _state(self, conversation: Conversation) -> Dict[str, Any]:
+        return {
+            "id": conversation.id,
+            "subject_key": conversation.subject_key,
+            "participants": conversation.participants or [],
+            "message_count": conversation.message_count,
+            "urgency": conversation.urgency,
+            "tone": conversation.tone,
+            "sentiment": conversation.sentiment,
+            "key_concerns": conversation.key_concerns or [],
+            "updated_at": conversation.updated_at.isoformat() if conversation.updated_at else None
+        }
+
+# Global conversation index instance
+conversation_index = ConversationIndex()
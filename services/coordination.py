@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from database import CircuitBreakerState, Lease, RateLimitBucket, SessionLocal
+from services.idempotency import idempotency_store
+from utils.retry import TokenBucketRateLimiter, RateLimitExceededError, circuit_breakers, rate_limiters
+
+logger = logging.getLogger(__name__)
+
+# "database" shares breaker, rate limit and leadership state through the database;
+# "local" keeps it in-process (single worker deployments)
+COORDINATION_BACKEND = os.getenv("COORDINATION_BACKEND", "database")
+
+# How often each worker exchanges circuit breaker transitions with the others
+SHARED_STATE_SYNC_INTERVAL = float(os.getenv("SHARED_STATE_SYNC_INTERVAL", "1.0"))
+
+# Leadership lapses if the leader stops renewing for this long
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "60"))
+
+# How often the leader runs maintenance, and how long results are kept
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+RESULT_RETENTION_DAYS = int(os.getenv("RESULT_RETENTION_DAYS", "30"))
+
+# Optimistic update attempts before a contended bucket is treated as empty
+BUCKET_UPDATE_ATTEMPTS = 5
+
+def worker_id() -> str:
+    """Identifier for this worker process, unique across nodes"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class SharedTokenBucket:
+    """Token bucket kept in the database so a rate limit holds across all workers and nodes
+
+    Drop-in replacement for TokenBucketRateLimiter. Each token costs one small
+    optimistic-concurrency UPDATE; if the database is unreachable the limiter
+    degrades to a process-local bucket rather than blocking LLM calls.
+    """
+
+    def __init__(self, service: str, rate_per_second: float, capacity: float, session_factory=SessionLocal):
+        self.service = service
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.SessionLocal = session_factory
+        self.local = TokenBucketRateLimiter(rate_per_second, capacity)
+        self._lock = None
+
+    def _take(self, tokens: float) -> float:
+        """Take tokens from the shared bucket; returns 0 on success, else the seconds to wait"""
+        for _ in range(BUCKET_UPDATE_ATTEMPTS):
+            db = self.SessionLocal()
+            try:
+                now = time.time()
+                bucket = db.get(RateLimitBucket, self.service)
+                if bucket is None:
+                    db.add(RateLimitBucket(service=self.service, tokens=self.capacity - tokens, refilled_at=now, version=0))
+                    db.commit()
+                    return 0.0
+
+                available = min(self.capacity, bucket.tokens + max(0.0, now - bucket.refilled_at) * self.rate)
+                if available < tokens:
+                    return (tokens - available) / self.rate
+
+                # Only succeeds if no other worker touched the bucket since we read it
+                updated = db.execute(
+                    update(RateLimitBucket)
+                    .where(RateLimitBucket.service == self.service, RateLimitBucket.version == bucket.version)
+                    .values(tokens=available - tokens, refilled_at=now, version=bucket.version + 1)
+                ).rowcount
+                db.commit()
+                if updated:
+                    return 0.0
+            except IntegrityError:
+                # Another worker created the bucket first
+                db.rollback()
+            finally:
+                db.close()
+        return 1.0 / self.rate
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens without waiting; return False if not available"""
+        try:
+            return self._take(tokens) == 0.0
+        except Exception as e:
+            logger.warning(f"Shared rate limit unavailable for {self.service}, using local bucket: {str(e)}")
+            return self.local.try_acquire(tokens)
+
+    async def try_acquire_async(self, tokens: float = 1.0) -> bool:
+        """try_acquire without blocking the event loop on the database"""
+        try:
+            return await asyncio.to_thread(self._take, tokens) == 0.0
+        except Exception as e:
+            logger.warning(f"Shared rate limit unavailable for {self.service}, using local bucket: {str(e)}")
+            return self.local.try_acquire(tokens)
+
+    async def acquire(self, tokens: float = 1.0, max_wait: Optional[float] = None):
+        """Wait for tokens, raising RateLimitExceededError if the wait would exceed max_wait"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Serialize this worker's waiters so tokens are handed out in arrival order
+        async with self._lock:
+            waited = 0.0
+            while True:
+                try:
+                    wait_time = await asyncio.to_thread(self._take, tokens)
+                except Exception as e:
+                    logger.warning(f"Shared rate limit unavailable for {self.service}, using local bucket: {str(e)}")
+                    remaining = None if max_wait is None else max(0.0, max_wait - waited)
+                    return await self.local.acquire(tokens, max_wait=remaining)
+
+                if wait_time == 0.0:
+                    return
+                if max_wait is not None and waited + wait_time > max_wait:
+                    raise RateLimitExceededError(f"Rate limit wait of {waited + wait_time:.1f}s exceeds {max_wait:.1f}s")
+                await asyncio.sleep(wait_time)
+                waited += wait_time
+
+class LeaderLease:
+    """Expiring database lease; whoever holds it is the leader"""
+
+    def __init__(self, name: str, holder: str, ttl: float = LEADER_LEASE_TTL, session_factory=SessionLocal):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.SessionLocal = session_factory
+
+    def try_acquire(self) -> bool:
+        """Acquire the lease if free or expired, or renew it if already held"""
+        db = self.SessionLocal()
+        try:
+            now = time.time()
+            updated = db.execute(
+                update(Lease)
+                .where(Lease.name == self.name, or_(Lease.holder == self.holder, Lease.expires_at < now))
+                .values(holder=self.holder, expires_at=now + self.ttl)
+            ).rowcount
+            if not updated:
+                if db.get(Lease, self.name) is not None:
+                    db.rollback()
+                    return False
+                db.add(Lease(name=self.name, holder=self.holder, expires_at=now + self.ttl))
+            db.commit()
+            return True
+        except IntegrityError:
+            # Another worker inserted the lease first
+            db.rollback()
+            return False
+        finally:
+            db.close()
+
+    def release(self):
+        """Give up the lease so another worker can take over immediately"""
+        db = self.SessionLocal()
+        try:
+            db.execute(
+                update(Lease)
+                .where(Lease.name == self.name, Lease.holder == self.holder)
+                .values(expires_at=0.0)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+def exchange_breaker_states(snapshots: Dict[str, Dict[str, Any]], session_factory=SessionLocal) -> Dict[str, Dict[str, Any]]:
+    """Publish local breaker transitions that are newer than the shared ones; return the shared ones that are newer"""
+    newer_remote = {}
+    db = session_factory()
+    try:
+        for service, local in snapshots.items():
+            row = db.get(CircuitBreakerState, service)
+            if row is None:
+                if local["changed_at"] > 0:
+                    db.add(CircuitBreakerState(service=service, **local))
+            elif local["changed_at"] > row.changed_at:
+                row.state = local["state"]
+                row.opened_at = local["opened_at"]
+                row.changed_at = local["changed_at"]
+            elif row.changed_at > local["changed_at"]:
+                newer_remote[service] = {
+                    "state": row.state,
+                    "opened_at": row.opened_at,
+                    "changed_at": row.changed_at
+                }
+        db.commit()
+    except IntegrityError:
+        # Another worker published first; we pick its state up next round
+        db.rollback()
+    finally:
+        db.close()
+    return newer_remote
+
+class Coordinator:
+    """Per-worker background tasks that share state between workers and elect a maintenance leader"""
+
+    def __init__(self, memory_store, backend: str = COORDINATION_BACKEND):
+        self.memory_store = memory_store
+        self.backend = backend
+        self.worker_id = worker_id()
+        self.lease = LeaderLease("maintenance", self.worker_id)
+        self.is_leader = backend != "database"
+        self._tasks: List[asyncio.Task] = []
+        self._maintenance: Optional[asyncio.Task] = None
+        self._next_maintenance = time.time() + MAINTENANCE_INTERVAL
+
+    async def start(self):
+        """Install shared state and start the background loops"""
+        if self.backend == "database":
+            for service, limiter in list(rate_limiters.items()):
+                rate_limiters[service] = SharedTokenBucket(service, limiter.rate, limiter.capacity)
+            self._tasks.append(asyncio.create_task(self._sync_loop()))
+        self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+        logger.info(f"Worker {self.worker_id} started with {self.backend} coordination")
+
+    async def stop(self):
+        """Stop the background loops and hand over leadership"""
+        tasks = self._tasks + ([self._maintenance] if self._maintenance is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._maintenance = None
+        if self.backend == "database" and self.is_leader:
+            try:
+                await asyncio.to_thread(self.lease.release)
+            except Exception as e:
+                logger.warning(f"Failed to release maintenance lease: {str(e)}")
+        self.is_leader = self.backend != "database"
+
+    async def _sync_loop(self):
+        """Exchange circuit breaker transitions with the other workers"""
+        while True:
+            await asyncio.sleep(SHARED_STATE_SYNC_INTERVAL)
+            try:
+                snapshots = {service: breaker.snapshot() for service, breaker in circuit_breakers.items()}
+                newer_remote = await asyncio.to_thread(exchange_breaker_states, snapshots)
+                # Apply on the event loop, where the breakers are used
+                for service, remote in newer_remote.items():
+                    circuit_breakers[service].adopt(**remote)
+            except Exception as e:
+                logger.warning(f"Circuit breaker state sync failed: {str(e)}")
+
+    async def _maintenance_loop(self):
+        """Renew the leader lease and run maintenance when this worker leads"""
+        while True:
+            if self.backend == "database":
+                try:
+                    leader = await asyncio.to_thread(self.lease.try_acquire)
+                    if leader != self.is_leader:
+                        logger.info(f"Worker {self.worker_id} {'became' if leader else 'is no longer'} maintenance leader")
+                    self.is_leader = leader
+                except Exception as e:
+                    logger.warning(f"Leader lease renewal failed: {str(e)}")
+                    self.is_leader = False
+
+            running = self._maintenance is not None and not self._maintenance.done()
+            if self.is_leader and not running and time.time() >= self._next_maintenance:
+                self._next_maintenance = time.time() + MAINTENANCE_INTERVAL
+                # Its own task, so the lease keeps being renewed however long a pass takes
+                self._maintenance = asyncio.create_task(self.run_maintenance())
+            elif running and not self.is_leader:
+                # Another worker may take over; stop at the next step rather than run alongside it
+                logger.warning("Lost the maintenance lease during maintenance; stopping")
+                self._maintenance.cancel()
+
+            # Renew well within the lease TTL
+            await asyncio.sleep(min(LEADER_LEASE_TTL / 3, MAINTENANCE_INTERVAL))
+
+    async def run_maintenance(self):
+        """Periodic housekeeping, run by the leader only"""
+        try:
+            deleted = await self.memory_store.cleanup_old_results(days_old=RESULT_RETENTION_DAYS)
+            logger.info(f"Maintenance removed {deleted} results older than {RESULT_RETENTION_DAYS} days")
+        except Exception as e:
+            logger.error(f"Maintenance failed: {str(e)}")
+        try:
+            purged = await idempotency_store.purge_expired()
+            logger.info(f"Maintenance removed {purged} expired idempotency keys")
+        except Exception as e:
+            logger.error(f"Idempotency key cleanup failed: {str(e)}")
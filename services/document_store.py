@@ -0,0 +1,233 @@
+import asyncio
+import gzip
+import logging
+import mmap
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, Optional
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, StoredDocument
+from utils.upload_spool import SpooledUpload
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # optional: documents fall back to gzip
+    zstandard = None
+
+# Originals of uploaded documents, keyed by SHA-256 (set DOCUMENT_STORE_ENABLED=false to discard them)
+DOCUMENT_STORE_DIR = os.getenv("DOCUMENT_STORE_DIR", "./uploads")
+DOCUMENT_STORE_ENABLED = os.getenv("DOCUMENT_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+DOCUMENT_ZSTD_LEVEL = int(os.getenv("DOCUMENT_ZSTD_LEVEL", "3"))
+
+# Documents whose head compresses worse than this are stored as-is (most PDFs are compressed already)
+DOCUMENT_MIN_SAVING = float(os.getenv("DOCUMENT_MIN_SAVING", "0.1"))
+
+# Bytes copied per chunk while storing or streaming a document
+DOCUMENT_CHUNK_SIZE = 256 * 1024
+
+_EXTENSIONS = {"zstd": ".zst", "gzip": ".gz", "raw": ""}
+
+class DocumentStore:
+    """Content-addressed store for original documents, deduplicated by reference count
+
+    Objects live at <root>/objects/<aa>/<bb>/<sha256>[.zst|.gz]; the stored_documents table
+    holds their encoding and how many results reference them. A document already stored is
+    never written again; the last release removes it.
+    """
+
+    def __init__(self, root: str = DOCUMENT_STORE_DIR, enabled: bool = DOCUMENT_STORE_ENABLED):
+        self.root = root
+        self.enabled = enabled
+
+    def object_path(self, sha256: str, encoding: str) -> str:
+        return os.path.join(self.root, "objects", sha256[:2], sha256[2:4], sha256 + _EXTENSIONS[encoding])
+
+    def put(self, upload) -> str:
+        """Store a SpooledUpload (or add a reference to the stored copy); returns its SHA-256. Blocking."""
+        sha256 = upload.sha256
+        # Step 1: Already stored - just take another reference
+        if self._add_reference(sha256):
+            return sha256
+
+        # Step 2: Stream it to disk once
+        encoding = self._choose_encoding(upload.head)
+        stored_size = self._write_object(upload, sha256, encoding)
+
+        # Step 3: Record it; a concurrent upload of the same content may have won the insert
+        db = SessionLocal()
+        try:
+            db.add(StoredDocument(sha256=sha256, size=upload.size, stored_size=stored_size,
+                                  encoding=encoding, refcount=1))
+            db.commit()
+            logger.info(f"Stored document {sha256[:12]} ({upload.size} -> {stored_size} bytes, {encoding})")
+        except IntegrityError:
+            db.rollback()
+            if not self._add_reference(sha256):
+                raise
+        finally:
+            db.close()
+        return sha256
+
+    async def store(self, upload) -> Optional[str]:
+        """Keep the original of an upload; returns its SHA-256, or None if it was not stored"""
+        if not self.enabled:
+            return None
+        try:
+            return await asyncio.to_thread(self.put, upload)
+        except Exception as e:
+            # Losing the original must not fail the upload itself
+            logger.error(f"Error storing document {upload.filename}: {str(e)}")
+            return None
+
+    def release(self, sha256_counts: Dict[str, int]):
+        """Drop references (sha256 -> count), removing documents nothing refers to any more. Blocking."""
+        for sha256, count in sha256_counts.items():
+            db = SessionLocal()
+            try:
+                # The row lock makes a concurrent put wait until the file is gone, then store it afresh
+                document = db.query(StoredDocument).filter(StoredDocument.sha256 == sha256).with_for_update().first()
+                if document is None:
+                    continue
+                document.refcount -= count
+                if document.refcount <= 0:
+                    path = self.object_path(sha256, document.encoding)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    db.delete(document)
+                    logger.info(f"Removed document {sha256[:12]}")
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error releasing document {sha256[:12]}: {str(e)}")
+            finally:
+                db.close()
+
+    def get_info(self, sha256: str) -> Optional[Dict[str, Any]]:
+        """Size, encoding and reference count of a stored document, or None"""
+        db = SessionLocal()
+        try:
+            document = db.query(StoredDocument).filter(StoredDocument.sha256 == sha256).first()
+            if document is None:
+                return None
+            return {
+                "sha256": document.sha256,
+                "size": document.size,
+                "stored_size": document.stored_size,
+                "encoding": document.encoding,
+                "refcount": document.refcount,
+                "created_at": document.created_at.isoformat() if document.created_at else None
+            }
+        finally:
+            db.close()
+
+    @contextmanager
+    def open(self, sha256: str, encoding: Optional[str] = None) -> Iterator[BinaryIO]:
+        """The original bytes of a document as a file object over a memory map of the stored object"""
+        if encoding is None:
+            info = self.get_info(sha256)
+            if info is None:
+                raise FileNotFoundError(f"Document {sha256} is not stored")
+            encoding = info["encoding"]
+        with open(self.object_path(sha256, encoding), "rb") as raw:
+            # mmap cannot map empty files
+            if os.fstat(raw.fileno()).st_size == 0:
+                yield raw
+                return
+            with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if encoding == "zstd":
+                    if zstandard is None:
+                        raise RuntimeError(f"zstandard is required to read document {sha256}")
+                    with zstandard.ZstdDecompressor().stream_reader(mapped) as stream:
+                        yield stream
+                elif encoding == "gzip":
+                    with gzip.GzipFile(fileobj=mapped, mode="rb") as stream:
+                        yield stream
+                else:
+                    yield mapped
+
+    def read(self, sha256: str) -> bytes:
+        """The whole original document. Blocking."""
+        with self.open(sha256) as stream:
+            return stream.read()
+
+    def iter_chunks(self, sha256: str, chunk_size: int = DOCUMENT_CHUNK_SIZE) -> Iterable[bytes]:
+        """The original document in chunks, for streaming responses"""
+        with self.open(sha256) as stream:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def to_upload(self, sha256: str, filename: str, max_size: Optional[int] = None) -> SpooledUpload:
+        """Spool a stored document back into a SpooledUpload, as if it had just been uploaded. Blocking."""
+        info = self.get_info(sha256)
+        if info is None:
+            raise FileNotFoundError(f"Document {sha256} is not stored")
+        upload = SpooledUpload(filename, max_size=max_size or info["size"])
+        try:
+            for chunk in self.iter_chunks(sha256):
+                upload.write(chunk)
+            upload.finish()
+        except BaseException:
+            upload.close()
+            raise
+        return upload
+
+    def _add_reference(self, sha256: str) -> bool:
+        db = SessionLocal()
+        try:
+            updated = db.execute(
+                update(StoredDocument).where(StoredDocument.sha256 == sha256).values(
+                    refcount=StoredDocument.refcount + 1, last_referenced_at=datetime.utcnow()
+                )
+            ).rowcount
+            db.commit()
+            return updated > 0
+        finally:
+            db.close()
+
+    def _choose_encoding(self, head: bytes) -> str:
+        """Compress unless a trial on the leading bytes shows it would not pay off"""
+        if zstandard is not None:
+            saving = 1 - len(zstandard.ZstdCompressor(level=1).compress(head)) / max(len(head), 1)
+            encoding = "zstd"
+        else:
+            saving = 1 - len(gzip.compress(head, compresslevel=1)) / max(len(head), 1)
+            encoding = "gzip"
+        return encoding if saving >= DOCUMENT_MIN_SAVING else "raw"
+
+    def _write_object(self, upload, sha256: str, encoding: str) -> int:
+        """Stream the upload into its object path via a synced temp file; returns the stored size"""
+        path = self.object_path(sha256, encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}")
+        try:
+            with upload.open() as source, open(temp_path, "wb") as target:
+                if encoding == "zstd":
+                    compressor = zstandard.ZstdCompressor(level=DOCUMENT_ZSTD_LEVEL)
+                    compressor.copy_stream(source, target, size=upload.size,
+                                           read_size=DOCUMENT_CHUNK_SIZE, write_size=DOCUMENT_CHUNK_SIZE)
+                elif encoding == "gzip":
+                    with gzip.GzipFile(fileobj=target, mode="wb", compresslevel=6) as stream:
+                        shutil.copyfileobj(source, stream, DOCUMENT_CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(source, target, DOCUMENT_CHUNK_SIZE)
+                target.flush()
+                os.fsync(target.fileno())
+            # Same content under the same name, so a concurrent writer replacing it is harmless
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return os.path.getsize(path)
+
+# Global document store instance
+document_store = DocumentStore()
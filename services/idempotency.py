@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from database import IdempotencyKey, SessionLocal
+from utils.deadline import check_deadline, with_deadline
+
+logger = logging.getLogger(__name__)
+
+# Deduplicate retried and concurrent identical uploads
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# How long the response to a request with an Idempotency-Key header is replayed
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+# Without a header, the same file under the same name is treated as a retry for this many
+# seconds; later uploads of it are processed again. 0 turns the automatic key off
+IDEMPOTENCY_CONTENT_WINDOW = float(os.getenv("IDEMPOTENCY_CONTENT_WINDOW", "600"))
+
+# An in-progress claim lapses after this long, so a request whose worker died can be run again;
+# keep it above UPLOAD_DEADLINE_SECONDS
+IDEMPOTENCY_CLAIM_TTL = float(os.getenv("IDEMPOTENCY_CLAIM_TTL", "120"))
+
+# How often a request waits for another worker's in-progress run of the same key
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.5"))
+
+# Longest accepted Idempotency-Key header
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+class IdempotencyConflictError(Exception):
+    """An Idempotency-Key was reused for a different upload"""
+    pass
+
+def upload_fingerprint(filename: str, sha256: str) -> str:
+    """What makes two uploads the same request: the file name and content"""
+    return hashlib.sha256(f"{filename}\0{sha256}".encode("utf-8")).hexdigest()
+
+class IdempotencyStore:
+    """Single-flight execution and stored responses, by idempotency key
+
+    Within a worker, requests for a key that is already running await that run instead of
+    starting another. Across workers, the first request claims the key in the database and
+    the others poll until its response is stored, so a retry storm costs one pipeline run.
+    A failed run releases its claim, so the next retry runs again.
+    """
+
+    def __init__(self, enabled: bool = IDEMPOTENCY_ENABLED):
+        self.enabled = enabled
+        self._in_flight: Dict[str, Tuple[str, asyncio.Task]] = {}
+
+    def request_key(self, header_key: Optional[str], filename: str, sha256: str) -> Optional[Tuple[str, str, float]]:
+        """(key, fingerprint, ttl) for an upload, or None if it is not deduplicated"""
+        if not self.enabled:
+            return None
+        fingerprint = upload_fingerprint(filename, sha256)
+        if header_key:
+            if len(header_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+                raise ValueError(f"Idempotency-Key longer than {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+            return f"key:{header_key}", fingerprint, IDEMPOTENCY_KEY_TTL
+        if IDEMPOTENCY_CONTENT_WINDOW > 0:
+            return f"content:{fingerprint}", fingerprint, IDEMPOTENCY_CONTENT_WINDOW
+        return None
+
+    async def run(self, key: str, fingerprint: str, ttl: float, work: Callable[[], Awaitable[Dict[str, Any]]],
+                  release: Optional[Callable[[], None]] = None) -> Tuple[Dict[str, Any], bool]:
+        """Run work() once per key; returns its response and whether it was replayed rather than run here
+
+        release() frees what work() would have used; it is called once the shared run is
+        finished with it, even if this caller stops waiting first.
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            if release is not None:
+                release()
+            if in_flight[0] != fingerprint:
+                raise IdempotencyConflictError("Idempotency-Key is already in use for a different upload")
+            response, _ = await with_deadline(asyncio.shield(in_flight[1]))
+            return response, True
+
+        # The shared run must outlive a caller that gives up, so every caller awaits it shielded
+        task = asyncio.create_task(self._execute(key, fingerprint, ttl, work, release))
+        self._in_flight[key] = (fingerprint, task)
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return await with_deadline(asyncio.shield(task))
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Every caller may have stopped waiting; retrieve the error so it is not reported as unhandled
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Run for idempotency key {key} failed: {task.exception()}")
+
+    async def _execute(self, key: str, fingerprint: str, ttl: float, work: Callable[[], Awaitable[Dict[str, Any]]],
+                       release: Optional[Callable[[], None]]) -> Tuple[Dict[str, Any], bool]:
+        try:
+            token = uuid.uuid4().hex
+            while True:
+                claimed, stored = await asyncio.to_thread(self._claim, key, fingerprint, token)
+                if stored is not None:
+                    return stored, True
+                if claimed:
+                    break
+                # Another worker is running this key
+                check_deadline()
+                await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+            try:
+                response = await work()
+            except BaseException:
+                await asyncio.shield(asyncio.to_thread(self._release, key, token))
+                raise
+            try:
+                await asyncio.to_thread(self._complete, key, token, response, ttl)
+            except Exception as e:
+                # The upload is processed and its actions have fired; answer it even if the replay is lost
+                logger.error(f"Failed to store the response for idempotency key {key}: {str(e)}")
+                await asyncio.shield(asyncio.to_thread(self._release, key, token))
+            return response, False
+        finally:
+            if release is not None:
+                release()
+
+    def _claim(self, key: str, fingerprint: str, token: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(claimed, stored response) for a key"""
+        db = SessionLocal()
+        try:
+            now = time.time()
+            row = db.get(IdempotencyKey, key)
+            if row is None:
+                db.add(IdempotencyKey(key=key, fingerprint=fingerprint, owner=token,
+                                      expires_at=now + IDEMPOTENCY_CLAIM_TTL))
+                db.commit()
+                return True, None
+            if row.expires_at < now:
+                # An expired response, or a claim whose worker died: take it over
+                updated = db.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.key == key, IdempotencyKey.expires_at == row.expires_at)
+                    .values(fingerprint=fingerprint, owner=token, response=None, processing_id=None,
+                            expires_at=now + IDEMPOTENCY_CLAIM_TTL)
+                ).rowcount
+                db.commit()
+                return bool(updated), None
+            if row.fingerprint != fingerprint:
+                raise IdempotencyConflictError("Idempotency-Key was already used for a different upload")
+            return False, row.response
+        except IntegrityError:
+            # Another worker inserted the key first
+            db.rollback()
+            return False, None
+        finally:
+            db.close()
+
+    def _complete(self, key: str, token: str, response: Dict[str, Any], ttl: float):
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.key == key, IdempotencyKey.owner == token)
+                .values(response=response, processing_id=response.get("processing_id"), expires_at=time.time() + ttl)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _release(self, key: str, token: str):
+        db = SessionLocal()
+        try:
+            db.query(IdempotencyKey).filter(
+                IdempotencyKey.key == key, IdempotencyKey.owner == token
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            # The claim lapses on its own after IDEMPOTENCY_CLAIM_TTL
+            logger.error(f"Failed to release idempotency key {key}: {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+
+    async def purge_expired(self) -> int:
+        """Delete expired keys; returns how many were removed"""
+        def _purge() -> int:
+            db = SessionLocal()
+            try:
+                deleted = db.query(IdempotencyKey).filter(
+                    IdempotencyKey.expires_at < time.time()
+                ).delete(synchronize_session=False)
+                db.commit()
+                return deleted
+            finally:
+                db.close()
+        return await asyncio.to_thread(_purge)
+
+# Global idempotency store instance
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,455 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import struct
+import time
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+from sqlalchemy.exc import IntegrityError
+from database import IngestedItem, IngestionCheckpoint, SessionLocal
+from utils.deadline import deadline_scope
+from utils.metrics import documents_processed
+from utils.timing import timed_stage, timing_scope
+from utils.upload_spool import UPLOAD_CHUNK_SIZE, SpooledUpload, UploadTooLargeError
+
+logger = logging.getLogger(__name__)
+
+# Messages or files run through the pipeline at once; also how many are spooled at any time
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+
+# Larger messages and files are skipped (the /upload limit)
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Processing deadline per ingested document; no HTTP client is waiting, so it is generous
+INGEST_DEADLINE_SECONDS = float(os.getenv("INGEST_DEADLINE_SECONDS", "300"))
+
+# Watch folders: how often the folder is scanned without inotify (with inotify, a safety rescan
+# runs every INGEST_RESCAN_INTERVAL), and how long a file must be unmodified to count as complete
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "5"))
+INGEST_RESCAN_INTERVAL = float(os.getenv("INGEST_RESCAN_INTERVAL", "60"))
+INGEST_SETTLE_SECONDS = float(os.getenv("INGEST_SETTLE_SECONDS", "2"))
+
+# Longest mbox line read at once; longer lines are read in pieces
+_LINE_LIMIT = 64 * 1024
+# mboxrd escaping: ">From " in a body is "From " with one ">" added
+_ESCAPED_FROM = re.compile(rb"^>+From ")
+# Names of files still being written by common tools
+_PARTIAL_SUFFIXES = (".tmp", ".part", ".partial", ".crdownload")
+
+class IngestItem:
+    """One message or file read from a source, spooled and ready for the pipeline"""
+
+    def __init__(self, key: str, filename: str, upload: Optional[SpooledUpload], skip_reason: Optional[str] = None):
+        self.key = key
+        self.filename = filename
+        self.upload = upload
+        # Set when the item is passed over (e.g. too large) rather than processed
+        self.skip_reason = skip_reason
+
+class IngestionState:
+    """Persistent read offset and seen-set of one source, so a restarted run carries on where it stopped"""
+
+    def __init__(self, source: str):
+        self.source = source
+
+    def load(self) -> Dict[str, Any]:
+        """The saved read offset and the keys of items already processed. Blocking."""
+        db = SessionLocal()
+        try:
+            checkpoint = db.get(IngestionCheckpoint, self.source)
+            seen = {key for (key,) in db.query(IngestedItem.item_key).filter(IngestedItem.source == self.source)}
+            return {"offset": checkpoint.read_offset if checkpoint else 0, "seen": seen}
+        finally:
+            db.close()
+
+    def mark_done(self, item_key: str, processing_id: Optional[int]):
+        """Record an item as processed. Blocking."""
+        db = SessionLocal()
+        try:
+            db.add(IngestedItem(source=self.source, item_key=item_key, processing_id=processing_id))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+        finally:
+            db.close()
+
+    def save_offset(self, offset: int, forget: List[str]):
+        """Advance the read offset, dropping seen items it now covers. Blocking."""
+        db = SessionLocal()
+        try:
+            checkpoint = db.get(IngestionCheckpoint, self.source)
+            if checkpoint is None:
+                db.add(IngestionCheckpoint(source=self.source, read_offset=offset))
+            else:
+                checkpoint.read_offset = offset
+            if forget:
+                db.query(IngestedItem).filter(
+                    IngestedItem.source == self.source, IngestedItem.item_key.in_(forget)
+                ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+def _spool_file(path: str, filename: str) -> IngestItem:
+    """Stream a file into a SpooledUpload, chunk by chunk. Blocking."""
+    upload = SpooledUpload(filename, max_size=INGEST_MAX_BYTES)
+    try:
+        with open(path, "rb") as source:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload.write(chunk)
+        upload.finish()
+    except UploadTooLargeError as e:
+        upload.close()
+        return IngestItem(filename, filename, None, skip_reason=str(e))
+    except BaseException:
+        upload.close()
+        raise
+    return IngestItem(filename, filename, upload)
+
+class MboxSource:
+    """Messages of an mbox archive, read sequentially with constant memory
+
+    Each message is streamed into its own SpooledUpload (which spills to disk when large), so
+    the archive is never held in memory. Progress is a byte offset: everything before it has
+    been processed. Messages after it that finished out of order are remembered by their start
+    offset until the offset passes them.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self.name = f"mbox:{self.path}"
+        self.state = IngestionState(self.name)
+        self._file = None
+        self._offset = 0
+        self._lookahead: Optional[bytes] = None
+        self._seen: Set[str] = set()
+        # Start offsets of messages read but not yet processed
+        self._in_flight: Set[int] = set()
+        self._done_ahead: Set[int] = set()
+        self._checkpoint = 0
+        # Where the message after the last one read starts
+        self._read_end = 0
+        # Checkpoints are written one at a time, so they are never saved out of order
+        self._save_lock = asyncio.Lock()
+
+    async def items(self) -> AsyncIterator[IngestItem]:
+        saved = await asyncio.to_thread(self.state.load)
+        self._checkpoint = saved["offset"]
+        self._seen = saved["seen"]
+        self._done_ahead = {int(key) for key in self._seen}
+        self._file = open(self.path, "rb")
+        try:
+            self._file.seek(self._checkpoint)
+            self._offset = self._read_end = self._checkpoint
+            if self._checkpoint:
+                logger.info(f"Resuming {self.path} at byte {self._checkpoint}")
+            while True:
+                item = await asyncio.to_thread(self._read_message)
+                if item is None:
+                    break
+                self._read_end = self._offset
+                if item.key in self._seen:
+                    continue
+                self._in_flight.add(int(item.key))
+                yield item
+        finally:
+            self._file.close()
+
+    def _read_line(self) -> bytes:
+        if self._lookahead is not None:
+            line, self._lookahead = self._lookahead, None
+            return line
+        return self._file.readline(_LINE_LIMIT)
+
+    def _read_message(self) -> Optional[IngestItem]:
+        """The next message, streamed into a SpooledUpload. Blocking."""
+        # Step 1: Find the "From " separator line that starts the message
+        line = self._read_line()
+        while line and not line.startswith(b"From "):
+            self._offset += len(line)
+            line = self._read_line()
+        if not line:
+            return None
+        start = self._offset
+        self._offset += len(line)
+        filename = f"{os.path.basename(self.path)}@{start}.eml"
+
+        # Step 2: Stream the message up to the next separator, in upload-sized chunks
+        upload = SpooledUpload(filename, max_size=INGEST_MAX_BYTES)
+        pending = bytearray()
+        # Messages processed before a restart are read past without spooling them
+        skip_reason = "already ingested" if str(start) in self._seen else None
+        at_line_start = True
+        while True:
+            line = self._file.readline(_LINE_LIMIT)
+            if not line or (at_line_start and line.startswith(b"From ")):
+                self._lookahead = line or None
+                break
+            self._offset += len(line)
+            if at_line_start and _ESCAPED_FROM.match(line):
+                line = line[1:]
+            at_line_start = line.endswith(b"\n")
+            if skip_reason is not None:
+                continue
+            pending += line
+            if len(pending) >= UPLOAD_CHUNK_SIZE:
+                try:
+                    upload.write(bytes(pending))
+                except UploadTooLargeError as e:
+                    skip_reason = str(e)
+                pending.clear()
+        try:
+            if skip_reason is None:
+                upload.write(bytes(pending))
+                upload.finish()
+        except UploadTooLargeError as e:
+            skip_reason = str(e)
+        if skip_reason is not None:
+            upload.close()
+            return IngestItem(str(start), filename, None, skip_reason=skip_reason)
+        return IngestItem(str(start), filename, upload)
+
+    async def done(self, item: IngestItem, processing_id: Optional[int]):
+        start = int(item.key)
+        self._in_flight.discard(start)
+        self._done_ahead.add(start)
+        # Everything before the earliest message still in flight is finished
+        offset = min(self._in_flight) if self._in_flight else self._read_end
+        if start >= offset:
+            await asyncio.to_thread(self.state.mark_done, item.key, processing_id)
+        async with self._save_lock:
+            offset = min(self._in_flight) if self._in_flight else self._read_end
+            if offset > self._checkpoint:
+                covered = [done for done in self._done_ahead if done < offset]
+                self._done_ahead.difference_update(covered)
+                self._checkpoint = offset
+                await asyncio.to_thread(self.state.save_offset, offset, [str(done) for done in covered])
+
+class MaildirSource:
+    """Messages of a Maildir (its new/ and cur/ folders), each file streamed into the pipeline once"""
+
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self.name = f"maildir:{self.path}"
+        self.state = IngestionState(self.name)
+
+    async def items(self) -> AsyncIterator[IngestItem]:
+        seen = (await asyncio.to_thread(self.state.load))["seen"]
+        for folder in ("new", "cur"):
+            directory = os.path.join(self.path, folder)
+            if not os.path.isdir(directory):
+                continue
+            names = await asyncio.to_thread(lambda: sorted(entry.name for entry in os.scandir(directory) if entry.is_file()))
+            for name in names:
+                # The unique name stays the same when a message moves to cur/ and gains flags (":2,S")
+                key = name.split(":", 1)[0]
+                if key in seen or name.startswith("."):
+                    continue
+                try:
+                    item = await asyncio.to_thread(_spool_file, os.path.join(directory, name), f"{key}.eml")
+                except FileNotFoundError:
+                    # Moved by a mail client since the listing; picked up from its new folder next run
+                    continue
+                item.key = key
+                seen.add(key)
+                yield item
+
+    async def done(self, item: IngestItem, processing_id: Optional[int]):
+        await asyncio.to_thread(self.state.mark_done, item.key, processing_id)
+
+class _Inotify:
+    """Minimal inotify binding (Linux) reporting files closed after writing or moved into a folder"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def read_names(self) -> List[str]:
+        """Names of the files reported since the last read"""
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            position = 0
+            while position < len(data):
+                _, _, _, length = self._EVENT.unpack_from(data, position)
+                position += self._EVENT.size
+                name = data[position:position + length].rstrip(b"\0")
+                position += length
+                if name:
+                    names.append(os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+class WatchFolderSource:
+    """Files dropped into a folder, each run through the pipeline once; runs until cancelled
+
+    Uses inotify where available and falls back to polling. A file is picked up once it has
+    been closed after writing (inotify) or left unmodified for INGEST_SETTLE_SECONDS. A file
+    replaced with different content is ingested again. Subfolders, hidden files and partial
+    downloads are ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self.name = f"watch:{self.path}"
+        self.state = IngestionState(self.name)
+        self._seen: Set[str] = set()
+
+    async def items(self) -> AsyncIterator[IngestItem]:
+        self._seen = (await asyncio.to_thread(self.state.load))["seen"]
+        try:
+            inotify = _Inotify(self.path)
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify unavailable for {self.path} ({str(e)}); polling every {INGEST_POLL_INTERVAL}s")
+            inotify = None
+
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        if inotify is not None:
+            loop.add_reader(inotify.fd, woken.set)
+        try:
+            while True:
+                # Step 1: A full scan (at start and as a safety net), then whatever inotify reports
+                for name in await asyncio.to_thread(self._settled_files):
+                    item = await self._spool(name)
+                    if item is not None:
+                        yield item
+                interval = INGEST_RESCAN_INTERVAL if inotify is not None else INGEST_POLL_INTERVAL
+                deadline = time.monotonic() + interval
+                while inotify is not None and time.monotonic() < deadline:
+                    try:
+                        await asyncio.wait_for(woken.wait(), timeout=deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        break
+                    woken.clear()
+                    for name in dict.fromkeys(inotify.read_names()):
+                        item = await self._spool(name)
+                        if item is not None:
+                            yield item
+                if inotify is None:
+                    await asyncio.sleep(interval)
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fd)
+                inotify.close()
+
+    def _settled_files(self) -> List[str]:
+        now = time.time()
+        names = []
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime >= INGEST_SETTLE_SECONDS:
+                    names.append(entry.name)
+            except OSError:
+                # Removed since the listing
+                continue
+        return sorted(names)
+
+    async def _spool(self, name: str) -> Optional[IngestItem]:
+        if name.startswith(".") or name.lower().endswith(_PARTIAL_SUFFIXES):
+            return None
+        try:
+            return await asyncio.to_thread(self._spool_new, name)
+        except OSError as e:
+            # Deleted, renamed or unreadable since it was reported; a later scan or event picks it up if it is back
+            logger.warning(f"Skipping {name} in {self.path}: {str(e)}")
+            return None
+
+    def _spool_new(self, name: str) -> Optional[IngestItem]:
+        """Spool a file not ingested yet, or None if it already was. Blocking."""
+        path = os.path.join(self.path, name)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        key = f"{name}:{stat.st_size}:{stat.st_mtime_ns}"
+        if key in self._seen:
+            return None
+        item = _spool_file(path, name)
+        # Marked now so a failed file is not retried in a loop; it is retried by the next run
+        self._seen.add(key)
+        item.key = key
+        return item
+
+    async def done(self, item: IngestItem, processing_id: Optional[int]):
+        await asyncio.to_thread(self.state.mark_done, item.key, processing_id)
+
+class IngestionRunner:
+    """Feeds a source's items through the pipeline, at most INGEST_CONCURRENCY at a time
+
+    The next item is only read once a slot is free, so memory stays bounded however large
+    the source. An item that fails is not recorded as done and is retried by the next run.
+    """
+
+    def __init__(self, pipeline, concurrency: int = INGEST_CONCURRENCY):
+        self.pipeline = pipeline
+        self.concurrency = max(1, concurrency)
+
+    async def run(self, source) -> Dict[str, int]:
+        """Ingest a source until it is exhausted (watch folders: until cancelled); returns outcome counts"""
+        counts: Counter = Counter()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        items = source.items().__aiter__()
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    item = await items.__anext__()
+                except StopAsyncIteration:
+                    slots.release()
+                    break
+                task = asyncio.create_task(self._ingest(source, item, slots, counts))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await items.aclose()
+        logger.info(f"Ingestion of {source.name} finished: {dict(counts)}")
+        return dict(counts)
+
+    async def _ingest(self, source, item: IngestItem, slots: asyncio.Semaphore, counts: Counter):
+        try:
+            if item.upload is None:
+                logger.warning(f"Skipping {item.filename} from {source.name}: {item.skip_reason}")
+                await source.done(item, None)
+                counts["skipped"] += 1
+                return
+            with deadline_scope(INGEST_DEADLINE_SECONDS), timing_scope() as timer, timed_stage("total"):
+                try:
+                    response = await self.pipeline.run(item.upload, item.filename, {"source": source.name}, timer)
+                except Exception as e:
+                    logger.error(f"Ingesting {item.filename} from {source.name} failed: {str(e)}")
+                    documents_processed.labels(timer.file_type, timer.business_intent, "failed").inc()
+                    counts["failed"] += 1
+                    return
+            documents_processed.labels(timer.file_type, timer.business_intent, "completed").inc()
+            await source.done(item, response["processing_id"])
+            counts["ingested"] += 1
+        finally:
+            if item.upload is not None:
+                item.upload.close()
+            slots.release()
@@ -1,21 +1,32 @@
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, and_, or_, update
 from database import ProcessingResult, get_db, SessionLocal
+from services.retention import RetentionManager
+from services.storage_codec import storage_codec
 from typing import Dict, Any, List, Optional
+import asyncio
 import logging
 import json
+import time
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# Statuses of results the pipeline is done with; their lease is cleared
+TERMINAL_STATUSES = ("completed", "failed")
+
 class MemoryStore:
     def __init__(self):
         self.SessionLocal = SessionLocal
+        self.retention = RetentionManager()
+        self.codec = storage_codec
 
     async def store_processing_result(self, filename: str, file_type: str, business_intent: str, 
                                     status: str = "pending", metadata: Optional[Dict[str, Any]] = None,
                                     extracted_data: Optional[Dict[str, Any]] = None,
-                                    actions_taken: Optional[List[str]] = None) -> int:
+                                    actions_taken: Optional[List[str]] = None,
+                                    document_sha256: Optional[str] = None, lease_owner: Optional[str] = None,
+                                    lease_expires_at: Optional[float] = None) -> int:
         """Store a new processing result and return the ID"""
         try:
             db = self.SessionLocal()
@@ -25,10 +36,12 @@ class MemoryStore:
                 file_type=file_type,
                 business_intent=business_intent,
                 status=status,
-                processing_metadata=metadata or {},
-                extracted_data=extracted_data or {},
-                actions_taken=actions_taken or []
+                actions_taken=actions_taken or [],
+                document_sha256=document_sha256,
+                lease_owner=lease_owner,
+                lease_expires_at=lease_expires_at
             )
+            self.codec.pack(result, extracted_data or {}, metadata or {})
             
             db.add(result)
             db.commit()
@@ -50,8 +63,10 @@ class MemoryStore:
     async def update_processing_result(self, processing_id: int, status: Optional[str] = None,
                                      extracted_data: Optional[Dict[str, Any]] = None,
                                      metadata: Optional[Dict[str, Any]] = None,
-                                     actions_taken: Optional[List[str]] = None) -> bool:
-        """Update an existing processing result"""
+                                     actions_taken: Optional[List[str]] = None,
+                                     lease_owner: Optional[str] = None,
+                                     lease_expires_at: Optional[float] = None) -> bool:
+        """Update an existing processing result; passing a lease owner renews its lease"""
         try:
             db = self.SessionLocal()
             
@@ -66,17 +81,14 @@ class MemoryStore:
             if status is not None:
                 result.status = status
             
-            if extracted_data is not None:
-                # Merge with existing data
-                existing_data = result.extracted_data or {}
-                existing_data.update(extracted_data)
-                result.extracted_data = existing_data
-            
-            if metadata is not None:
-                # Merge with existing metadata
-                existing_metadata = result.processing_metadata or {}
-                existing_metadata.update(metadata)
-                result.processing_metadata = existing_metadata
+            if extracted_data is not None or metadata is not None:
+                # Merge with the existing data and metadata, then re-encode both
+                existing_data, existing_metadata = self.codec.unpack(result)
+                existing_data = dict(existing_data)
+                existing_data.update(extracted_data or {})
+                existing_metadata = dict(existing_metadata)
+                existing_metadata.update(metadata or {})
+                self.codec.pack(result, existing_data, existing_metadata)
             
             if actions_taken is not None:
                 # Append to existing actions
@@ -84,6 +96,13 @@ class MemoryStore:
                 existing_actions.extend(actions_taken)
                 result.actions_taken = list(set(existing_actions))  # Remove duplicates
             
+            if result.status in TERMINAL_STATUSES:
+                result.lease_owner = None
+                result.lease_expires_at = None
+            elif lease_owner is not None:
+                result.lease_owner = lease_owner
+                result.lease_expires_at = lease_expires_at
+            
             result.updated_at = datetime.utcnow()
             
             db.commit()
@@ -184,6 +203,66 @@ class MemoryStore:
                 db.close()
             return []
 
+    async def get_cluster_results(self, cluster_id: int, limit: int = 50) -> List[Dict[str, Any]]:
+        """Get the results in a near-duplicate cluster, oldest (the cluster's first) first"""
+        try:
+            db = self.SessionLocal()
+            
+            results = db.query(ProcessingResult).filter(
+                ProcessingResult.duplicate_cluster_id == cluster_id
+            ).order_by(ProcessingResult.id).limit(limit).all()
+            
+            results_list = [self._result_to_dict(result) for result in results]
+            db.close()
+            
+            return results_list
+            
+        except Exception as e:
+            logger.error(f"Error fetching results in cluster {cluster_id}: {str(e)}")
+            if 'db' in locals():
+                db.close()
+            return []
+
+    async def get_conversation_results(self, conversation_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Get the messages of an email conversation in the order they were received"""
+        try:
+            db = self.SessionLocal()
+            
+            results = db.query(ProcessingResult).filter(
+                ProcessingResult.conversation_id == conversation_id
+            ).order_by(ProcessingResult.id).limit(limit).all()
+            
+            results_list = [self._result_to_dict(result) for result in results]
+            db.close()
+            
+            return results_list
+            
+        except Exception as e:
+            logger.error(f"Error fetching results in conversation {conversation_id}: {str(e)}")
+            if 'db' in locals():
+                db.close()
+            return []
+
+    async def get_results_by_ids(self, processing_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Get several results at once, keyed by id; ids that no longer exist are left out"""
+        if not processing_ids:
+            return {}
+        try:
+            db = self.SessionLocal()
+
+            results = db.query(ProcessingResult).filter(ProcessingResult.id.in_(processing_ids)).all()
+
+            results_by_id = {result.id: self._result_to_dict(result) for result in results}
+            db.close()
+
+            return results_by_id
+
+        except Exception as e:
+            logger.error(f"Error fetching results {processing_ids}: {str(e)}")
+            if 'db' in locals():
+                db.close()
+            return {}
+
     async def get_flagged_results(self, flag_pattern: str = None, limit: int = 50) -> List[Dict[str, Any]]:
         """Get processing results that have specific flags"""
         try:
@@ -198,7 +277,8 @@ class MemoryStore:
                 all_results = query.order_by(ProcessingResult.created_at.desc()).limit(limit * 2).all()
                 
                 for result in all_results:
-                    metadata_str = json.dumps(result.metadata or {}).lower()
+                    _, metadata = self.codec.unpack(result)
+                    metadata_str = json.dumps(metadata).lower()
                     actions_str = json.dumps(result.actions_taken or []).lower()
                     
                     if flag_pattern.lower() in metadata_str or flag_pattern.lower() in actions_str:
@@ -220,6 +300,47 @@ class MemoryStore:
                 db.close()
             return []
 
+    async def claim_orphaned_results(self, owner: str, lease_expires_at: float, statuses: List[str],
+                                     stale_before: datetime, limit: int = 10) -> List[Dict[str, Any]]:
+        """Take over unfinished results whose lease has expired (or that never had one and went stale)"""
+        try:
+            db = self.SessionLocal()
+            now = time.time()
+            orphaned = or_(
+                ProcessingResult.lease_expires_at < now,
+                and_(ProcessingResult.lease_expires_at.is_(None), ProcessingResult.updated_at < stale_before)
+            )
+            candidates = db.query(ProcessingResult.id).filter(
+                ProcessingResult.status.in_(statuses), orphaned
+            ).order_by(ProcessingResult.id).limit(limit).all()
+            
+            claimed = []
+            for (processing_id,) in candidates:
+                # Only one worker's conditional update can win each row
+                won = db.execute(
+                    update(ProcessingResult)
+                    .where(ProcessingResult.id == processing_id, ProcessingResult.status.in_(statuses), orphaned)
+                    .values(lease_owner=owner, lease_expires_at=lease_expires_at)
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                db.commit()
+                if won:
+                    claimed.append(processing_id)
+            
+            results = []
+            if claimed:
+                results = db.query(ProcessingResult).filter(ProcessingResult.id.in_(claimed)).order_by(ProcessingResult.id).all()
+            results_list = [self._result_to_dict(result) for result in results]
+            db.close()
+            return results_list
+            
+        except Exception as e:
+            logger.error(f"Error claiming orphaned results: {str(e)}")
+            if 'db' in locals():
+                db.rollback()
+                db.close()
+            return []
+
     async def get_statistics(self) -> Dict[str, Any]:
         """Get processing statistics"""
         try:
@@ -250,7 +371,6 @@ class MemoryStore:
                 intent_counts[intent] = count
             
             # Recent activity (last 24 hours)
-            from datetime import datetime, timedelta
             yesterday = datetime.utcnow() - timedelta(days=1)
             recent_count = db.query(ProcessingResult).filter(
                 ProcessingResult.created_at >= yesterday
@@ -275,40 +395,39 @@ class MemoryStore:
             return {}
 
     def _result_to_dict(self, result: ProcessingResult) -> Dict[str, Any]:
-        """Convert SQLAlchemy result to dictionary"""
+        """Convert SQLAlchemy result to dictionary, decoding compressed data columns"""
+        extracted_data, metadata = self.codec.unpack(result)
         return {
             "id": result.id,
             "filename": result.filename,
             "file_type": result.file_type,
             "business_intent": result.business_intent,
             "status": result.status,
-            "extracted_data": result.extracted_data or {},
-            "metadata": result.processing_metadata or {},
+            "extracted_data": extracted_data,
+            "metadata": metadata,
             "actions_taken": result.actions_taken or [],
+            "document_sha256": result.document_sha256,
+            "duplicate_cluster_id": result.duplicate_cluster_id,
+            "conversation_id": result.conversation_id,
             "created_at": result.created_at.isoformat() if result.created_at else None,
             "updated_at": result.updated_at.isoformat() if result.updated_at else None
         }
 
     async def cleanup_old_results(self, days_old: int = 30) -> int:
-        """Clean up old processing results (for maintenance)"""
+        """Archive and remove results past retention (for maintenance), without one long DELETE"""
         try:
-            db = self.SessionLocal()
-            
-            cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-            
-            deleted_count = db.query(ProcessingResult).filter(
-                ProcessingResult.created_at < cutoff_date
-            ).delete()
-            
-            db.commit()
-            db.close()
-            
+            deleted_count = await asyncio.to_thread(self.retention.apply, days_old)
             logger.info(f"Cleaned up {deleted_count} old results")
             return deleted_count
             
         except Exception as e:
             logger.error(f"Error cleaning up old results: {str(e)}")
-            if 'db' in locals():
-                db.rollback()
-                db.close()
             return 0
+
+    async def get_archived_result(self, processing_id: int) -> Optional[Dict[str, Any]]:
+        """Get a result that has been moved to the archive by retention"""
+        try:
+            return await asyncio.to_thread(self.retention.reader.get_result, processing_id)
+        except Exception as e:
+            logger.error(f"Error reading archived result {processing_id}: {str(e)}")
+            return None
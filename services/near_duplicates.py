@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from database import ClusterAction, ProcessingResult, SessionLocal
+from utils.prompt_budget import strip_quoted_reply
+
+logger = logging.getLogger(__name__)
+
+# File types checked for near-duplicates before their agent runs
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "true").lower() in ("1", "true", "yes")
+NEAR_DUPLICATE_FILE_TYPES = tuple(os.getenv("NEAR_DUPLICATE_FILE_TYPES", "email,pdf").split(","))
+
+# Documents whose estimated word-shingle Jaccard similarity reaches this are near-duplicates
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+
+# Texts with fewer shingles than this give unreliable signatures and are never matched
+NEAR_DUPLICATE_MIN_SHINGLES = int(os.getenv("NEAR_DUPLICATE_MIN_SHINGLES", "20"))
+
+# How often a worker loads clusters started by other workers
+NEAR_DUPLICATE_REFRESH = float(os.getenv("NEAR_DUPLICATE_REFRESH", "10"))
+
+# Actions taken once per cluster rather than once per document
+CLUSTER_COLLAPSED_ACTIONS = ("crm_escalation",)
+
+# MinHash signature of SIGNATURE_SIZE 32-bit minimums. Its first BANDS * BAND_ROWS minimums are
+# banded for LSH, so documents 85% similar become candidates ~99% of the time (50% similar: ~6%).
+# Candidates are then checked on the full signature: with a 0.85 threshold, documents 90% similar
+# match ~99% of the time and 80% similar ~1-2%, 75% almost never (tests/test_near_duplicates.py)
+SIGNATURE_SIZE = 256
+BANDS = 16
+BAND_ROWS = 8
+SHINGLE_SIZE = 3
+
+# Band table additions kept in a dict before they are merged into the sorted arrays
+_MERGE_SIZE = 10000
+
+_WORD_PATTERN = re.compile(r"\w+")
+_HEADER_PATTERN = re.compile(r"^[\w-]+:\s")
+_SIGNATURE_FORMAT = f">{SIGNATURE_SIZE}I"
+_SIGNATURE_BYTES = struct.calcsize(_SIGNATURE_FORMAT)
+_EMPTY_BIN = 0xFFFFFFFF
+_POSITION_BITS = 24  # up to 16M clusters per worker
+_POSITION_MASK = (1 << _POSITION_BITS) - 1
+_KEY_MASK = (1 << (64 - _POSITION_BITS)) - 1
+
+def normalize_text(text: str) -> str:
+    """Lowercased words of a document without its header block, quoted replies and signature"""
+    lines = strip_quoted_reply(text).splitlines()
+    # Headers (sender, date, message id) differ between copies of the same message; keep the subject
+    header_end = 0
+    while header_end < len(lines) and _HEADER_PATTERN.match(lines[header_end]):
+        header_end += 1
+    kept = [line for line in lines[:header_end] if line.lower().startswith("subject:")] + lines[header_end:]
+    return " ".join(_WORD_PATTERN.findall("\n".join(kept).lower()))
+
+def minhash(text: str) -> Optional[bytes]:
+    """MinHash signature over word shingles of normalized text, or None if the text is too short"""
+    words = normalize_text(text).split()
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+    if len(shingles) < NEAR_DUPLICATE_MIN_SHINGLES:
+        return None
+    return shingle_signature(shingles)
+
+def shingle_signature(shingles) -> bytes:
+    """MinHash signature of a set of shingles
+
+    One-permutation hashing: each shingle is hashed once and its hash kept if it is the
+    smallest in its bin, so the cost is one hash per shingle rather than one per bin.
+    Bins no shingle fell into stay empty, which keeps short documents' estimates exact.
+    """
+    hashes = array("Q", b"".join(hashlib.blake2b(shingle.encode(), digest_size=8).digest() for shingle in shingles))
+    mins = [_EMPTY_BIN] * SIGNATURE_SIZE
+    for value in hashes:
+        # Low bits pick the bin, high bits are the value
+        bin_index = value % SIGNATURE_SIZE
+        value >>= 32
+        if value < mins[bin_index]:
+            mins[bin_index] = value
+    return struct.pack(_SIGNATURE_FORMAT, *mins)
+
+def _densify(values: Tuple[int, ...]) -> Tuple[int, ...]:
+    """Fill empty bins for banding: an empty bin borrows from the next filled one round the ring,
+    shifted by the distance, so documents with few shingles still agree bin by bin"""
+    if _EMPTY_BIN not in values:
+        return values
+    densified = list(values)
+    source = None
+    # Walking the ring twice backwards finds every bin's next filled one in a single pass
+    for step in range(2 * SIGNATURE_SIZE - 1, -1, -1):
+        index = step % SIGNATURE_SIZE
+        if values[index] != _EMPTY_BIN:
+            source = step
+        elif source is not None and step < SIGNATURE_SIZE:
+            offset = source - step
+            densified[index] = (values[source % SIGNATURE_SIZE] + offset * 0x9E3779B1) & 0xFFFFFFFF
+    return tuple(densified)
+
+def _band_keys(values: Tuple[int, ...]) -> List[int]:
+    values = _densify(values)
+    # Tuples of ints hash the same in every process
+    return [hash(values[band * BAND_ROWS:(band + 1) * BAND_ROWS]) & _KEY_MASK for band in range(BANDS)]
+
+def estimate_similarity(values: Tuple[int, ...], other: Tuple[int, ...]) -> float:
+    """Jaccard similarity from two full signatures: the share of bins filled in either that agree"""
+    matched = filled = 0
+    for value, other_value in zip(values, other):
+        if value != _EMPTY_BIN or other_value != _EMPTY_BIN:
+            filled += 1
+            matched += value == other_value
+    return matched / filled if filled else 0.0
+
+def is_candidate(values: Tuple[int, ...], other: Tuple[int, ...]) -> bool:
+    """Whether two signatures share an LSH band, i.e. whether an index lookup would find one from the other"""
+    return any(key == other_key for key, other_key in zip(_band_keys(values), _band_keys(other)))
+
+class _BandTable:
+    """Band keys of one LSH band in a sorted array, plus recent additions not merged in yet
+
+    Each entry packs a 40-bit band key above a 24-bit position, so the table is one flat
+    array and merging is a sort of two sorted runs.
+    """
+
+    def __init__(self):
+        self.entries = array("Q")
+        self.recent: Dict[int, List[int]] = {}
+        self.merging: Dict[int, List[int]] = {}
+        self.recent_count = 0
+
+    def add(self, key: int, position: int):
+        self.recent.setdefault(key, []).append(position)
+        self.recent_count += 1
+
+    def lookup(self, key: int) -> List[int]:
+        positions = self.recent.get(key, []) + self.merging.get(key, [])
+        index = bisect_left(self.entries, key << _POSITION_BITS)
+        while index < len(self.entries) and self.entries[index] >> _POSITION_BITS == key:
+            positions.append(self.entries[index] & _POSITION_MASK)
+            index += 1
+        return positions
+
+    def merge(self, lock: threading.Lock):
+        """Fold recent additions into the sorted array without holding the lock while sorting"""
+        with lock:
+            self.merging, self.recent = self.recent, {}
+            self.recent_count = 0
+            entries, merging = self.entries, self.merging
+        added = [key << _POSITION_BITS | position for key, positions in merging.items() for position in positions]
+        # Timsort finds the two sorted runs, so this is close to linear
+        merged = array("Q", sorted(chain(entries, sorted(added))))
+        with lock:
+            self.entries, self.merging = merged, {}
+
+class NearDuplicateIndex:
+    """In-memory MinHash LSH index over the first document of every near-duplicate cluster
+
+    A lookup binary-searches one sorted array per band, then checks the few candidates sharing
+    a band against their full signatures, loaded from the database by primary key. Only band
+    keys are kept in memory, about 140 bytes per cluster. Only the first document of a cluster
+    is indexed, which keeps it small however large a duplicate campaign gets. The database is
+    the source of truth: each worker loads clusters other workers started every NEAR_DUPLICATE_REFRESH.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD, enabled: bool = NEAR_DUPLICATE_ENABLED):
+        self.threshold = threshold
+        self.enabled = enabled
+        # Cluster ids; band tables hold positions in this array
+        self._cluster_ids = array("q")
+        self._bands = [_BandTable() for _ in range(BANDS)]
+        self._indexed = set()
+        self._dropped = set()
+        self._loaded_id = 0
+        self._refreshed_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def applies(self, file_type: str) -> bool:
+        """Whether documents of a file type are checked for near-duplicates"""
+        return self.enabled and file_type in NEAR_DUPLICATE_FILE_TYPES
+
+    def __len__(self) -> int:
+        return len(self._indexed) - len(self._dropped)
+
+    async def find(self, signature: bytes) -> Optional[Tuple[int, float]]:
+        """(cluster_id, similarity) of the most similar indexed cluster above the threshold, or None"""
+        self.schedule_refresh()
+        values = struct.unpack(_SIGNATURE_FORMAT, signature)
+        with self._lock:
+            positions = set()
+            for table, key in zip(self._bands, _band_keys(values)):
+                positions.update(table.lookup(key))
+            candidates = {self._cluster_ids[position] for position in positions} - self._dropped
+        if not candidates:
+            return None
+
+        best = None
+        for cluster_id, other in (await asyncio.to_thread(self._load_signatures, candidates)).items():
+            similarity = estimate_similarity(values, struct.unpack(_SIGNATURE_FORMAT, other))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (cluster_id, similarity)
+        return best
+
+    def _load_signatures(self, cluster_ids) -> Dict[int, bytes]:
+        db = SessionLocal()
+        try:
+            rows = db.query(ProcessingResult.id, ProcessingResult.minhash).filter(
+                ProcessingResult.id.in_(list(cluster_ids))
+            ).all()
+        finally:
+            db.close()
+        return {row_id: signature for row_id, signature in rows if signature and len(signature) == _SIGNATURE_BYTES}
+
+    def add(self, cluster_id: int, signature: bytes):
+        """Index the first document of a new cluster"""
+        values = struct.unpack(_SIGNATURE_FORMAT, signature)
+        keys = _band_keys(values)
+        with self._lock:
+            # Clusters this worker started come back in the next refresh
+            if cluster_id in self._indexed:
+                return
+            self._indexed.add(cluster_id)
+            position = len(self._cluster_ids)
+            self._cluster_ids.append(cluster_id)
+            for table, key in zip(self._bands, keys):
+                table.add(key, position)
+
+    def drop(self, cluster_id: int):
+        """Stop matching a cluster whose first result is gone (e.g. removed by retention)"""
+        with self._lock:
+            self._dropped.add(cluster_id)
+
+    def register(self, processing_id: int, signature: bytes, cluster_id: Optional[int] = None):
+        """Record a result's signature and cluster; without a cluster it starts a new one. Blocking."""
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(ProcessingResult).where(ProcessingResult.id == processing_id).values(
+                    minhash=signature, duplicate_cluster_id=cluster_id or processing_id
+                ).execution_options(synchronize_session=False)
+            )
+            db.commit()
+        finally:
+            db.close()
+        if cluster_id is None:
+            self.add(processing_id, signature)
+
+    def refresh(self):
+        """Load cluster representatives recorded since the last refresh. Blocking."""
+        # Ids committed out of order by other workers can be passed over; such a cluster just
+        # is not matched by this worker, and its duplicates start a cluster of their own
+        loaded = 0
+        while True:
+            db = SessionLocal()
+            try:
+                rows = db.query(ProcessingResult.id, ProcessingResult.minhash).filter(
+                    ProcessingResult.id > self._loaded_id,
+                    ProcessingResult.duplicate_cluster_id == ProcessingResult.id,
+                    ProcessingResult.minhash.isnot(None)
+                ).order_by(ProcessingResult.id).limit(10000).all()
+            finally:
+                db.close()
+            if not rows:
+                break
+            for row_id, signature in rows:
+                # Signatures from before SIGNATURE_SIZE changed are not comparable; their clusters get no new members
+                if len(signature) == _SIGNATURE_BYTES:
+                    self.add(row_id, signature)
+            self._loaded_id = rows[-1][0]
+            loaded += len(rows)
+        for table in self._bands:
+            if table.recent_count >= _MERGE_SIZE:
+                table.merge(self._lock)
+        if loaded:
+            logger.info(f"Loaded {loaded} near-duplicate clusters ({len(self)} indexed)")
+
+    def schedule_refresh(self, force: bool = False):
+        """Refresh in a background thread when due; lookups never wait for the database"""
+        now = time.monotonic()
+        if self._refreshing or (not force and now - self._refreshed_at < NEAR_DUPLICATE_REFRESH):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refreshing = True
+        self._refreshed_at = now
+        loop.create_task(self._refresh_async())
+
+    async def _refresh_async(self):
+        try:
+            await asyncio.to_thread(self.refresh)
+        except Exception as e:
+            logger.error(f"Error refreshing near-duplicate index: {str(e)}")
+        finally:
+            self._refreshing = False
+
+    async def claim_action(self, cluster_id: int, action: str, processing_id: int) -> bool:
+        """Claim an action for a whole cluster; False if another result of the cluster already took it"""
+        def _claim() -> bool:
+            db = SessionLocal()
+            try:
+                db.add(ClusterAction(cluster_id=cluster_id, action=action, processing_id=processing_id))
+                db.commit()
+                return True
+            except IntegrityError:
+                db.rollback()
+                # A resumed result keeps the claim it made before its worker died
+                holder = db.query(ClusterAction.processing_id).filter(
+                    ClusterAction.cluster_id == cluster_id, ClusterAction.action == action
+                ).scalar()
+                return holder == processing_id
+            finally:
+                db.close()
+        return await asyncio.to_thread(_claim)
+
+    async def release_action(self, cluster_id: int, action: str, processing_id: int):
+        """Give back a claim whose action failed, so the next result of the cluster retries it"""
+        def _release():
+            db = SessionLocal()
+            try:
+                db.query(ClusterAction).filter(
+                    ClusterAction.cluster_id == cluster_id, ClusterAction.action == action,
+                    ClusterAction.processing_id == processing_id
+                ).delete(synchronize_session=False)
+                db.commit()
+            finally:
+                db.close()
+        await asyncio.to_thread(_release)
+
+# Global near-duplicate index instance
+near_duplicate_index = NearDuplicateIndex()
@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from services.near_duplicates import minhash
+from services.similarity import embed, quantize
+from utils.deadline import deadline_scope
+from utils.metrics import documents_processed
+from utils.profiling import tag_profile
+from utils.timing import StageTimer, get_stage_timer, timed_stage, timing_scope
+from utils.upload_spool import SpooledUpload
+
+logger = logging.getLogger(__name__)
+
+# Result statuses doubling as stage checkpoints: the classification is stored with STATUS_CLASSIFIED,
+# the agent result with STATUS_EXTRACTED, and actions_taken with STATUS_COMPLETED
+STATUS_CLASSIFIED = "processing"
+STATUS_EXTRACTED = "processed"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+# How long a worker owns an unfinished result without checkpointing; must exceed the longest stage
+PIPELINE_LEASE_TTL = float(os.getenv("PIPELINE_LEASE_TTL", "120"))
+
+# How often each worker looks for results orphaned by a crashed worker, and how many it takes at once
+RECOVERY_INTERVAL = float(os.getenv("RECOVERY_INTERVAL", "60"))
+RECOVERY_BATCH_SIZE = int(os.getenv("RECOVERY_BATCH_SIZE", "10"))
+
+# Unfinished results from before leases existed count as orphaned once untouched this long
+RECOVERY_STALE_SECONDS = float(os.getenv("RECOVERY_STALE_SECONDS", "600"))
+
+# Resume attempts before a result that keeps taking its worker down is marked failed
+RECOVERY_MAX_ATTEMPTS = int(os.getenv("RECOVERY_MAX_ATTEMPTS", "3"))
+
+# Deadline and scheduler priority of a resumed result (below every fresh upload)
+RECOVERY_DEADLINE_SECONDS = float(os.getenv("RECOVERY_DEADLINE_SECONDS", "120"))
+RECOVERY_PRIORITY = 0.0
+
+# Metadata keys written by the pipeline itself rather than by the classifier
+PIPELINE_METADATA_KEYS = ("scheduling", "flags", "recovery", "near_duplicate", "stage_timings_ms", "stage_counts")
+
+class DocumentPipeline:
+    """Classification, agent and action routing for one document, checkpointed after every stage
+
+    The worker running a document holds a lease on its result row and renews it at each
+    checkpoint; if the worker dies, RecoverySweeper resumes the row from its last checkpoint.
+    """
+
+    def __init__(self, memory_store, classifier_agent, agent_dispatcher, action_router, document_store,
+                 near_duplicates, similarity, conversations, owner: str):
+        self.memory_store = memory_store
+        self.classifier_agent = classifier_agent
+        self.agent_dispatcher = agent_dispatcher
+        self.action_router = action_router
+        self.document_store = document_store
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.conversations = conversations
+        self.owner = owner
+
+    def _lease_expiry(self) -> float:
+        return time.time() + PIPELINE_LEASE_TTL
+
+    async def run(self, upload: SpooledUpload, filename: str, scheduling: Dict[str, Any],
+                  timer: StageTimer) -> Dict[str, Any]:
+        """Run a spooled upload through every stage; returns the upload response fields"""
+        # Step 1: Classify the file from its leading bytes
+        # Gemini calls are rate limited and circuit-broken inside the agents,
+        # which fall back to rule-based analysis instead of raising
+        with timed_stage("classify"):
+            classification_result = await self.classifier_agent.classify(
+                upload.path,
+                filename,
+                upload.head
+            )
+        timer.label(classification_result["file_type"], classification_result["business_intent"])
+
+        # Step 2: Keep the original (once per unique document) and checkpoint the classification
+        with timed_stage("document.store"):
+            document_sha256 = await self.document_store.store(upload)
+        with timed_stage("db.store"):
+            processing_id = await self.memory_store.store_processing_result(
+                filename=filename,
+                file_type=classification_result["file_type"],
+                business_intent=classification_result["business_intent"],
+                status=STATUS_CLASSIFIED,
+                metadata={**classification_result, "scheduling": scheduling},
+                document_sha256=document_sha256,
+                lease_owner=self.owner,
+                lease_expires_at=self._lease_expiry()
+            )
+        tag_profile(processing_id)
+
+        try:
+            # Steps 3-4: Agent, then checkpoint its result
+            agent_result = await self._run_agent(processing_id, upload, classification_result,
+                                                 {"scheduling": scheduling})
+
+            # Steps 5-6: Route actions and complete
+            actions_taken, timings = await self._route_and_complete(processing_id, classification_result,
+                                                                    agent_result, completed_actions=[])
+        except asyncio.CancelledError:
+            # The worker is going away; the lease runs out and another worker resumes the row
+            raise
+        except Exception as e:
+            await self._fail(processing_id, e)
+            raise
+
+        return {
+            "processing_id": processing_id,
+            "classification": classification_result,
+            "agent_result": agent_result,
+            "actions_taken": actions_taken,
+            "scheduling": scheduling,
+            **timings
+        }
+
+    async def resume(self, result: Dict[str, Any]) -> List[str]:
+        """Finish a result orphaned by another worker, from its last checkpoint; returns its actions"""
+        processing_id = result["id"]
+        metadata = result["metadata"]
+        classification = {key: value for key, value in metadata.items() if key not in PIPELINE_METADATA_KEYS}
+        classification.update(file_type=result["file_type"], business_intent=result["business_intent"])
+        recovery = {
+            "resumed_from": result["status"],
+            "worker": self.owner,
+            "attempts": metadata.get("recovery", {}).get("attempts", 0) + 1,
+            "resumed_at": datetime.utcnow().isoformat()
+        }
+
+        if recovery["attempts"] > RECOVERY_MAX_ATTEMPTS:
+            await self._fail(processing_id, RuntimeError(f"gave up after {RECOVERY_MAX_ATTEMPTS} resume attempts"))
+            return []
+        # Count the attempt before running it, so a document that crashes workers is eventually given up on
+        await self.memory_store.update_processing_result(
+            processing_id, metadata={"recovery": recovery},
+            lease_owner=self.owner, lease_expires_at=self._lease_expiry()
+        )
+
+        try:
+            if result["status"] == STATUS_CLASSIFIED:
+                # The agent never finished: run it again on the stored original
+                if not result.get("document_sha256"):
+                    raise RuntimeError("original document not stored, cannot re-run the agent")
+                upload = await asyncio.to_thread(self.document_store.to_upload, result["document_sha256"],
+                                                 result["filename"])
+                try:
+                    agent_result = await self._run_agent(processing_id, upload, classification, {})
+                finally:
+                    upload.close()
+            else:
+                # The agent result is checkpointed; only routing is left
+                agent_result = {
+                    "extracted_data": result["extracted_data"],
+                    "metadata": metadata,
+                    "flags": metadata.get("flags", [])
+                }
+
+            # Actions recorded by the crashed worker are not executed twice
+            actions_taken, _ = await self._route_and_complete(
+                processing_id, classification, agent_result,
+                completed_actions=result.get("actions_taken") or [], extra_metadata={"recovery": recovery}
+            )
+        except Exception as e:
+            await self._fail(processing_id, e)
+            raise
+        logger.info(f"Resumed processing result {processing_id} from {result['status']}")
+        return actions_taken
+
+    async def _run_agent(self, processing_id: int, upload: SpooledUpload, classification: Dict[str, Any],
+                         extra_metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Step 3: Route to the agent registered for this format, unless the document
+        # is a near-duplicate of one already analysed
+        file_type = classification["file_type"]
+        near_duplicate: Dict[str, Any] = {}
+
+        async def inspect_text(text: str) -> Optional[Dict[str, Any]]:
+            if self.similarity.enabled:
+                await self._index_similarity(processing_id, text)
+            if not self.near_duplicates.applies(file_type):
+                return None
+            return await self._match_duplicate(processing_id, classification, text, near_duplicate)
+
+        # Emails are analysed against their conversation's running state, not their quoted history
+        context = None
+        if self.conversations.applies(file_type):
+            with timed_stage("conversation"):
+                conversation = await self.conversations.resolve(processing_id, upload.read_text())
+            if conversation is not None:
+                context = {"conversation": conversation}
+
+        with timed_stage("agent"):
+            agent_result = await self.agent_dispatcher.dispatch(
+                file_type,
+                upload,
+                classification,
+                inspect_text=inspect_text if self.similarity.enabled or self.near_duplicates.applies(file_type) else None,
+                context=context
+            )
+        if agent_result and near_duplicate:
+            agent_result["metadata"]["near_duplicate"] = near_duplicate
+        if agent_result and context is not None:
+            # Merged under a row lock, so replies processed at the same time all count
+            state = await self.conversations.record_analysis(context["conversation"]["id"], agent_result["extracted_data"])
+            if state is not None and "conversation" in agent_result["metadata"]:
+                agent_result["metadata"]["conversation"].update(
+                    {key: state[key] for key in ("message_count", "urgency", "tone", "sentiment", "key_concerns")}
+                )
+
+        # Step 4: Checkpoint the agent result
+        if agent_result:
+            with timed_stage("db.update"):
+                await self.memory_store.update_processing_result(
+                    processing_id,
+                    status=STATUS_EXTRACTED,
+                    extracted_data=agent_result["extracted_data"],
+                    # Flags are kept so routing can be resumed or re-run without the agent
+                    metadata={**classification, **agent_result["metadata"], "flags": agent_result.get("flags", []),
+                              **extra_metadata},
+                    lease_owner=self.owner,
+                    lease_expires_at=self._lease_expiry()
+                )
+        return agent_result
+
+    async def _index_similarity(self, processing_id: int, text: str):
+        """Embed a document's text and add it to the similarity index"""
+        with timed_stage("similarity"):
+            vector = await asyncio.to_thread(embed, text)
+            if vector is None:
+                return
+            try:
+                await asyncio.to_thread(self.similarity.register, processing_id, quantize(vector))
+            except Exception as e:
+                # Similarity search is a convenience; never fail the document over it
+                logger.warning(f"Could not index result {processing_id} for similarity search: {str(e)}")
+
+    async def _match_duplicate(self, processing_id: int, classification: Dict[str, Any], text: str,
+                               near_duplicate: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Put a document in its near-duplicate cluster; returns the earlier agent result to reuse, if any"""
+        with timed_stage("near_duplicate"):
+            # Shingling a long document takes milliseconds; keep it off the event loop
+            signature = await asyncio.to_thread(minhash, text)
+            if signature is None:
+                return None
+            match = await self.near_duplicates.find(signature)
+            # A resumed document may find the cluster it started itself
+            if match is not None and match[0] == processing_id:
+                match = None
+            earlier = await self.memory_store.get_result(match[0]) if match is not None else None
+            if match is not None and earlier is None:
+                # The cluster's first result is gone; this document starts a new cluster
+                self.near_duplicates.drop(match[0])
+                match = None
+
+            cluster_id = match[0] if match is not None else None
+            await asyncio.to_thread(self.near_duplicates.register, processing_id, signature, cluster_id)
+            near_duplicate["cluster_id"] = cluster_id or processing_id
+            if match is None:
+                return None
+            near_duplicate["similarity"] = round(match[1], 3)
+
+            # Only a finished analysis of the same format that did not fall back is worth reusing
+            earlier_metadata = earlier["metadata"]
+            if (earlier["status"] not in (STATUS_EXTRACTED, STATUS_COMPLETED)
+                    or earlier["file_type"] != classification["file_type"]
+                    or earlier_metadata.get("ai_fallback_reason") or earlier_metadata.get("fallback_used")):
+                return None
+            near_duplicate["reused_result"] = earlier["id"]
+            logger.info(f"Processing result {processing_id} reuses near-duplicate result {earlier['id']}")
+            return {
+                "extracted_data": earlier["extracted_data"],
+                "metadata": {key: value for key, value in earlier_metadata.items()
+                             if key not in classification and key not in PIPELINE_METADATA_KEYS},
+                "flags": earlier_metadata.get("flags", [])
+            }
+
+    async def _route_and_complete(self, processing_id: int, classification: Dict[str, Any],
+                                  agent_result: Optional[Dict[str, Any]], completed_actions: List[str],
+                                  extra_metadata: Optional[Dict[str, Any]] = None) -> Tuple[List[str], Dict[str, Any]]:
+        # Step 5: Route actions
+        with timed_stage("route_actions"):
+            actions_taken = await self.action_router.route_actions(
+                classification,
+                agent_result if agent_result else {},
+                processing_id,
+                completed_actions=completed_actions
+            )
+
+        # Step 6: Final update with actions and the stage timings so far; clears the lease
+        timer = get_stage_timer()
+        timings = timer.as_metadata() if timer is not None else {}
+        with timed_stage("db.complete"):
+            await self.memory_store.update_processing_result(
+                processing_id,
+                status=STATUS_COMPLETED,
+                actions_taken=actions_taken,
+                metadata={**timings, **(extra_metadata or {})}
+            )
+        return actions_taken, timings
+
+    async def _fail(self, processing_id: int, error: Exception):
+        """Mark a result failed (clearing its lease) so nobody resumes it"""
+        logger.error(f"Processing result {processing_id} failed: {str(error)}")
+        try:
+            await self.memory_store.update_processing_result(
+                processing_id, status=STATUS_FAILED, metadata={"error": str(error)}
+            )
+        except Exception as e:
+            # The lease still runs out, so the sweeper retries the result instead
+            logger.error(f"Error marking result {processing_id} failed: {str(e)}")
+
+class RecoverySweeper:
+    """Per-worker background task resuming results whose worker died mid-pipeline
+
+    Runs once at startup and then every RECOVERY_INTERVAL. A result is claimed through a
+    conditional update of its lease, so with several workers sweeping each one is resumed once.
+    """
+
+    def __init__(self, pipeline: DocumentPipeline, scheduler):
+        self.pipeline = pipeline
+        self.scheduler = scheduler
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Recovery sweep failed: {str(e)}")
+            await asyncio.sleep(RECOVERY_INTERVAL)
+
+    async def sweep(self) -> int:
+        """Claim and resume orphaned results until none are left; returns how many were resumed"""
+        resumed = 0
+        while True:
+            claimed = await self.pipeline.memory_store.claim_orphaned_results(
+                owner=self.pipeline.owner,
+                lease_expires_at=time.time() + PIPELINE_LEASE_TTL,
+                statuses=[STATUS_CLASSIFIED, STATUS_EXTRACTED],
+                stale_before=datetime.utcnow() - timedelta(seconds=RECOVERY_STALE_SECONDS),
+                limit=RECOVERY_BATCH_SIZE
+            )
+            if not claimed:
+                return resumed
+            logger.info(f"Resuming {len(claimed)} orphaned results")
+            outcomes = await asyncio.gather(*(self._resume(result) for result in claimed), return_exceptions=True)
+            resumed += sum(1 for outcome in outcomes if not isinstance(outcome, BaseException))
+
+    async def _resume(self, result: Dict[str, Any]):
+        # Resumed documents queue behind fresh uploads for a pipeline slot
+        with deadline_scope(RECOVERY_DEADLINE_SECONDS), timing_scope() as timer:
+            timer.label(result["file_type"], result["business_intent"])
+            async with self.scheduler.slot(RECOVERY_PRIORITY):
+                await self.pipeline.resume(result)
+        documents_processed.labels(result["file_type"], result["business_intent"], "recovered").inc()
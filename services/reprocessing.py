@@ -0,0 +1,441 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import uuid
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from sqlalchemy import update
+from database import ProcessingResult, ReprocessingJob, SessionLocal
+from services.document_store import document_store
+from services.storage_codec import storage_codec
+
+logger = logging.getLogger(__name__)
+
+# Stages a reprocessing run can start from; each also re-runs the stages after it
+STAGE_CLASSIFY = "classify"
+STAGE_AGENT = "agent"
+STAGE_ROUTING = "routing"
+STAGES = (STAGE_CLASSIFY, STAGE_AGENT, STAGE_ROUTING)
+
+# Gemini budget of a reprocessing run, shared by its worker processes (separate from the live quota)
+REPROCESS_GEMINI_RPM = float(os.getenv("REPROCESS_GEMINI_RPM", "30"))
+
+# Longest a reprocessing call waits for the rate limit before the agent falls back to rules
+REPROCESS_RATE_LIMIT_MAX_WAIT = float(os.getenv("REPROCESS_RATE_LIMIT_MAX_WAIT", "600"))
+
+# Diff reports (<job id>.ndjson per result, <job id>.json summary)
+REPROCESS_REPORT_DIR = os.getenv("REPROCESS_REPORT_DIR", "./reports")
+
+# Results per task handed to a worker process, and results a worker processes at once
+REPROCESS_CHUNK_SIZE = int(os.getenv("REPROCESS_CHUNK_SIZE", "50"))
+REPROCESS_CONCURRENCY = int(os.getenv("REPROCESS_CONCURRENCY", "8"))
+
+def new_job_id() -> str:
+    return f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+def _fallback_reason(classification: Optional[Dict[str, Any]], agent_result: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Why a re-run used the rule-based fallback instead of the model, if it did"""
+    if classification and classification.get("fallback_reason"):
+        return f"classifier: {classification['fallback_reason']}"
+    metadata = (agent_result or {}).get("metadata", {})
+    if metadata.get("ai_fallback_reason"):
+        return f"{metadata.get('processing_agent', 'agent')}: {metadata['ai_fallback_reason']}"
+    if metadata.get("fallback_used"):
+        return f"{metadata.get('processing_agent', 'agent')}: fallback processing"
+    return None
+
+class _Reprocessor:
+    """Pipeline components of one worker process, driven by its own event loop"""
+
+    def __init__(self, gemini_rpm: float, concurrency: int):
+        # The worker pool already spreads work over processes; PDF extraction runs in threads here
+        os.environ.setdefault("AGENT_PDF_AGENT_EXECUTION", "thread")
+
+        from agents.classifier import ClassifierAgent
+        from agents.registry import default_registry
+        from services.action_router import ActionRouter
+        from services.agent_dispatcher import AgentDispatcher
+        from services.coordination import SharedTokenBucket
+        from utils import retry
+
+        # One budget for the whole run, whichever process makes the call; waiting for it is
+        # better than silently replacing model output with the rule-based fallback
+        retry.rate_limiters["gemini_api"] = SharedTokenBucket(
+            "gemini_api:reprocess", gemini_rpm / 60.0, capacity=max(1.0, gemini_rpm / 60.0)
+        )
+        retry.RATE_LIMIT_MAX_WAIT = REPROCESS_RATE_LIMIT_MAX_WAIT
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.classifier = ClassifierAgent()
+        self.dispatcher = AgentDispatcher(default_registry())
+        self.router = ActionRouter()
+        self.concurrency = concurrency
+
+    def run_chunk(self, ids: List[int], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return self.loop.run_until_complete(self._process_chunk(ids, options))
+
+    async def _process_chunk(self, ids: List[int], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # Step 1: Load the rows, then let go of the session while the pipeline runs
+        db = SessionLocal()
+        try:
+            rows = db.query(ProcessingResult).filter(ProcessingResult.id.in_(ids)).order_by(ProcessingResult.id).all()
+            db.expunge_all()
+        finally:
+            db.close()
+
+        # Step 2: Re-run the requested stages, a few rows at a time
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def guarded(row):
+            async with semaphore:
+                try:
+                    return await self._process_row(row, options)
+                except Exception as e:
+                    logger.error(f"Reprocessing result {row.id} failed: {str(e)}")
+                    return {"id": row.id, "outcome": "failed", "reason": str(e)}
+
+        outcomes = await asyncio.gather(*(guarded(row) for row in rows))
+
+        # Step 3: Write the changed rows back in one transaction
+        changes = [outcome.pop("values") for outcome in outcomes if "values" in outcome]
+        if changes and not options["dry_run"]:
+            db = SessionLocal()
+            try:
+                db.execute(update(ProcessingResult), changes)
+                db.commit()
+            finally:
+                db.close()
+        return outcomes
+
+    async def _process_row(self, row: ProcessingResult, options: Dict[str, Any]) -> Dict[str, Any]:
+        extracted_data, metadata = storage_codec.unpack(row)
+        stage = options["stage"]
+        before = {"file_type": row.file_type, "business_intent": row.business_intent,
+                  "actions": sorted(row.actions_taken or [])}
+
+        # Routing alone needs the agent's flags; results stored before they were kept need the agent again
+        reason = "original document not stored"
+        if stage == STAGE_ROUTING and "flags" not in metadata:
+            stage = STAGE_AGENT
+            reason = "agent flags not recorded and original document not stored"
+        if stage != STAGE_ROUTING and not row.document_sha256:
+            return {"id": row.id, "outcome": "skipped", "reason": reason, "before": before}
+
+        classification = {key: metadata[key] for key in ("confidence", "reasoning") if key in metadata}
+        classification.update(file_type=row.file_type, business_intent=row.business_intent)
+        agent_result = {"extracted_data": extracted_data, "metadata": metadata, "flags": metadata.get("flags", [])}
+        new_metadata = dict(metadata)
+        new_extracted_data = extracted_data
+
+        upload = None
+        try:
+            if stage != STAGE_ROUTING:
+                upload = await asyncio.to_thread(document_store.to_upload, row.document_sha256, row.filename)
+            if stage == STAGE_CLASSIFY:
+                classification = await self.classifier.classify(upload.path, row.filename, upload.head)
+                new_metadata.update(classification)
+            if stage in (STAGE_CLASSIFY, STAGE_AGENT):
+                agent_result = await self.dispatcher.dispatch(classification["file_type"], upload, classification)
+                if agent_result:
+                    new_metadata.update(agent_result["metadata"])
+                    new_metadata["flags"] = agent_result.get("flags", [])
+                    new_extracted_data = agent_result["extracted_data"]
+        finally:
+            if upload is not None:
+                upload.close()
+
+        fallback = None
+        if stage != STAGE_ROUTING:
+            fallback = _fallback_reason(classification if stage == STAGE_CLASSIFY else None, agent_result)
+        if fallback and not options["allow_fallback"]:
+            # Do not overwrite model output with rule-based guesses
+            return {"id": row.id, "outcome": "failed", "reason": f"fallback used ({fallback})", "before": before}
+
+        # Which actions the current rules call for; webhooks only fire for new ones when asked to
+        planned = self.router.plan_actions(classification, agent_result or {})
+        actions_taken = list(row.actions_taken or [])
+        if options["execute_actions"] and not options["dry_run"]:
+            context = self.router._build_decision_context(classification, agent_result or {})
+            for action_name in planned:
+                if action_name in actions_taken:
+                    continue
+                rule = self.router.routing_rules.get(action_name)
+                if rule is None or await self.router._execute_action(action_name, rule, context, row.id):
+                    actions_taken.append(action_name)
+
+        after = {"file_type": classification["file_type"], "business_intent": classification["business_intent"],
+                 "actions": sorted(set(planned))}
+        changed = (after["file_type"], after["business_intent"], after["actions"]) != \
+                  (before["file_type"], before["business_intent"], sorted(set(before["actions"])))
+
+        # New column values, written back with the rest of the chunk
+        new_metadata["reprocessing"] = {
+            "job_id": options["job_id"],
+            "stage": stage,
+            "planned_actions": planned,
+            "reprocessed_at": datetime.utcnow().isoformat()
+        }
+        target = SimpleNamespace(file_type=after["file_type"], business_intent=after["business_intent"])
+        values = {
+            "id": row.id,
+            "file_type": after["file_type"],
+            "business_intent": after["business_intent"],
+            "actions_taken": actions_taken,
+            "updated_at": datetime.utcnow(),
+            **storage_codec.columns(target, new_extracted_data, new_metadata)
+        }
+        return {"id": row.id, "outcome": "changed" if changed else "unchanged", "stage": stage,
+                "before": before, "after": after, "values": values}
+
+# Per-process state of pool workers
+_worker: Optional[_Reprocessor] = None
+
+def _init_worker(gemini_rpm: float, concurrency: int):
+    global _worker
+    logging.basicConfig(level=logging.WARNING)
+    _worker = _Reprocessor(gemini_rpm, concurrency)
+
+def _run_chunk(ids: List[int], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return _worker.run_chunk(ids, options)
+
+class ReprocessingRun:
+    """Re-runs stored results through the pipeline from a given stage, resumably, in a process pool
+
+    Results are selected in id order and handed to workers in chunks; the job's checkpoint is
+    the highest id below which every chunk has finished, so a crashed or interrupted run resumes
+    from there (finished chunks above it are redone). Outcomes go to an NDJSON diff report.
+    """
+
+    def __init__(self, params: Dict[str, Any], job_id: Optional[str] = None, workers: int = 2,
+                 concurrency: int = REPROCESS_CONCURRENCY, chunk_size: int = REPROCESS_CHUNK_SIZE,
+                 gemini_rpm: float = REPROCESS_GEMINI_RPM, report_dir: str = REPROCESS_REPORT_DIR):
+        if params["stage"] not in STAGES:
+            raise ValueError(f"Unknown stage: {params['stage']}")
+        self.params = params
+        self.job_id = job_id or new_job_id()
+        self.workers = workers
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.gemini_rpm = gemini_rpm
+        os.makedirs(report_dir, exist_ok=True)
+        self.report_path = os.path.join(report_dir, f"{self.job_id}.ndjson")
+        self.summary_path = os.path.join(report_dir, f"{self.job_id}.json")
+
+    @classmethod
+    def resume(cls, job_id: str, **kwargs) -> "ReprocessingRun":
+        """A run continuing an earlier job with its original parameters"""
+        db = SessionLocal()
+        try:
+            job = db.get(ReprocessingJob, job_id)
+        finally:
+            db.close()
+        if job is None:
+            raise ValueError(f"Unknown reprocessing job: {job_id}")
+        if job.status == "completed":
+            raise ValueError(f"Reprocessing job {job_id} already completed")
+        return cls(job.params, job_id=job_id, **kwargs)
+
+    def _query(self, db):
+        query = db.query(ProcessingResult.id)
+        params = self.params
+        if params.get("ids"):
+            query = query.filter(ProcessingResult.id.in_(params["ids"]))
+        if params.get("file_type"):
+            query = query.filter(ProcessingResult.file_type == params["file_type"])
+        if params.get("business_intent"):
+            query = query.filter(ProcessingResult.business_intent == params["business_intent"])
+        if params.get("status"):
+            query = query.filter(ProcessingResult.status == params["status"])
+        if params.get("since"):
+            query = query.filter(ProcessingResult.created_at >= datetime.fromisoformat(params["since"]))
+        if params.get("until"):
+            query = query.filter(ProcessingResult.created_at < datetime.fromisoformat(params["until"]))
+        return query
+
+    def _next_ids(self, after_id: int) -> List[int]:
+        db = SessionLocal()
+        try:
+            rows = self._query(db).filter(ProcessingResult.id > after_id).order_by(ProcessingResult.id) \
+                .limit(self.chunk_size).all()
+            return [row_id for (row_id,) in rows]
+        finally:
+            db.close()
+
+    def _load_job(self) -> ReprocessingJob:
+        db = SessionLocal()
+        try:
+            job = db.get(ReprocessingJob, self.job_id)
+            if job is None:
+                job = ReprocessingJob(id=self.job_id, params=self.params, status="running", checkpoint_id=0,
+                                      processed=0, changed=0, skipped=0, failed=0)
+                db.add(job)
+            else:
+                job.status = "running"
+            db.commit()
+            db.refresh(job)
+            db.expunge(job)
+            return job
+        finally:
+            db.close()
+
+    def _save_job(self, job: ReprocessingJob):
+        db = SessionLocal()
+        try:
+            db.merge(job)
+            db.commit()
+        finally:
+            db.close()
+
+    def run(self) -> Dict[str, Any]:
+        """Run (or continue) the job to completion; returns the summary. Blocking."""
+        job = self._load_job()
+        options = {
+            "job_id": self.job_id,
+            "stage": self.params["stage"],
+            "dry_run": self.params.get("dry_run", False),
+            "execute_actions": self.params.get("execute_actions", False),
+            "allow_fallback": self.params.get("allow_fallback", False)
+        }
+        logger.info(f"Reprocessing job {self.job_id} from stage {options['stage']}, after id {job.checkpoint_id}")
+
+        # spawn, not fork: workers build their own event loops, agents and connections
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.gemini_rpm, self.concurrency)
+        )
+        pending = {}
+        submitted = deque()  # last id of each chunk, in submission order
+        finished = set()
+        cursor = job.checkpoint_id
+        exhausted = False
+        try:
+            with open(self.report_path, "a") as report:
+                while True:
+                    # Step 1: Keep every worker busy with a chunk queued behind it
+                    while not exhausted and len(pending) < self.workers * 2:
+                        ids = self._next_ids(cursor)
+                        if not ids:
+                            exhausted = True
+                            break
+                        cursor = ids[-1]
+                        pending[executor.submit(_run_chunk, ids, options)] = ids
+                        submitted.append(ids[-1])
+                    if not pending:
+                        break
+
+                    # Step 2: Record finished chunks in the report and the job counters
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ids = pending.pop(future)
+                        try:
+                            outcomes = future.result()
+                        except BrokenProcessPool:
+                            raise
+                        except Exception as e:
+                            logger.error(f"Reprocessing chunk {ids[0]}-{ids[-1]} failed: {str(e)}")
+                            outcomes = [{"id": row_id, "outcome": "failed", "reason": str(e)} for row_id in ids]
+                        for outcome in outcomes:
+                            if outcome["outcome"] != "unchanged":
+                                report.write(json.dumps(outcome, default=str) + "\n")
+                            job.processed += 1
+                            job.changed += outcome["outcome"] == "changed"
+                            job.skipped += outcome["outcome"] == "skipped"
+                            job.failed += outcome["outcome"] == "failed"
+                        finished.add(ids[-1])
+
+                    # Step 3: Advance the checkpoint past every chunk finished in order
+                    report.flush()
+                    os.fsync(report.fileno())
+                    while submitted and submitted[0] in finished:
+                        job.checkpoint_id = submitted.popleft()
+                        finished.discard(job.checkpoint_id)
+                    self._save_job(job)
+                    logger.info(f"Job {self.job_id}: {job.processed} processed, {job.changed} changed, "
+                                f"{job.skipped} skipped, {job.failed} failed (checkpoint id {job.checkpoint_id})")
+            job.status = "completed"
+        except KeyboardInterrupt:
+            job.status = "interrupted"
+            raise
+        except BaseException:
+            job.status = "failed"
+            raise
+        finally:
+            executor.shutdown(wait=job.status == "completed", cancel_futures=True)
+            self._save_job(job)
+            logger.info(f"Reprocessing job {self.job_id} {job.status}")
+
+        summary = self.summarize(job)
+        with open(self.summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def summarize(self, job: ReprocessingJob) -> Dict[str, Any]:
+        """Job counters plus intent, file type and action changes from the report (last outcome per id)"""
+        outcomes: Dict[int, Dict[str, Any]] = {}
+        if os.path.exists(self.report_path):
+            with open(self.report_path) as report:
+                for line in report:
+                    if line.strip():
+                        outcome = json.loads(line)
+                        outcomes[outcome["id"]] = outcome
+
+        intent_changes, file_type_changes, actions_added, actions_removed, failures = (
+            Counter(), Counter(), Counter(), Counter(), Counter()
+        )
+        for outcome in outcomes.values():
+            if outcome["outcome"] != "changed":
+                if outcome["outcome"] == "failed":
+                    failures[outcome.get("reason", "")[:120]] += 1
+                continue
+            before, after = outcome["before"], outcome["after"]
+            if before["business_intent"] != after["business_intent"]:
+                intent_changes[f"{before['business_intent']} -> {after['business_intent']}"] += 1
+            if before["file_type"] != after["file_type"]:
+                file_type_changes[f"{before['file_type']} -> {after['file_type']}"] += 1
+            actions_added.update(set(after["actions"]) - set(before["actions"]))
+            actions_removed.update(set(before["actions"]) - set(after["actions"]))
+
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "params": job.params,
+            "processed": job.processed,
+            "changed": job.changed,
+            "skipped": job.skipped,
+            "failed": job.failed,
+            "business_intent_changes": dict(intent_changes.most_common()),
+            "file_type_changes": dict(file_type_changes.most_common()),
+            "actions_added": dict(actions_added.most_common()),
+            "actions_removed": dict(actions_removed.most_common()),
+            "failure_reasons": dict(failures.most_common(20)),
+            "report": self.report_path
+        }
+
+def list_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    """Recent reprocessing jobs, newest first"""
+    db = SessionLocal()
+    try:
+        jobs = db.query(ReprocessingJob).order_by(ReprocessingJob.created_at.desc()).limit(limit).all()
+        return [{
+            "id": job.id,
+            "status": job.status,
+            "stage": job.params.get("stage"),
+            "checkpoint_id": job.checkpoint_id,
+            "processed": job.processed,
+            "changed": job.changed,
+            "skipped": job.skipped,
+            "failed": job.failed,
+            "created_at": job.created_at.isoformat() if job.created_at else None,
+            "updated_at": job.updated_at.isoformat() if job.updated_at else None
+        } for job in jobs]
+    finally:
+        db.close()
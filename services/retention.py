@@ -0,0 +1,308 @@
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import column, delete, func, select, table, text
+from sqlalchemy.exc import OperationalError
+from database import (
+    ProcessingResult, engine, ensure_partitions, is_partitioned, list_partitions, add_months
+)
+from services.document_store import DocumentStore, document_store
+from services.storage_codec import storage_codec
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # optional: archives fall back to gzip
+    zstandard = None
+
+# Expired results are exported here before they are removed (set ARCHIVE_ENABLED=false to just delete)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "true").lower() in ("1", "true", "yes")
+ARCHIVE_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "9"))
+
+# Rows removed per transaction where partitions cannot be dropped, and the pause between chunks
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "5000"))
+RETENTION_CHUNK_PAUSE = float(os.getenv("RETENTION_CHUNK_PAUSE", "0.05"))
+
+# part-<first id>-<last id>-<unique>.ndjson.<zst|gz>, under <ARCHIVE_DIR>/<YYYY-MM>/
+_ARCHIVE_FILE = re.compile(r'^part-(\d+)-(\d+)-[0-9a-f]+\.ndjson\.(zst|gz)$')
+
+def _results_table(name: str):
+    """processing_results or one of its partitions, with the model's column types so JSON and dates decode"""
+    return table(name, *(column(col.name, col.type) for col in ProcessingResult.__table__.columns))
+
+def _row_to_dict(row) -> Dict[str, Any]:
+    """Archived form of a row, the same shape MemoryStore returns for results"""
+    extracted_data, metadata = storage_codec.unpack(row)
+    return {
+        "id": row.id,
+        "filename": row.filename,
+        "file_type": row.file_type,
+        "business_intent": row.business_intent,
+        "status": row.status,
+        "extracted_data": extracted_data,
+        "metadata": metadata,
+        "actions_taken": row.actions_taken or [],
+        "document_sha256": row.document_sha256,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None
+    }
+
+class ArchiveWriter:
+    """Writes one compressed NDJSON archive file; it only appears under its final name once fully synced"""
+
+    def __init__(self, archive_dir: str, month: str):
+        self.directory = os.path.join(archive_dir, month)
+        os.makedirs(self.directory, exist_ok=True)
+        self.extension = "zst" if zstandard is not None else "gz"
+        self.temp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        self._file = open(self.temp_path, "wb")
+        if zstandard is not None:
+            self._stream = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).stream_writer(self._file, closefd=False)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6)
+        self.count = 0
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+
+    def write(self, record: Dict[str, Any]):
+        self._stream.write(json.dumps(record, separators=(",", ":"), default=str).encode() + b"\n")
+        self.count += 1
+        self.first_id = record["id"] if self.first_id is None else min(self.first_id, record["id"])
+        self.last_id = record["id"] if self.last_id is None else max(self.last_id, record["id"])
+
+    def commit(self) -> Optional[str]:
+        """Flush, fsync and move the file into place; returns its path (None if nothing was written)"""
+        self._stream.close()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if not self.count:
+            os.remove(self.temp_path)
+            return None
+        path = os.path.join(
+            self.directory, f"part-{self.first_id}-{self.last_id}-{uuid.uuid4().hex[:8]}.ndjson.{self.extension}"
+        )
+        os.replace(self.temp_path, path)
+        return path
+
+    def abort(self):
+        try:
+            self._stream.close()
+            self._file.close()
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+class ArchiveReader:
+    """Read-only access to archived results, scanning only the months and id ranges that can match"""
+
+    def __init__(self, archive_dir: str = ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+
+    def months(self) -> List[str]:
+        """Archived months (YYYY-MM), oldest first"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(name for name in os.listdir(self.archive_dir) if re.match(r'^\d{4}-\d{2}$', name))
+
+    def _files(self, month: str) -> List[Tuple[int, int, str]]:
+        directory = os.path.join(self.archive_dir, month)
+        files = []
+        for name in os.listdir(directory):
+            match = _ARCHIVE_FILE.match(name)
+            if match:
+                files.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+        return sorted(files)
+
+    def _read(self, path: str) -> Iterator[Dict[str, Any]]:
+        with open(path, "rb") as raw:
+            if path.endswith(".zst"):
+                if zstandard is None:
+                    raise RuntimeError(f"zstandard is required to read {path}")
+                stream = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                stream = gzip.GzipFile(fileobj=raw, mode="rb")
+            for line in io.TextIOWrapper(stream, encoding="utf-8"):
+                if line.strip():
+                    yield json.loads(line)
+
+    def get_result(self, processing_id: int) -> Optional[Dict[str, Any]]:
+        """An archived result by id, or None"""
+        for month in reversed(self.months()):
+            for first_id, last_id, path in self._files(month):
+                if first_id <= processing_id <= last_id:
+                    for record in self._read(path):
+                        if record["id"] == processing_id:
+                            return record
+        return None
+
+    def iter_results(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     file_type: Optional[str] = None, business_intent: Optional[str] = None,
+                     status: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Archived results created in [start, end), optionally filtered, in archive order"""
+        first_month = start.strftime("%Y-%m") if start else None
+        last_month = end.strftime("%Y-%m") if end else None
+        start_iso = start.isoformat() if start else None
+        end_iso = end.isoformat() if end else None
+        seen = set()
+        for month in self.months():
+            if (first_month and month < first_month) or (last_month and month > last_month):
+                continue
+            for _, _, path in self._files(month):
+                for record in self._read(path):
+                    # An archive run interrupted before its delete committed re-exports the same rows
+                    if record["id"] in seen:
+                        continue
+                    seen.add(record["id"])
+                    created_at = record.get("created_at") or ""
+                    if (start_iso and created_at < start_iso) or (end_iso and created_at >= end_iso):
+                        continue
+                    if file_type and record.get("file_type") != file_type:
+                        continue
+                    if business_intent and record.get("business_intent") != business_intent:
+                        continue
+                    if status and record.get("status") != status:
+                        continue
+                    yield record
+
+class RetentionManager:
+    """Removes results past retention without long transactions, archiving them first
+
+    On a partitioned Postgres table whole months are archived and dropped once every row in
+    them has expired, so results may be kept up to a month past the retention period. Elsewhere
+    (SQLite, an unpartitioned table, the default partition) rows go in small committed chunks.
+    Original documents are released with their results and removed once nothing refers to them.
+    """
+
+    def __init__(self, archive_dir: str = ARCHIVE_DIR, archive: bool = ARCHIVE_ENABLED,
+                 chunk_size: int = RETENTION_CHUNK_SIZE, documents: DocumentStore = document_store):
+        self.archive_dir = archive_dir
+        self.archive = archive
+        self.chunk_size = chunk_size
+        self.documents = documents
+        self.reader = ArchiveReader(archive_dir)
+
+    def apply(self, days_old: int) -> int:
+        """One retention pass (blocking); returns the number of results removed"""
+        cutoff = datetime.utcnow() - timedelta(days=days_old)
+        removed = 0
+        with engine.connect() as connection:
+            partitioned = is_partitioned(connection)
+            if partitioned:
+                ensure_partitions(connection)
+                connection.commit()
+                removed += self._drop_expired_partitions(connection, cutoff)
+
+        # Partitioned tables only need this for strays in the default partition
+        table = "processing_results_default" if partitioned else "processing_results"
+        removed += self._delete_in_chunks(table, cutoff)
+        return removed
+
+    def _drop_expired_partitions(self, connection, cutoff: datetime) -> int:
+        removed = 0
+        for name, year, month in list_partitions(connection):
+            next_year, next_month = add_months(year, month, 1)
+            if datetime(next_year, next_month, 1) > cutoff:
+                break
+            partition = _results_table(name)
+            count = self._archive_table(connection, partition, f"{year:04d}-{month:02d}")
+            references = dict(connection.execute(
+                select(partition.c.document_sha256, func.count()).where(partition.c.document_sha256.isnot(None))
+                .group_by(partition.c.document_sha256)
+            ).all())
+            connection.commit()
+            try:
+                # DETACH briefly locks the parent; give up rather than queue behind long queries
+                with connection.begin():
+                    connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+                    connection.execute(text(f"ALTER TABLE processing_results DETACH PARTITION {name}"))
+                    connection.execute(text(f"DROP TABLE {name}"))
+            except OperationalError as e:
+                # Archived already; the next pass re-exports and retries (readers skip duplicate ids)
+                logger.warning(f"Could not drop partition {name}, retrying next pass: {str(e)}")
+                break
+            logger.info(f"Dropped partition {name} with {count} results")
+            self.documents.release(references)
+            removed += count
+        return removed
+
+    def _archive_table(self, connection, partition, month: str) -> int:
+        """Stream a whole partition into one archive file for its month; returns the row count"""
+        if not self.archive:
+            return connection.execute(select(func.count()).select_from(partition)).scalar()
+        writer = ArchiveWriter(self.archive_dir, month)
+        try:
+            result = connection.execution_options(stream_results=True, yield_per=1000).execute(
+                select(partition).order_by(partition.c.id)
+            )
+            for row in result:
+                writer.write(_row_to_dict(row))
+            path = writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        if path:
+            logger.info(f"Archived {writer.count} results to {path}")
+        return writer.count
+
+    def _delete_in_chunks(self, name: str, cutoff: datetime) -> int:
+        """Archive and delete expired rows oldest-first, one short transaction per chunk"""
+        results = _results_table(name)
+        removed = 0
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(
+                    select(results).where(results.c.created_at < cutoff).order_by(results.c.id).limit(self.chunk_size)
+                ).fetchall()
+                connection.commit()
+                if not rows:
+                    return removed
+
+                # The archive is on disk before the rows it holds are deleted
+                if self.archive:
+                    self._archive_rows(rows)
+                # Only rows this DELETE removed give up their document references: a reprocess or
+                # another maintenance pass may have deleted some of them since the SELECT
+                statement = delete(results).where(results.c.id.in_([row.id for row in rows]))
+                with connection.begin():
+                    if connection.dialect.delete_returning:
+                        deleted = connection.execute(statement.returning(results.c.id, results.c.document_sha256)).fetchall()
+                    else:
+                        deleted = connection.execute(
+                            select(results.c.id, results.c.document_sha256).where(results.c.id.in_([row.id for row in rows]))
+                        ).fetchall()
+                        connection.execute(statement)
+            self.documents.release(Counter(row.document_sha256 for row in deleted if row.document_sha256))
+            removed += len(deleted)
+            logger.info(f"Removed {len(deleted)} expired results from {name} ({removed} so far)")
+            if len(rows) < self.chunk_size:
+                return removed
+            # Let other writers in between chunks
+            time.sleep(RETENTION_CHUNK_PAUSE)
+
+    def _archive_rows(self, rows: List[Any]):
+        writers: Dict[str, ArchiveWriter] = {}
+        try:
+            for row in rows:
+                record = _row_to_dict(row)
+                month = (record["created_at"] or "0000-00")[:7]
+                writer = writers.get(month)
+                if writer is None:
+                    writer = writers.setdefault(month, ArchiveWriter(self.archive_dir, month))
+                writer.write(record)
+            for writer in writers.values():
+                writer.commit()
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
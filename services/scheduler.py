@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from agents.email_agent import (
+    ANGRY_TONE_KEYWORDS,
+    HIGH_URGENCY_KEYWORDS,
+    THREATENING_TONE_KEYWORDS,
+    URGENT_KEYWORDS,
+)
+from utils.deadline import with_deadline
+
+logger = logging.getLogger(__name__)
+
+# Uploads processed through the pipeline at once; the rest wait in priority order
+PIPELINE_MAX_CONCURRENCY = int(os.getenv("PIPELINE_MAX_CONCURRENCY", "16"))
+
+# Priority points a waiting upload gains per second, so low-priority work cannot starve
+SCHEDULER_AGING_PER_SECOND = float(os.getenv("SCHEDULER_AGING_PER_SECOND", "2.0"))
+
+# Leading bytes of an upload scanned for the pre-score
+PRESCORE_SCAN_BYTES = 8 * 1024
+
+# Amounts above this mark a document as high value (matches ActionRouter's risk_alert rule)
+HIGH_VALUE_THRESHOLD = 10000
+
+BASE_PRIORITY = 10.0
+
+# Filename hints for documents likely to end in an escalation or risk alert
+FILENAME_HINTS = {
+    "fraud": 40.0,
+    "complaint": 30.0,
+    "urgent": 30.0,
+    "legal": 25.0,
+    "invoice": 10.0,
+    "regulatory": 15.0,
+}
+
+# Sniffed formats that usually carry customer-facing content
+TYPE_WEIGHTS = {
+    "email": 5.0,
+    "pdf": 0.0,
+    "json": 0.0,
+}
+
+# Content keyword groups and their weights; only the best match per group counts
+KEYWORD_WEIGHTS: List[Tuple[List[str], float]] = [
+    (URGENT_KEYWORDS, 30.0),
+    (HIGH_URGENCY_KEYWORDS, 10.0),
+    (THREATENING_TONE_KEYWORDS, 30.0),
+    (ANGRY_TONE_KEYWORDS, 20.0),
+    (["fraud", "suspicious", "unauthorized"], 30.0),
+]
+
+HIGH_VALUE_WEIGHT = 25.0
+
+# Whole-word matching, so e.g. "sue" does not fire on "issue"
+_KEYWORD_PATTERNS = [
+    (re.compile(r'\b(' + "|".join(re.escape(word) for word in keywords) + r')\b'), weight)
+    for keywords, weight in KEYWORD_WEIGHTS
+]
+
+_AMOUNT_PATTERN = re.compile(r'\$\s?(\d{1,3}(?:,\d{3})+|\d+)(?:\.\d{2})?')
+
+def estimate_priority(filename: Optional[str], sniffed_type: Optional[str], head: bytes) -> Tuple[float, List[str]]:
+    """Cheap pre-score of an upload from its name, sniffed type and leading bytes"""
+    score = BASE_PRIORITY
+    reasons = []
+
+    name = (filename or "").lower()
+    for hint, weight in FILENAME_HINTS.items():
+        if hint in name:
+            score += weight
+            reasons.append(f"filename:{hint}")
+
+    score += TYPE_WEIGHTS.get(sniffed_type or "", 0.0)
+
+    text = head[:PRESCORE_SCAN_BYTES].decode("utf-8", errors="ignore").lower()
+    for pattern, weight in _KEYWORD_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            score += weight
+            reasons.append(f"keyword:{match.group(1)}")
+
+    for match in _AMOUNT_PATTERN.finditer(text):
+        if float(match.group(1).replace(",", "")) > HIGH_VALUE_THRESHOLD:
+            score += HIGH_VALUE_WEIGHT
+            reasons.append("high_value")
+            break
+
+    return score, reasons
+
+class PriorityScheduler:
+    """Admits uploads into the pipeline in priority order, with aging so low-priority work still runs"""
+
+    def __init__(self, max_concurrency: int = PIPELINE_MAX_CONCURRENCY,
+                 aging_per_second: float = SCHEDULER_AGING_PER_SECOND):
+        self.max_concurrency = max_concurrency
+        self.aging_per_second = aging_per_second
+        self._active = 0
+        self._waiting: List[Tuple[float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, priority: float):
+        """Wait for a pipeline slot; yields the seconds spent queued"""
+        queued_at = time.monotonic()
+        await self._acquire(priority, queued_at)
+        try:
+            yield time.monotonic() - queued_at
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: float, queued_at: float):
+        if self._active < self.max_concurrency and not self.queue_depth:
+            self._active += 1
+            return
+
+        # Effective priority is priority + aging * (now - queued_at). Ordering by
+        # priority - aging * queued_at gives the same order at any instant, so
+        # heap keys never need to be recomputed as entries age.
+        future = asyncio.get_running_loop().create_future()
+        sort_key = -(priority - self.aging_per_second * queued_at)
+        heapq.heappush(self._waiting, (sort_key, next(self._sequence), future))
+
+        try:
+            # Queueing counts against the upload deadline
+            await with_deadline(future)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # A slot handed over just as the waiter gave up must be passed on
+                self._release()
+            else:
+                future.cancel()
+            raise
+
+    def _release(self):
+        self._active -= 1
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        """Current occupancy of the pipeline"""
+        return {
+            "active": self._active,
+            "queued": self.queue_depth,
+            "max_concurrency": self.max_concurrency
+        }
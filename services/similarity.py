@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from typing import List, Optional, Tuple
+from sqlalchemy import update
+from database import ProcessingResult, SessionLocal
+from services.near_duplicates import normalize_text
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:  # optional: similarity search is disabled without it
+    np = None
+
+# Similarity search over processed documents ("find similar documents"); needs numpy
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Width of the hashed word n-gram embeddings, stored as int8 (one byte per dimension)
+SIMILARITY_DIMENSIONS = int(os.getenv("SIMILARITY_DIMENSIONS", "256"))
+
+# Only the start of long documents is embedded
+SIMILARITY_MAX_CHARS = int(os.getenv("SIMILARITY_MAX_CHARS", "20000"))
+
+# Below this many documents queries scan every vector; above it an IVF index is trained
+SIMILARITY_IVF_MIN_SIZE = int(os.getenv("SIMILARITY_IVF_MIN_SIZE", "20000"))
+
+# Inverted lists scanned per query (more is slower and more exact)
+SIMILARITY_NPROBE = int(os.getenv("SIMILARITY_NPROBE", "16"))
+
+# How often a worker loads documents embedded by other workers
+SIMILARITY_REFRESH = float(os.getenv("SIMILARITY_REFRESH", "10"))
+
+# Documents with fewer words than this are not embedded
+_MIN_WORDS = 5
+_QUANTIZE = 127
+_KMEANS_ITERATIONS = 8
+_KMEANS_SAMPLES_PER_LIST = 32
+_CHUNK_ROWS = 65536
+
+def embed(text: str, dimensions: int = SIMILARITY_DIMENSIONS) -> Optional["np.ndarray"]:
+    """Unit-length hashed word unigram and bigram embedding of a document, or None if it is too short"""
+    words = normalize_text(text[:SIMILARITY_MAX_CHARS]).split()
+    if len(words) < _MIN_WORDS:
+        return None
+    features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    # crc32 is stable across processes, unlike hash() on strings
+    hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+    vector = np.bincount(hashes % dimensions, weights=signs, minlength=dimensions)
+    # Sublinear term frequency, so a repeated word does not dominate
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return None
+    return (vector / norm).astype(np.float32)
+
+def quantize(vector: "np.ndarray") -> bytes:
+    """int8 bytes of a vector, as stored in the embedding column; scaled to use the full int8 range"""
+    scale = _QUANTIZE / max(float(np.abs(vector).max()), 1e-9)
+    return np.clip(np.rint(vector * scale), -_QUANTIZE, _QUANTIZE).astype(np.int8).tobytes()
+
+class SimilarityIndex:
+    """In-memory nearest-neighbour index over document embeddings
+
+    Vectors live in one growing int8 matrix. Small indexes are scanned whole; from
+    SIMILARITY_IVF_MIN_SIZE documents on, a background thread trains k-means centroids
+    (inverted file index) and a query only scans the SIMILARITY_NPROBE lists nearest to it,
+    re-training whenever the index has doubled. New documents are added as they are
+    processed; each worker loads documents embedded elsewhere every SIMILARITY_REFRESH.
+    """
+
+    def __init__(self, dimensions: int = SIMILARITY_DIMENSIONS, enabled: bool = SIMILARITY_ENABLED):
+        self.dimensions = dimensions
+        self.enabled = enabled and np is not None
+        if enabled and np is None:
+            logger.warning("numpy is not installed; similarity search is disabled")
+        self._size = 0
+        self._ids = array("q")
+        self._indexed = set()
+        if self.enabled:
+            self._vectors = np.zeros((1024, dimensions), dtype=np.int8)
+            self._norms = np.zeros(1024, dtype=np.float32)
+        # IVF structures: centroids and the rows in each centroid's inverted list
+        self._centroids = None
+        self._lists: List[array] = []
+        self._trained_size = 0
+        self._loaded_id = 0
+        self._refreshed_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, processing_id: int, embedding: bytes):
+        """Add a document's quantized embedding"""
+        vector = np.frombuffer(embedding, dtype=np.int8)
+        norm = float(np.linalg.norm(vector.astype(np.float32)))
+        if vector.shape[0] != self.dimensions or norm == 0:
+            return
+        with self._lock:
+            # Documents this worker embedded come back in the next refresh
+            if processing_id in self._indexed:
+                return
+            self._indexed.add(processing_id)
+            if self._size == self._vectors.shape[0]:
+                grown = np.zeros((self._size * 2, self.dimensions), dtype=np.int8)
+                grown[:self._size] = self._vectors[:self._size]
+                self._vectors = grown
+                self._norms = np.concatenate([self._norms, np.zeros(self._size, dtype=np.float32)])
+            self._vectors[self._size] = vector
+            self._norms[self._size] = norm
+            self._ids.append(processing_id)
+            if self._centroids is not None:
+                self._assign_row(self._size)
+            self._size += 1
+
+    def search(self, embedding: bytes, limit: int = 10, exclude: Optional[int] = None) -> List[Tuple[int, float]]:
+        """(processing_id, cosine similarity) of the documents nearest to an embedding, best first"""
+        self.schedule_refresh()
+        query = np.frombuffer(embedding, dtype=np.int8).astype(np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-9)
+        # One extra, in case the query document itself is among the best
+        count = limit + 1
+        with self._lock:
+            if self._size == 0:
+                return []
+            if self._centroids is None:
+                rows = np.arange(self._size)
+                scores = self._vectors[:self._size].astype(np.float32) @ query / self._norms[:self._size]
+            else:
+                nprobe = min(SIMILARITY_NPROBE, len(self._lists))
+                probed = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+                rows = np.concatenate([np.frombuffer(self._lists[index], dtype=np.int32) for index in probed])
+                scores = self._vectors[rows].astype(np.float32) @ query / self._norms[rows]
+            count = min(count, scores.shape[0])
+            if count == 0:
+                return []
+            best = np.argpartition(-scores, count - 1)[:count]
+            best = best[np.argsort(-scores[best])]
+            ranked = [(self._ids[int(rows[position])], float(scores[position])) for position in best]
+
+        return [(processing_id, round(score, 4)) for processing_id, score in ranked if processing_id != exclude][:limit]
+
+    def register(self, processing_id: int, embedding: bytes):
+        """Store a result's embedding and index it. Blocking."""
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(ProcessingResult).where(ProcessingResult.id == processing_id).values(
+                    embedding=embedding
+                ).execution_options(synchronize_session=False)
+            )
+            db.commit()
+        finally:
+            db.close()
+        self.add(processing_id, embedding)
+
+    def embedding_of(self, processing_id: int) -> Optional[bytes]:
+        """The stored embedding of a result, if it has one. Blocking."""
+        db = SessionLocal()
+        try:
+            row = db.query(ProcessingResult.embedding).filter(ProcessingResult.id == processing_id).first()
+            return row[0] if row else None
+        finally:
+            db.close()
+
+    def refresh(self):
+        """Load embeddings stored since the last refresh, then re-train the IVF index if due. Blocking."""
+        loaded = 0
+        while True:
+            db = SessionLocal()
+            try:
+                rows = db.query(ProcessingResult.id, ProcessingResult.embedding).filter(
+                    ProcessingResult.id > self._loaded_id, ProcessingResult.embedding.isnot(None)
+                ).order_by(ProcessingResult.id).limit(10000).all()
+            finally:
+                db.close()
+            if not rows:
+                break
+            for row_id, embedding in rows:
+                self.add(row_id, embedding)
+            self._loaded_id = rows[-1][0]
+            loaded += len(rows)
+        if loaded:
+            logger.info(f"Loaded {loaded} document embeddings ({len(self)} indexed)")
+        if self._size >= SIMILARITY_IVF_MIN_SIZE and self._size >= 2 * self._trained_size:
+            self.train()
+
+    def train(self):
+        """Train IVF centroids with spherical k-means on a sample, then assign every row. Blocking."""
+        with self._lock:
+            size = self._size
+            vectors = self._vectors
+            norms = self._norms
+        list_count = max(1, min(4096, int(2 * math.sqrt(size))))
+        started = time.perf_counter()
+        rng = np.random.default_rng(size)
+
+        # Step 1: k-means on a sample
+        sample_rows = rng.choice(size, size=min(size, list_count * _KMEANS_SAMPLES_PER_LIST), replace=False)
+        sample = vectors[sample_rows].astype(np.float32) / norms[sample_rows, None]
+        centroids = sample[rng.choice(sample.shape[0], size=list_count, replace=False)]
+        for _ in range(_KMEANS_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Lists nothing was assigned to keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-9), centroids)
+        centroids = centroids.astype(np.float32)
+
+        # Step 2: Assign every row indexed so far, in chunks
+        assignments = np.empty(size, dtype=np.int32)
+        for start in range(0, size, _CHUNK_ROWS):
+            end = min(start + _CHUNK_ROWS, size)
+            assignments[start:end] = np.argmax(vectors[start:end].astype(np.float32) @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable").astype(np.int32)
+        bounds = np.searchsorted(assignments[order], np.arange(list_count + 1))
+        lists = [array("i", order[bounds[index]:bounds[index + 1]].tobytes()) for index in range(list_count)]
+
+        # Step 3: Swap it in, assigning rows added while training
+        with self._lock:
+            self._centroids = centroids
+            self._lists = lists
+            for row in range(size, self._size):
+                self._assign_row(row)
+            self._trained_size = size
+        logger.info(f"Trained similarity index: {list_count} lists over {size} documents "
+                    f"in {time.perf_counter() - started:.1f}s")
+
+    def _assign_row(self, row: int):
+        list_index = int(np.argmax(self._centroids @ self._vectors[row].astype(np.float32)))
+        self._lists[list_index].append(row)
+
+    def schedule_refresh(self, force: bool = False):
+        """Refresh in a background thread when due; queries never wait for the database"""
+        now = time.monotonic()
+        if not self.enabled or self._refreshing or (not force and now - self._refreshed_at < SIMILARITY_REFRESH):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refreshing = True
+        self._refreshed_at = now
+        loop.create_task(self._refresh_async())
+
+    async def _refresh_async(self):
+        try:
+            await asyncio.to_thread(self.refresh)
+        except Exception as e:
+            logger.error(f"Error refreshing similarity index: {str(e)}")
+        finally:
+            self._refreshing = False
+
+# Global similarity index instance
+similarity_index = SimilarityIndex()
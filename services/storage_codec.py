@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from database import CodecDictionary, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # optional: blobs fall back to zlib
+    zstandard = None
+
+# "zstd" (zlib when zstandard is missing), "zlib", or "json" to keep writing the plain JSON columns
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "zstd").lower()
+STORAGE_ZSTD_LEVEL = int(os.getenv("STORAGE_ZSTD_LEVEL", "6"))
+# How often workers look for a newer trained dictionary
+STORAGE_DICT_REFRESH = float(os.getenv("STORAGE_DICT_REFRESH", "300"))
+
+# First byte of every blob says how the rest is encoded
+TAG_JSON = 0x00
+TAG_ZLIB = 0x01
+TAG_ZSTD = 0x02
+TAG_ZSTD_DICT = 0x03  # followed by the codec_dictionaries id as a big-endian uint32
+
+# Metadata keys that repeat a column of the row; they are dropped from the blob and restored on read
+DEDUPLICATED_METADATA = ("file_type", "business_intent")
+# Blob key listing the metadata keys to take from the row's columns
+COLUMN_REFERENCES = "__columns__"
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+
+class StorageCodec:
+    """Encodes extracted_data and processing_metadata as compact, compressed binary blobs"""
+
+    def __init__(self, codec: str = STORAGE_CODEC, level: int = STORAGE_ZSTD_LEVEL):
+        if codec == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed; storage blobs use zlib")
+            codec = "zlib"
+        if codec not in ("zstd", "zlib", "json"):
+            raise ValueError(f"Unknown STORAGE_CODEC: {codec}")
+        self.codec = codec
+        self.level = level
+        self._dictionaries: Dict[int, Any] = {}
+        self._current_dictionary: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # zstd contexts are not thread-safe; retention and migrations encode off the event loop
+        self._local = threading.local()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether new rows are written as blobs"""
+        return self.codec != "json"
+
+    def encode(self, value: Any) -> bytes:
+        """A tagged blob for a JSON-serializable value"""
+        raw = _dumps(value)
+        if self.codec == "zstd":
+            dictionary_id = self._current_dictionary_id()
+            if dictionary_id is not None:
+                payload = self._compressor(dictionary_id).compress(raw)
+                blob = bytes([TAG_ZSTD_DICT]) + struct.pack(">I", dictionary_id) + payload
+            else:
+                blob = bytes([TAG_ZSTD]) + self._compressor(None).compress(raw)
+        elif self.codec == "zlib":
+            blob = bytes([TAG_ZLIB]) + zlib.compress(raw, min(self.level, 9))
+        else:
+            blob = b""
+        # Tiny values do not compress; keep them as plain JSON
+        if not blob or len(blob) > len(raw) + 1:
+            blob = bytes([TAG_JSON]) + raw
+        return blob
+
+    def decode(self, blob: bytes) -> Any:
+        """The value stored in a blob written by any codec setting"""
+        tag, body = blob[0], memoryview(blob)[1:]
+        if tag == TAG_JSON:
+            raw = bytes(body)
+        elif tag == TAG_ZLIB:
+            raw = zlib.decompress(body)
+        elif tag in (TAG_ZSTD, TAG_ZSTD_DICT):
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read zstd-compressed results")
+            dictionary_id = None
+            if tag == TAG_ZSTD_DICT:
+                dictionary_id = struct.unpack(">I", body[:4])[0]
+                body = body[4:]
+            raw = self._decompressor(dictionary_id).decompress(body)
+        else:
+            raise ValueError(f"Unknown storage blob tag: {tag}")
+        return json.loads(raw)
+
+    def columns(self, row, extracted_data: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Values for a row's four data columns: blobs when enabled (clearing the JSON columns), JSON otherwise"""
+        if not self.enabled:
+            return {"extracted_data": extracted_data, "processing_metadata": metadata,
+                    "extracted_data_blob": None, "metadata_blob": None}
+        references = [key for key in DEDUPLICATED_METADATA if key in metadata and metadata[key] == getattr(row, key)]
+        stored_metadata = {key: value for key, value in metadata.items() if key not in references}
+        if references:
+            stored_metadata[COLUMN_REFERENCES] = references
+        return {"extracted_data": None, "processing_metadata": None,
+                "extracted_data_blob": self.encode(extracted_data), "metadata_blob": self.encode(stored_metadata)}
+
+    def pack(self, row, extracted_data: Dict[str, Any], metadata: Dict[str, Any]):
+        """Set a row's data columns"""
+        for name, value in self.columns(row, extracted_data, metadata).items():
+            setattr(row, name, value)
+
+    def unpack(self, row) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """(extracted_data, metadata) of an ORM or Core row, whichever way it was stored"""
+        if row.extracted_data_blob is not None:
+            extracted_data = self.decode(row.extracted_data_blob)
+        else:
+            extracted_data = row.extracted_data or {}
+        if row.metadata_blob is not None:
+            stored_metadata = self.decode(row.metadata_blob)
+            metadata = {key: getattr(row, key) for key in stored_metadata.pop(COLUMN_REFERENCES, [])}
+            metadata.update(stored_metadata)
+        else:
+            metadata = row.processing_metadata or {}
+        return extracted_data, metadata
+
+    def train_dictionary(self, samples: List[Any], size: int = 64 * 1024) -> int:
+        """Train a shared zstd dictionary on sample values, store it and use it for new writes"""
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to train a dictionary")
+        dictionary = zstandard.train_dictionary(size, [_dumps(sample) for sample in samples])
+        db = SessionLocal()
+        try:
+            record = CodecDictionary(data=dictionary.as_bytes(), sample_count=len(samples))
+            db.add(record)
+            db.commit()
+            dictionary_id = record.id
+        finally:
+            db.close()
+        with self._lock:
+            self._dictionaries[dictionary_id] = dictionary
+            self._current_dictionary = dictionary_id
+            self._checked_at = time.monotonic()
+        logger.info(f"Trained storage dictionary {dictionary_id} ({len(dictionary.as_bytes())} bytes, "
+                    f"{len(samples)} samples)")
+        return dictionary_id
+
+    def _current_dictionary_id(self) -> Optional[int]:
+        """The newest trained dictionary, re-checked every STORAGE_DICT_REFRESH seconds"""
+        now = time.monotonic()
+        if self._checked_at and now - self._checked_at < STORAGE_DICT_REFRESH:
+            return self._current_dictionary
+        with self._lock:
+            self._checked_at = now
+            try:
+                db = SessionLocal()
+                try:
+                    latest = db.query(CodecDictionary.id).order_by(CodecDictionary.id.desc()).first()
+                finally:
+                    db.close()
+                self._current_dictionary = latest[0] if latest else None
+            except Exception as e:
+                # Keep compressing without (or with the last known) dictionary
+                logger.error(f"Could not look up storage dictionaries: {str(e)}")
+        return self._current_dictionary
+
+    def _dictionary(self, dictionary_id: int):
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            db = SessionLocal()
+            try:
+                record = db.query(CodecDictionary).filter(CodecDictionary.id == dictionary_id).first()
+            finally:
+                db.close()
+            if record is None:
+                raise ValueError(f"Storage dictionary {dictionary_id} not found")
+            dictionary = zstandard.ZstdCompressionDict(record.data)
+            self._dictionaries[dictionary_id] = dictionary
+        return dictionary
+
+    def _compressor(self, dictionary_id: Optional[int]):
+        compressors = self._local.__dict__.setdefault("compressors", {})
+        compressor = compressors.get(dictionary_id)
+        if compressor is None:
+            dictionary = self._dictionary(dictionary_id) if dictionary_id is not None else None
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            compressors[dictionary_id] = compressor
+        return compressor
+
+    def _decompressor(self, dictionary_id: Optional[int]):
+        decompressors = self._local.__dict__.setdefault("decompressors", {})
+        decompressor = decompressors.get(dictionary_id)
+        if decompressor is None:
+            dictionary = self._dictionary(dictionary_id) if dictionary_id is not None else None
+            decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            decompressors[dictionary_id] = decompressor
+        return decompressor
+
+# Global codec instance
+storage_codec = StorageCodec()
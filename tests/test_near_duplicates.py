@@ -0,0 +1,54 @@
+"""Error rates of the near-duplicate reuse decision on synthetic pairs of known Jaccard similarity"""
+import random
+import struct
+
+import pytest
+
+from services.near_duplicates import (
+    NEAR_DUPLICATE_THRESHOLD, _SIGNATURE_FORMAT, estimate_similarity, is_candidate, shingle_signature
+)
+
+TRIALS = 400
+
+def _pair(rng: random.Random, similarity: float, union: int):
+    """Two shingle sets whose Jaccard similarity is exactly shared / union"""
+    shared = round(similarity * union)
+    unique = (union - shared) // 2
+    words = [f"w{rng.getrandbits(64):x}" for _ in range(shared + 2 * unique)]
+    common = set(words[:shared])
+    return common | set(words[shared:shared + unique]), common | set(words[shared + unique:])
+
+def _match_rate(similarity: float, union: int) -> float:
+    """Share of pairs the index would find and then judge near-duplicates"""
+    rng = random.Random(f"{similarity}:{union}")
+    matched = 0
+    for _ in range(TRIALS):
+        first, second = _pair(rng, similarity, union)
+        values = struct.unpack(_SIGNATURE_FORMAT, shingle_signature(first))
+        other = struct.unpack(_SIGNATURE_FORMAT, shingle_signature(second))
+        if is_candidate(values, other) and estimate_similarity(values, other) >= NEAR_DUPLICATE_THRESHOLD:
+            matched += 1
+    return matched / TRIALS
+
+@pytest.mark.parametrize("union", [40, 400, 3000])
+def test_near_duplicates_are_found(union):
+    assert _match_rate(0.9, union) >= 0.97
+
+@pytest.mark.parametrize("union", [40, 400, 3000])
+def test_less_similar_documents_do_not_reuse_analysis(union):
+    assert _match_rate(0.8, union) <= 0.04
+    assert _match_rate(0.75, union) <= 0.01
+
+def test_identical_documents_match_exactly():
+    shingles = {f"shingle {index}" for index in range(50)}
+    values = struct.unpack(_SIGNATURE_FORMAT, shingle_signature(shingles))
+    assert is_candidate(values, values)
+    assert estimate_similarity(values, values) == 1.0
+
+def test_unrelated_documents_are_not_candidates():
+    rng = random.Random(1)
+    first, second = _pair(rng, 0.0, 400)
+    values = struct.unpack(_SIGNATURE_FORMAT, shingle_signature(first))
+    other = struct.unpack(_SIGNATURE_FORMAT, shingle_signature(second))
+    assert not is_candidate(values, other)
+    assert estimate_similarity(values, other) < 0.05
@@ -0,0 +1,72 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Optional
+
+# Absolute monotonic deadline of the request currently being processed
+_current_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when the per-request deadline has passed"""
+    pass
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Set a deadline for everything awaited inside the block; nested scopes can only shorten it"""
+    if seconds is None:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds
+    existing = _current_deadline.get()
+    if existing is not None:
+        deadline = min(deadline, existing)
+
+    token = _current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+def get_deadline() -> Optional[float]:
+    """Get the absolute monotonic deadline of the current request, if any"""
+    return _current_deadline.get()
+
+def set_deadline(deadline: Optional[float]):
+    """Set the absolute deadline for the current context (used for background tasks)"""
+    _current_deadline.set(deadline)
+
+def remaining_time() -> Optional[float]:
+    """Seconds left before the current deadline, or None if there is no deadline"""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_deadline():
+    """Raise DeadlineExceededError if the current deadline has passed"""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError("Request deadline exceeded")
+
+async def with_deadline(awaitable: Awaitable, cap: Optional[float] = None):
+    """Await something, bounded by the current deadline and an optional per-call cap"""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceededError("Request deadline exceeded")
+
+    timeout = remaining
+    if cap is not None:
+        timeout = cap if timeout is None else min(timeout, cap)
+    if timeout is None:
+        return await awaitable
+
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        if remaining is not None and timeout == remaining:
+            raise DeadlineExceededError("Request deadline exceeded")
+        raise
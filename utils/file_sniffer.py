@@ -0,0 +1,172 @@
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Only this many leading bytes are ever inspected
+SNIFF_PREFIX_SIZE = 4096
+
+# Maximum JSON tokens checked before accepting a prefix as JSON
+JSON_SNIFF_MAX_TOKENS = 32
+
+# Lines scanned for RFC 822 headers
+EMAIL_SNIFF_MAX_LINES = 40
+
+_JSON_TOKEN = re.compile(
+    rb'\s*(?:(?P<punct>[{}\[\],:])|(?P<string>"(?:[^"\\]|\\.)*")|'
+    rb'(?P<number>-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?)|(?P<literal>true|false|null))'
+)
+_JSON_TRUNCATED_TAIL = re.compile(rb'\s*(?:"(?:[^"\\]|\\.)*\\?|-?[\d.eE+-]*|t(?:r(?:ue?)?)?|f(?:a(?:l(?:se?)?)?)?|n(?:u(?:ll?)?)?)\s*\Z')
+_EMAIL_HEADER_NAMES = frozenset((
+    b"from", b"to", b"cc", b"subject", b"date", b"message-id", b"received",
+    b"reply-to", b"return-path", b"mime-version"
+))
+_MBOX_SEPARATOR = re.compile(rb'^From \S+')
+_XML_START = re.compile(rb'\s*<(?:\?xml\b|!DOCTYPE\b|[A-Za-z_][\w.-]*[\s>/])')
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+class SnifferRegistry:
+    """Registry of file formats detected by extension and by bounded-prefix content sniffing"""
+
+    def __init__(self):
+        self._extensions: Dict[str, str] = {}
+        self._sniffers: List[Tuple[int, str, Callable[[bytes], bool]]] = []
+
+    def register(self, file_type: str, extensions: Tuple[str, ...] = (),
+                 sniff: Optional[Callable[[bytes], bool]] = None, priority: int = 100):
+        """Register a format; lower priority sniffers run first"""
+        for extension in extensions:
+            self._extensions[extension.lower()] = file_type
+        if sniff is not None:
+            self._sniffers.append((priority, file_type, sniff))
+            self._sniffers.sort(key=lambda entry: entry[0])
+
+    def detect(self, filename: Optional[str], prefix: bytes) -> str:
+        """Detect a file type from its name, falling back to its leading bytes"""
+        if filename:
+            extension = os.path.splitext(filename)[1].lower()
+            if extension in self._extensions:
+                return self._extensions[extension]
+        return self.sniff(prefix) or "unknown"
+
+    def sniff(self, prefix: bytes) -> Optional[str]:
+        """Detect a file type from its leading bytes only"""
+        prefix = prefix[:SNIFF_PREFIX_SIZE]
+        if prefix.startswith(_UTF8_BOM):
+            prefix = prefix[len(_UTF8_BOM):]
+        for _, file_type, sniff in self._sniffers:
+            if sniff(prefix):
+                return file_type
+        return None
+
+def is_pdf(prefix: bytes) -> bool:
+    """PDF magic bytes, which the spec allows anywhere in the first 1KB"""
+    return prefix.startswith(b"%PDF") or b"%PDF-" in prefix[:1024]
+
+def is_json(prefix: bytes) -> bool:
+    """Tokenize the start of a document and check it follows JSON grammar up to the cut-off"""
+    stripped = prefix.lstrip()
+    if stripped[:1] not in (b"{", b"["):
+        return False
+
+    stack = []
+    expect = "value"
+    position = 0
+    end = len(prefix)
+
+    for _ in range(JSON_SNIFF_MAX_TOKENS):
+        match = _JSON_TOKEN.match(prefix, position)
+        if match is None:
+            # Allow the prefix to end in the middle of a token
+            return position >= end or _JSON_TRUNCATED_TAIL.match(prefix, position) is not None
+        position = match.end()
+        kind = match.lastgroup
+        punct = prefix[position - 1:position] if kind == "punct" else None
+
+        if expect in ("value", "value_or_close"):
+            if punct == b"]" and expect == "value_or_close":
+                stack.pop()
+                expect = "after_value"
+            elif punct == b"{":
+                stack.append(b"{")
+                expect = "key_or_close"
+            elif punct == b"[":
+                stack.append(b"[")
+                expect = "value_or_close"
+            elif punct is None:
+                expect = "after_value"
+            else:
+                return False
+        elif expect in ("key", "key_or_close"):
+            if punct == b"}" and expect == "key_or_close":
+                stack.pop()
+                expect = "after_value"
+            elif kind == "string":
+                expect = "colon"
+            else:
+                return False
+        elif expect == "colon":
+            if punct != b":":
+                return False
+            expect = "value"
+        elif expect == "after_value":
+            if not stack:
+                return False
+            if punct == b",":
+                expect = "key" if stack[-1] == b"{" else "value"
+            elif (punct == b"}" and stack[-1] == b"{") or (punct == b"]" and stack[-1] == b"["):
+                stack.pop()
+            else:
+                return False
+
+        if not stack and expect == "after_value":
+            # A complete top-level value; only whitespace may follow
+            return not prefix[position:].strip()
+
+    return True
+
+def is_email(prefix: bytes) -> bool:
+    """RFC 822 header lines or an mbox separator near the start"""
+    if _MBOX_SEPARATOR.match(prefix):
+        return True
+    # Headers sit at the top (or at the top of a forwarded part); scan only the first lines
+    for line in prefix.split(b"\n", EMAIL_SNIFF_MAX_LINES)[:EMAIL_SNIFF_MAX_LINES]:
+        colon = line.find(b":", 1, 14)
+        if colon != -1 and line[colon + 1:colon + 2] in (b" ", b"\t") and line[:colon].lower() in _EMAIL_HEADER_NAMES:
+            return True
+    return False
+
+def is_xml(prefix: bytes) -> bool:
+    """An XML declaration, doctype or root element"""
+    return _XML_START.match(prefix) is not None
+
+def is_csv(prefix: bytes) -> bool:
+    """At least two lines with the same non-zero count of a common delimiter"""
+    if b"\x00" in prefix:
+        return False
+    lines = [line for line in prefix.split(b"\n", 6)[:5] if line.strip()]
+    if len(lines) < 2:
+        return False
+    # The last line may be cut off by the prefix bound
+    complete_lines = lines[:-1] if len(lines) > 2 else lines
+    for delimiter in (b",", b";", b"\t", b"|"):
+        counts = {line.count(delimiter) for line in complete_lines}
+        if len(counts) == 1 and counts.pop() > 0:
+            return True
+    return False
+
+# Global registry of supported formats
+sniffer_registry = SnifferRegistry()
+sniffer_registry.register("pdf", (".pdf",), is_pdf, priority=10)
+sniffer_registry.register("json", (".json",), is_json, priority=20)
+sniffer_registry.register("xml", (".xml",), is_xml, priority=30)
+sniffer_registry.register("email", (".eml", ".msg", ".txt", ".mbox"), is_email, priority=40)
+sniffer_registry.register("csv", (".csv", ".tsv"), is_csv, priority=50)
+
+def register_sniffer(file_type: str, extensions: Tuple[str, ...] = (),
+                     sniff: Optional[Callable[[bytes], bool]] = None, priority: int = 100):
+    """Register an additional format with the global registry"""
+    sniffer_registry.register(file_type, extensions, sniff, priority)
+
+def detect_file_type(filename: Optional[str], prefix: bytes) -> str:
+    """Detect a file type using the global registry"""
+    return sniffer_registry.detect(filename, prefix)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Optional
+from utils.deadline import DeadlineExceededError, with_deadline
+from utils.metrics import gemini_call_duration, gemini_calls
+from utils.profiling import profiled_thread
+from utils.retry import (
+    CircuitBreakerOpenError,
+    RateLimitExceededError,
+    hedged_request,
+    latency_trackers,
+    rate_limiters,
+    retry_with_circuit_breaker,
+)
+
+logger = logging.getLogger(__name__)
+
+# Model used by all agents; also selects the prompt token budgets
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+
+# Ask Gemini for raw JSON instead of Markdown-fenced text
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+# Retries per Gemini call; an open circuit skips them entirely
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "1"))
+
+# Upper bound for a single call when the request has no tighter deadline
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "30"))
+
+# Optional hedging: fire a duplicate call once the primary is slower than this latency percentile
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+
+# Alternative API endpoint, e.g. the local stand-in from benchmarks/fake_gemini.py
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model() -> Any:
+    """The shared Gemini model handle, created (and the SDK imported and configured) on first use"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                # google.generativeai is slow to import, so it is deferred until the first call
+                import google.generativeai as genai
+                options = {}
+                if GEMINI_API_ENDPOINT:
+                    # Plain REST so an http:// endpoint can be used
+                    options = {"transport": "rest", "client_options": {"api_endpoint": GEMINI_API_ENDPOINT}}
+                    logger.info(f"Using Gemini API endpoint {GEMINI_API_ENDPOINT}")
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY", "default_key"), **options)
+                _model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+                logger.info(f"Gemini model {GEMINI_MODEL_NAME} initialized")
+    return _model
+
+async def generate_text(prompt: str, json_mode: bool = True, model: Optional[Any] = None,
+                        agent: str = "unknown") -> str:
+    """Call Gemini through the shared rate limiter and circuit breaker and return the response text
+    
+    Uses the shared model handle unless a model is given; agent labels the call metrics.
+    """
+    try:
+        return await retry_with_circuit_breaker(
+            _generate_once,
+            "gemini_api",
+            model,
+            prompt,
+            json_mode,
+            agent,
+            max_retries=GEMINI_MAX_RETRIES,
+            base_delay=0.5
+        )
+    except (CircuitBreakerOpenError, RateLimitExceededError):
+        gemini_calls.labels(agent, "rejected").inc()
+        raise
+
+async def _generate_once(model: Optional[Any], prompt: str, json_mode: bool, agent: str) -> str:
+    """Make one (possibly hedged) Gemini call"""
+    hedge_after = None
+    if GEMINI_HEDGE_ENABLED:
+        hedge_after = latency_trackers["gemini_api"].percentile(GEMINI_HEDGE_PERCENTILE)
+    
+    # A hedge consumes quota too, so only send one if a token is free right now
+    rate_limiter = rate_limiters.get("gemini_api")
+    return await hedged_request(
+        _call_model,
+        model,
+        prompt,
+        json_mode,
+        agent,
+        hedge_after=hedge_after,
+        allow_hedge=rate_limiter.try_acquire_async if rate_limiter else None
+    )
+
+async def _call_model(model: Optional[Any], prompt: str, json_mode: bool, agent: str) -> str:
+    """Run a blocking generate_content call off the event loop, bounded by the request deadline"""
+    generation_config = JSON_GENERATION_CONFIG if json_mode else None
+    started = time.monotonic()
+    try:
+        response = await with_deadline(
+            asyncio.to_thread(_generate_content, model, prompt, generation_config),
+            cap=GEMINI_CALL_TIMEOUT
+        )
+    except (asyncio.TimeoutError, DeadlineExceededError):
+        gemini_calls.labels(agent, "timeout").inc()
+        raise
+    except Exception:
+        gemini_calls.labels(agent, "error").inc()
+        raise
+    
+    elapsed = time.monotonic() - started
+    latency_trackers["gemini_api"].record(elapsed)
+    gemini_calls.labels(agent, "success").inc()
+    gemini_call_duration.labels(agent).observe(elapsed)
+    return response.text
+
+def _generate_content(model: Optional[Any], prompt: str, generation_config: Optional[dict]) -> Any:
+    """Blocking call; resolving the shared model here keeps the first-use SDK import off the event loop"""
+    with profiled_thread():
+        return (model or get_model()).generate_content(prompt, generation_config=generation_config)
@@ -0,0 +1,149 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from utils.deadline import get_deadline, set_deadline, with_deadline
+from utils.llm_parsing import LLMParseError, load_llm_json, parse_failures
+from utils.profiling import set_profile
+from utils.timing import set_stage_timer
+
+logger = logging.getLogger(__name__)
+
+class PromptBatcher:
+    """Micro-batches independent LLM prompts into a single multi-document request"""
+
+    def __init__(self, generate: Callable[[str], Awaitable[str]], name: str = "llm",
+                 max_batch_size: Optional[int] = None, max_wait_ms: Optional[float] = None,
+                 max_batch_chars: Optional[int] = None):
+        self.generate = generate
+        self.name = name
+
+        # Size/latency budget for a batch; a batch size of 1 disables batching
+        self.max_batch_size = max_batch_size or int(os.getenv("LLM_BATCH_MAX_SIZE", "8"))
+        if max_wait_ms is None:
+            max_wait_ms = float(os.getenv("LLM_BATCH_MAX_WAIT_MS", "50"))
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_chars = max_batch_chars or int(os.getenv("LLM_BATCH_MAX_CHARS", "24000"))
+
+        self._pending: List[Tuple[str, asyncio.Future, Optional[float]]] = []
+        self._pending_chars = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def submit(self, prompt: str) -> str:
+        """Queue a prompt and wait for its individual response text"""
+        if self.max_batch_size <= 1:
+            return await self.generate(prompt)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # Keep the combined prompt within budget
+        if self._pending and self._pending_chars + len(prompt) > self.max_batch_chars:
+            self._flush()
+
+        self._pending.append((prompt, future, get_deadline()))
+        self._pending_chars += len(prompt)
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+
+        # Each caller gives up at its own deadline; the shared batch keeps running for the others
+        return await with_deadline(asyncio.shield(future))
+
+    def _flush(self):
+        """Send everything gathered so far as one batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch = self._pending
+        self._pending = []
+        self._pending_chars = 0
+
+        if not batch:
+            return
+
+        # The batch may run as long as its most patient member allows
+        deadlines = [deadline for _, _, deadline in batch]
+        context = contextvars.copy_context()
+        context.run(set_deadline, None if None in deadlines else max(deadlines))
+        # Shared calls would otherwise be charged to whichever upload triggered the flush
+        context.run(set_stage_timer, None)
+        context.run(set_profile, None)
+
+        task = asyncio.get_running_loop().create_task(
+            self._run_batch([(prompt, future) for prompt, future, _ in batch]),
+            context=context
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        """Execute a batch and fan the answers back out to the waiting callers"""
+        if len(batch) == 1:
+            await self._run_single(*batch[0])
+            return
+
+        try:
+            response_text = await self.generate(self._build_batch_prompt([prompt for prompt, _ in batch]))
+        except Exception as e:
+            # The model itself failed; individual calls would fail the same way
+            logger.error(f"Batched {self.name} call failed for {len(batch)} prompts: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        answers = self._parse_batch_response(response_text, len(batch))
+        if answers is None:
+            logger.warning(f"Malformed batch output from {self.name}, falling back to {len(batch)} individual calls")
+            await asyncio.gather(*(self._run_single(prompt, future) for prompt, future in batch))
+            return
+
+        logger.info(f"Batched {len(batch)} {self.name} prompts into one call")
+        for (_, future), answer in zip(batch, answers):
+            if not future.done():
+                future.set_result(json.dumps(answer))
+
+    async def _run_single(self, prompt: str, future: asyncio.Future):
+        """Send one prompt on its own"""
+        if future.done():
+            return
+        try:
+            response_text = await self.generate(prompt)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(response_text)
+
+    def _build_batch_prompt(self, prompts: List[str]) -> str:
+        """Combine individual prompts into one prompt asking for a JSON array"""
+        sections = [f"### TASK {index}\n{prompt.strip()}" for index, prompt in enumerate(prompts)]
+        return (
+            f"You will receive {len(prompts)} independent tasks, each starting with a '### TASK <n>' line.\n"
+            f"Answer every task separately, following that task's own instructions.\n"
+            f"Respond with ONLY a JSON array of exactly {len(prompts)} elements, where element n is the "
+            f"JSON object answering TASK n, in order.\n\n"
+            + "\n\n".join(sections)
+        )
+
+    def _parse_batch_response(self, response_text: str, expected: int) -> Optional[List[Any]]:
+        """Parse the batch answer, returning None when it cannot be trusted"""
+        try:
+            answers = load_llm_json(response_text, list)
+        except (LLMParseError, json.JSONDecodeError):
+            answers = None
+
+        if not isinstance(answers, list) or len(answers) != expected or \
+                not all(isinstance(answer, dict) for answer in answers):
+            parse_failures[f"{self.name}_batch"] += 1
+            return None
+
+        return answers
@@ -0,0 +1,109 @@
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Optional, Type
+from pydantic import BaseModel, ValidationError
+from utils.metrics import CallbackMetric
+
+logger = logging.getLogger(__name__)
+
+# Parse failure counters per agent
+parse_failures: Dict[str, int] = defaultdict(int)
+
+class LLMParseError(ValueError):
+    """Raised when an LLM response does not contain usable structured output"""
+    pass
+
+def strip_code_fences(text: str) -> str:
+    """Remove a surrounding Markdown code fence such as ```json ... ```"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if "```" in text:
+            text = text.rsplit("```", 1)[0]
+    return text.strip()
+
+def extract_json_fragment(text: str, opening: str = "{", max_attempts: int = 5) -> Optional[str]:
+    """Return the first balanced JSON object or array in a text that actually parses"""
+    closing = "}" if opening == "{" else "]"
+    start = text.find(opening)
+    attempts = 0
+
+    while start != -1 and attempts < max_attempts:
+        attempts += 1
+        depth = 0
+        in_string = False
+        escaped = False
+
+        for index in range(start, len(text)):
+            char = text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == opening:
+                depth += 1
+            elif char == closing:
+                depth -= 1
+                if depth == 0:
+                    candidate = text[start:index + 1]
+                    try:
+                        json.loads(candidate)
+                        return candidate
+                    except json.JSONDecodeError:
+                        break
+
+        start = text.find(opening, start + 1)
+
+    return None
+
+def load_llm_json(text: str, expected_type: type = dict) -> Any:
+    """Decode the JSON object (or array) carried by an LLM response"""
+    if not text:
+        raise LLMParseError("Empty LLM response")
+
+    cleaned = strip_code_fences(text)
+    try:
+        data = json.loads(cleaned)
+        if isinstance(data, expected_type):
+            return data
+    except json.JSONDecodeError:
+        pass
+
+    fragment = extract_json_fragment(cleaned, "[" if expected_type is list else "{")
+    if fragment is None:
+        raise LLMParseError(f"No JSON {expected_type.__name__} found in LLM response")
+    return json.loads(fragment)
+
+def parse_llm_json(text: str, schema: Optional[Type[BaseModel]] = None, agent: str = "unknown") -> Dict[str, Any]:
+    """Parse and validate a structured LLM response, counting failures per agent"""
+    try:
+        data = load_llm_json(text, dict)
+
+        if schema is not None:
+            validated = schema.model_validate(data)
+            # Keep any extra fields the model returned alongside the validated ones
+            data = {**data, **validated.model_dump()}
+
+        return data
+
+    except (LLMParseError, ValidationError) as e:
+        parse_failures[agent] += 1
+        logger.warning(f"Unparseable LLM output for {agent}: {str(e)[:200]}")
+        raise LLMParseError(str(e)) from e
+
+def get_parse_failure_counts() -> Dict[str, int]:
+    """Get parse failure counts per agent"""
+    return dict(parse_failures)
+
+# Exported at scrape time from the counts above
+CallbackMetric(
+    "llm_parse_failures_total", "LLM responses that could not be parsed or validated, by agent", ("agent",),
+    lambda: (((agent,), count) for agent, count in list(parse_failures.items())),
+    kind="counter"
+)
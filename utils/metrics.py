@@ -0,0 +1,230 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Default latency buckets in seconds, from fast DB writes to slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; made cumulative only when exposed
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _Metric:
+    """A metric family; children are created once per label combination and cached
+
+    Updates are plain attribute increments on the event loop, with no locks. Hot paths
+    should bind children once (metric.labels(...)) and keep them to avoid the lookup.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: Optional["MetricsRegistry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._unlabelled = self._new_child()
+            self._children[()] = self._unlabelled
+        (registry or metrics_registry).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """The child for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children.setdefault(tuple(str(value) for value in values), self._new_child())
+        return child
+
+    def _samples(self) -> Iterable[str]:
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._unlabelled.inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._unlabelled.dec(amount)
+
+    def set(self, value: float):
+        self._unlabelled.set(value)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: Optional["MetricsRegistry"] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabelled.observe(value)
+
+    def _samples(self) -> Iterable[str]:
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(child.sum)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, values)} {child.count}"
+
+class CallbackMetric(_Metric):
+    """A gauge or counter read from existing state at scrape time, costing nothing on the hot path"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...],
+                 collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]], kind: str = "gauge",
+                 registry: Optional["MetricsRegistry"] = None):
+        self.kind = kind
+        self.collect = collect
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return None
+
+    def _samples(self) -> Iterable[str]:
+        for values, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labelnames, tuple(values))} {_format_value(value)}"
+
+class MetricsRegistry:
+    """All metric families of this worker, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def expose(self) -> str:
+        blocks: List[str] = []
+        for metric in list(self._metrics.values()):
+            try:
+                blocks.append(metric.expose())
+            except Exception as e:
+                # One broken collector must not take the whole scrape down
+                blocks.append(f"# {metric.name} collection failed: {_escape(str(e))}")
+        return "\n".join(blocks) + "\n"
+
+# Global registry for this worker
+metrics_registry = MetricsRegistry()
+
+# Pipeline
+documents_processed = Counter(
+    "documents_processed_total", "Uploads finished, by classified type, intent and final status",
+    ("file_type", "business_intent", "status")
+)
+uploads_in_flight = Gauge("uploads_in_flight", "Uploads currently being received or processed")
+
+# LLM calls
+gemini_calls = Counter("gemini_calls_total", "Gemini API calls by calling agent and outcome", ("agent", "outcome"))
+gemini_call_duration = Histogram(
+    "gemini_call_duration_seconds", "Latency of individual Gemini API calls by calling agent", ("agent",)
+)
+llm_fallbacks = Counter(
+    "llm_fallbacks_total", "Rule-based fallbacks taken instead of an LLM answer, by agent and reason",
+    ("agent", "reason")
+)
+
+# Webhooks
+webhook_requests = Counter("webhook_requests_total", "Action webhooks by action and outcome", ("action", "outcome"))
+
+def fallback_reason_label(error: Optional[BaseException]) -> str:
+    """Bounded-cardinality label for why an agent fell back"""
+    if error is None:
+        return "parse_error"
+    # Matched by name so this module needs no imports from the rest of the app
+    return {
+        "CircuitBreakerOpenError": "circuit_open",
+        "RateLimitExceededError": "rate_limited",
+        "DeadlineExceededError": "deadline",
+        "LLMParseError": "parse_error",
+    }.get(type(error).__name__, "error")
+
+def count_fallback(agent: str, error: Optional[BaseException] = None):
+    """Count one LLM fallback for an agent"""
+    llm_fallbacks.labels(agent, fallback_reason_label(error)).inc()
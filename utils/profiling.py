@@ -0,0 +1,445 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests profiled at random (0 disables sampling; the header still works)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+# Request header that profiles one request. Off by default: with PROFILE_TOKEN set the header must
+# carry the token (`X-Profile: <token>`); PROFILE_HEADER_ENABLED=true accepts any value (local use only)
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_HEADER_ENABLED = os.getenv("PROFILE_HEADER_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Randomly sampled profiles are only kept for requests slower than this; header-requested ones always are
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "10000"))
+
+# Stack sampling interval, and a cap on samples kept per request
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SAMPLES = int(os.getenv("PROFILE_MAX_SAMPLES", "20000"))
+
+# Where saved profiles go, and how many are kept (oldest are deleted first)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# Only profiled paths; everything else passes straight through
+PROFILE_PATH_PREFIXES = tuple(os.getenv("PROFILE_PATH_PREFIXES", "/upload,/retry-action").split(","))
+
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Root of the project and of the standard library, shortened in saved profiles
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_STDLIB_ROOT = os.path.dirname(os.__file__)
+
+# Frame key: (function, file, first line)
+FrameKey = Tuple[str, str, int]
+
+def _frame_key(code) -> FrameKey:
+    filename = code.co_filename
+    if "site-packages" in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[-1]
+    elif filename.startswith(_STDLIB_ROOT):
+        filename = "<stdlib>/" + os.path.relpath(filename, _STDLIB_ROOT)
+    elif filename.startswith(_PROJECT_ROOT):
+        filename = os.path.relpath(filename, _PROJECT_ROOT)
+    return (getattr(code, "co_qualname", code.co_name), filename, code.co_firstlineno)
+
+def _marker(name: str) -> FrameKey:
+    return (name, "", 0)
+
+class RequestProfile:
+    """Wall-clock stack samples of one request: its asyncio await chain plus any worker threads attached to it"""
+
+    def __init__(self, task: asyncio.Task, loop_thread_id: int, method: str, path: str, forced: bool):
+        self.task = task
+        self.loop_thread_id = loop_thread_id
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.elapsed_ms: Optional[float] = None
+        self.processing_id: Optional[int] = None
+        self.status: Optional[int] = None
+        self.threads: Set[int] = set()
+        self.truncated = False
+        self._anonymous_id: Optional[str] = None
+        # Stacks are interned; samples hold stack indices in time order
+        self._frames: Dict[FrameKey, int] = {}
+        self._stacks: Dict[Tuple[int, ...], int] = {}
+        self._samples: List[int] = []
+
+    @property
+    def profile_id(self) -> str:
+        if self.processing_id is not None:
+            return str(self.processing_id)
+        # Requests that never got a processing_id (rejected, failed early, retries)
+        if self._anonymous_id is None:
+            self._anonymous_id = f"req-{uuid.uuid4().hex[:12]}"
+        return self._anonymous_id
+
+    def should_save(self, elapsed_ms: float) -> bool:
+        return self.forced or elapsed_ms >= PROFILE_SLOW_MS
+
+    def _add(self, stack: List[FrameKey]):
+        if len(self._samples) >= PROFILE_MAX_SAMPLES:
+            self.truncated = True
+            return
+        frame_ids = []
+        for key in stack:
+            frame_id = self._frames.get(key)
+            if frame_id is None:
+                frame_id = self._frames.setdefault(key, len(self._frames))
+            frame_ids.append(frame_id)
+        stack_key = tuple(frame_ids)
+        stack_id = self._stacks.get(stack_key)
+        if stack_id is None:
+            stack_id = self._stacks.setdefault(stack_key, len(self._stacks))
+        self._samples.append(stack_id)
+
+    def sample(self, thread_frames: Dict[int, Any]):
+        """Record where the request is right now; called from the sampler thread"""
+        task_stack, waiting = self._task_stack(thread_frames.get(self.loop_thread_id))
+        threads = [thread_frames[thread_id] for thread_id in list(self.threads) if thread_id in thread_frames]
+        if waiting and threads:
+            # Blocked on executor work: graft each attached thread's stack under the await
+            for frame in threads:
+                self._add(task_stack + [_marker("[thread]")] + _thread_stack(frame))
+        else:
+            self._add(task_stack)
+
+    def _task_stack(self, loop_frame) -> Tuple[List[FrameKey], bool]:
+        """Outermost-first frames of the request's await chain, and whether it ends waiting on a future"""
+        stack: List[FrameKey] = []
+        task = self.task
+        awaitable: Any = task.get_coro()
+        innermost = None
+        depth = 0
+        while awaitable is not None and depth < 200:
+            depth += 1
+            if isinstance(awaitable, asyncio.Task):
+                task = awaitable
+                awaitable = task.get_coro()
+                continue
+            frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+            if frame is None:
+                # Awaiting a future (C futures only expose an opaque iterator here)
+                if innermost is not None and innermost.f_code.co_name == "wait_for":
+                    # asyncio.wait_for (3.11) awaits a private waiter; follow the task it wraps
+                    inner = innermost.f_locals.get("fut")
+                    if isinstance(inner, asyncio.Task):
+                        awaitable = inner
+                        continue
+                waiter = getattr(task, "_fut_waiter", None)
+                if waiter is not None:
+                    stack.append(_marker(f"[await {type(waiter).__name__}]"))
+                    return stack, True
+                break
+            stack.append(_frame_key(frame.f_code))
+            innermost = frame
+            awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+
+        # Not waiting: if the innermost coroutine is on the loop thread right now, add the sync code it is running
+        if innermost is not None and loop_frame is not None:
+            running = []
+            frame = loop_frame
+            while frame is not None and frame is not innermost:
+                running.append(_frame_key(frame.f_code))
+                frame = frame.f_back
+            if frame is innermost:
+                stack.extend(reversed(running))
+                return stack, False
+        stack.append(_marker("[ready]"))
+        return stack, False
+
+    def collapsed(self) -> str:
+        """Brendan Gregg collapsed stacks, one `frame;frame;frame count` line per distinct stack"""
+        names = {frame_id: _frame_label(key) for key, frame_id in self._frames.items()}
+        stacks = {stack_id: stack for stack, stack_id in self._stacks.items()}
+        counts: Dict[int, int] = {}
+        for stack_id in self._samples:
+            counts[stack_id] = counts.get(stack_id, 0) + 1
+        lines = [
+            ";".join(names[frame_id] for frame_id in stacks[stack_id]) + f" {count}"
+            for stack_id, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        ]
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> Dict[str, Any]:
+        """Sampled profile in the speedscope file format (https://www.speedscope.app)"""
+        frames = [None] * len(self._frames)
+        for (name, filename, line), frame_id in self._frames.items():
+            frames[frame_id] = {"name": name, "file": filename, "line": line} if filename else {"name": name}
+        stacks = {stack_id: list(stack) for stack, stack_id in self._stacks.items()}
+        elapsed_ms = self.elapsed_ms or 0.0
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.method} {self.path} ({self.profile_id})",
+            "exporter": "business-document-processor",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{self.method} {self.path}",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round(elapsed_ms, 3),
+                "samples": [stacks[stack_id] for stack_id in self._samples],
+                "weights": [PROFILE_INTERVAL_MS] * len(self._samples)
+            }],
+            "metadata": self.metadata()
+        }
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "profile_id": self.profile_id,
+            "processing_id": self.processing_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "forced": self.forced,
+            "started_at": self.started_at,
+            "elapsed_ms": round(self.elapsed_ms, 1) if self.elapsed_ms is not None else None,
+            "samples": len(self._samples),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "truncated": self.truncated
+        }
+
+def _frame_label(key: FrameKey) -> str:
+    name, filename, line = key
+    return f"{name} ({filename}:{line})" if filename else name
+
+def _thread_stack(frame) -> List[FrameKey]:
+    """Outermost-first frames of a worker thread, starting below the thread pool machinery"""
+    stack = []
+    while frame is not None:
+        if frame.f_code.co_name == "run" and frame.f_code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py")):
+            break
+        stack.append(_frame_key(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class ProfileSampler:
+    """One background thread sampling every active request profile; idle (blocked) when none are active"""
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self._active: Set[RequestProfile] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, profile: RequestProfile):
+        with self._lock:
+            self._active.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._active)
+                if not profiles:
+                    self._wake.clear()
+            if not profiles:
+                self._wake.wait()
+                continue
+
+            started = time.perf_counter()
+            thread_frames = sys._current_frames()
+            for profile in profiles:
+                try:
+                    profile.sample(thread_frames)
+                except Exception as e:
+                    # Frames change under our feet; a lost sample is harmless
+                    logger.debug(f"Profile sample failed: {str(e)}")
+            del thread_frames
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+_current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("request_profile", default=None)
+
+# Global sampler for this worker
+profile_sampler = ProfileSampler()
+
+def get_profile() -> Optional[RequestProfile]:
+    """The profile of the request being processed, if it is being profiled"""
+    return _current_profile.get()
+
+def set_profile(profile: Optional[RequestProfile]):
+    """Attach a profile to the current context (e.g. None for shared batch tasks)"""
+    _current_profile.set(profile)
+
+def tag_profile(processing_id: int):
+    """Name the current request's profile after its processing_id"""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.processing_id = processing_id
+
+@contextmanager
+def profiled_thread():
+    """Attribute this worker thread's stack to the current request's profile while the block runs"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    profile.threads.add(thread_id)
+    try:
+        yield
+    finally:
+        profile.threads.discard(thread_id)
+
+def _run_in_profile(profile: RequestProfile, function: Callable, *args, **kwargs):
+    token = _current_profile.set(profile)
+    try:
+        with profiled_thread():
+            return function(*args, **kwargs)
+    finally:
+        _current_profile.reset(token)
+
+def bind_profile(function: Callable) -> Callable:
+    """Wrap a function bound for a thread pool (run_in_executor does not copy context) so it is profiled
+
+    Returns the function unchanged when nothing is being profiled, so process pools still get a picklable callable.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        return function
+    return functools.partial(_run_in_profile, profile, function)
+
+def _save(profile: RequestProfile) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, profile.profile_id)
+    with open(f"{base}.speedscope.json", "w") as f:
+        json.dump(profile.speedscope(), f)
+    with open(f"{base}.collapsed", "w") as f:
+        f.write(profile.collapsed())
+    _prune()
+    return base
+
+def _prune():
+    """Keep the newest PROFILE_MAX_FILES profiles"""
+    try:
+        entries = [
+            os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".speedscope.json")
+        ]
+        if len(entries) <= PROFILE_MAX_FILES:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - PROFILE_MAX_FILES]:
+            os.remove(path)
+            collapsed = path[:-len(".speedscope.json")] + ".collapsed"
+            if os.path.exists(collapsed):
+                os.remove(collapsed)
+    except OSError as e:
+        logger.warning(f"Could not prune profiles: {str(e)}")
+
+def profile_path(profile_id: str, fmt: str = "speedscope") -> Optional[str]:
+    """Path of a saved profile, or None if the id is invalid or nothing was saved"""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    suffix = ".speedscope.json" if fmt == "speedscope" else ".collapsed"
+    path = os.path.join(PROFILE_DIR, profile_id + suffix)
+    return path if os.path.exists(path) else None
+
+def list_profiles(limit: int = 50) -> List[Dict[str, Any]]:
+    """Saved profiles, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    entries = [name for name in os.listdir(PROFILE_DIR) if name.endswith(".speedscope.json")]
+    entries.sort(key=lambda name: os.path.getmtime(os.path.join(PROFILE_DIR, name)), reverse=True)
+    profiles = []
+    for name in entries[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profiles.append(json.load(f).get("metadata", {}))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests asking for it (header) or picked at random (PROFILE_SAMPLE_RATE)
+
+    Unprofiled requests cost one header scan and, with sampling on, one random number.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header = PROFILE_HEADER.lower().encode()
+
+    def _requested(self, scope) -> Optional[bool]:
+        """True if forced by the header, False if randomly sampled, None if not profiled"""
+        if not scope["path"].startswith(PROFILE_PATH_PREFIXES):
+            return None
+        if PROFILE_TOKEN or PROFILE_HEADER_ENABLED:
+            for name, value in scope["headers"]:
+                if name != self.header:
+                    continue
+                value = value.strip()
+                if PROFILE_TOKEN:
+                    if hmac.compare_digest(value, PROFILE_TOKEN.encode()):
+                        return True
+                elif value.lower() not in (b"", b"0", b"false", b"no"):
+                    return True
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return False
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = self._requested(scope)
+        if requested is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(
+            asyncio.current_task(), threading.get_ident(), scope["method"], scope["path"], forced=requested
+        )
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                # Elapsed time is all but final once the handler has produced a response
+                if profile.should_save((time.perf_counter() - profile.started) * 1000):
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-profile-id", profile.profile_id.encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current_profile.set(profile)
+        profile_sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile_sampler.remove(profile)
+            _current_profile.reset(token)
+            profile.elapsed_ms = (time.perf_counter() - profile.started) * 1000
+            if profile.should_save(profile.elapsed_ms):
+                try:
+                    path = await asyncio.to_thread(_save, profile)
+                    logger.info(f"Saved profile of {profile.method} {profile.path} "
+                                f"({profile.elapsed_ms:.0f}ms, {len(profile._samples)} samples) to {path}")
+                except OSError as e:
+                    logger.warning(f"Could not save profile {profile.profile_id}: {str(e)}")
@@ -0,0 +1,181 @@
+import os
+import re
+from typing import List
+
+# Content token budgets per model and prompt purpose
+MODEL_TOKEN_BUDGETS = {
+    "gemini-1.5-flash": {
+        "classification": 500,
+        "email_analysis": 600,
+        "pdf_analysis": 900
+    },
+    "gemini-1.5-pro": {
+        "classification": 400,
+        "email_analysis": 500,
+        "pdf_analysis": 800
+    }
+}
+
+DEFAULT_TOKEN_BUDGETS = MODEL_TOKEN_BUDGETS["gemini-1.5-flash"]
+
+# Lines mentioning these are worth keeping when space is tight
+BUSINESS_KEYWORDS = [
+    "urgent", "asap", "immediately", "complaint", "refund", "cancel", "invoice", "total",
+    "amount", "due", "payment", "balance", "quote", "rfq", "pricing", "deadline", "gdpr",
+    "fda", "hipaa", "compliance", "regulation", "fraud", "suspicious", "unauthorized",
+    "lawyer", "legal", "lawsuit", "breach", "angry", "unacceptable"
+]
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_HEADER_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9-]*:\s")
+_AMOUNT_PATTERN = re.compile(r"[$€£]\s*\d|\d[\d,]*\.\d{2}\b|\b\d+(?:\.\d+)?\s*(?:USD|EUR|GBP)\b", re.IGNORECASE)
+_DATE_PATTERN = re.compile(
+    r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b|\b\d{4}-\d{2}-\d{2}\b|"
+    r"\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+\d{1,2}\b",
+    re.IGNORECASE
+)
+_KEYWORD_PATTERN = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in BUSINESS_KEYWORDS) + r")\b", re.IGNORECASE)
+
+# Markers after which an email body is quoted history rather than new content
+_REPLY_MARKERS = [
+    re.compile(r"^-{2,}\s*Original Message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^-{2,}\s*Forwarded message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^On .{4,200} wrote:\s*$", re.IGNORECASE),
+    re.compile(r"^_{20,}\s*$"),
+]
+_SIGNATURE_MARKERS = [
+    re.compile(r"^--\s*$"),
+    re.compile(r"^Sent from my \w+", re.IGNORECASE),
+]
+
+GAP_MARKER = "[...]"
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the LLM token count of a text without calling the model"""
+    if not text:
+        return 0
+    # Words and punctuation map to roughly one token each; long words split further
+    word_count = sum(1 for _ in _TOKEN_PATTERN.finditer(text))
+    return max(word_count, len(text) // 4)
+
+def get_token_budget(model_name: str, purpose: str) -> int:
+    """Get the content token budget for a model and prompt purpose"""
+    override = os.getenv(f"PROMPT_TOKEN_BUDGET_{purpose.upper()}")
+    if override:
+        return int(override)
+    budgets = MODEL_TOKEN_BUDGETS.get(model_name, DEFAULT_TOKEN_BUDGETS)
+    return budgets.get(purpose, DEFAULT_TOKEN_BUDGETS.get(purpose, 500))
+
+def strip_quoted_reply(text: str) -> str:
+    """Remove quoted reply history, forwarded chains and signatures from an email body"""
+    lines = text.splitlines()
+    header_end = _header_block_end(lines)
+    kept = lines[:header_end]
+
+    for line in lines[header_end:]:
+        stripped = line.strip()
+        if any(marker.match(stripped) for marker in _REPLY_MARKERS + _SIGNATURE_MARKERS):
+            break
+        # Outlook-style quoted header inside the body
+        if kept and stripped.lower().startswith("from:") and len(kept) > header_end:
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line)
+
+    return "\n".join(kept).strip()
+
+def build_content_excerpt(text: str, budget_tokens: int, strip_quotes: bool = False) -> str:
+    """Select the most informative segments of a document that fit a token budget"""
+    if strip_quotes:
+        text = strip_quoted_reply(text)
+    text = text.strip()
+
+    if estimate_tokens(text) <= budget_tokens:
+        return text
+
+    lines = text.splitlines()
+    header_end = _header_block_end(lines)
+    first_paragraph, last_paragraph = _body_paragraph_bounds(lines, header_end)
+
+    # Cap any single line so one run-on line cannot take the whole budget
+    max_line_chars = max(80, (budget_tokens // 4) * 4)
+
+    candidates = []
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if len(stripped) > max_line_chars:
+            stripped = stripped[:max_line_chars] + " " + GAP_MARKER
+        candidates.append((_score_line(stripped, index, header_end, first_paragraph, last_paragraph), index, stripped))
+
+    # Greedily keep the highest scoring lines, earliest first on ties
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    selected = {}
+    used_tokens = 0
+    for score, index, line in candidates:
+        cost = estimate_tokens(line) + 1
+        if used_tokens + cost > budget_tokens:
+            continue
+        selected[index] = line
+        used_tokens += cost
+
+    # Reassemble in document order, marking skipped regions
+    excerpt: List[str] = []
+    previous_index = -1
+    for index in sorted(selected):
+        if previous_index >= 0 and index > previous_index + 1 and any(lines[i].strip() for i in range(previous_index + 1, index)):
+            excerpt.append(GAP_MARKER)
+        elif previous_index >= 0 and previous_index < header_end <= index:
+            excerpt.append("")
+        excerpt.append(selected[index])
+        previous_index = index
+
+    return "\n".join(excerpt)
+
+def _header_block_end(lines: List[str]) -> int:
+    """Return the index of the first line after a leading RFC 822 style header block"""
+    index = 0
+    while index < len(lines) and _HEADER_PATTERN.match(lines[index]):
+        index += 1
+        # Folded header continuation lines
+        while index < len(lines) and lines[index][:1] in (" ", "\t") and lines[index].strip():
+            index += 1
+    return index
+
+def _body_paragraph_bounds(lines: List[str], start: int):
+    """Return the (start, end) line ranges of the first and last body paragraphs"""
+    paragraphs = []
+    current_start = None
+    for index in range(start, len(lines)):
+        if lines[index].strip():
+            if current_start is None:
+                current_start = index
+        elif current_start is not None:
+            paragraphs.append((current_start, index))
+            current_start = None
+    if current_start is not None:
+        paragraphs.append((current_start, len(lines)))
+
+    if not paragraphs:
+        return (start, start), (start, start)
+    return paragraphs[0], paragraphs[-1]
+
+def _score_line(line: str, index: int, header_end: int, first_paragraph, last_paragraph) -> int:
+    """Score how informative a line is for business classification"""
+    if index < header_end:
+        return 100
+
+    score = 1
+    if first_paragraph[0] <= index < first_paragraph[1]:
+        # Opening lines carry the request; decay through the paragraph
+        score += max(20, 60 - (index - first_paragraph[0]) * 5)
+    if last_paragraph[0] <= index < last_paragraph[1]:
+        score += 35
+    if _AMOUNT_PATTERN.search(line):
+        score += 30
+    if _DATE_PATTERN.search(line):
+        score += 20
+    score += 25 * min(3, sum(1 for _ in _KEYWORD_PATTERN.finditer(line)))
+    return score
@@ -1,10 +1,24 @@
 import asyncio
 import logging
-from typing import Callable, Any, Optional
+import os
+import time
+from typing import Awaitable, Callable, Any, Dict, Optional
 import random
+from collections import deque
+from utils.deadline import DeadlineExceededError, remaining_time
+from utils.metrics import CallbackMetric
+from utils.timing import timed_stage
 
 logger = logging.getLogger(__name__)
 
+class CircuitBreakerOpenError(Exception):
+    """Raised when a call is rejected because its circuit breaker is open"""
+    pass
+
+class RateLimitExceededError(Exception):
+    """Raised when a rate limit token is not available within the allowed wait"""
+    pass
+
 async def retry_with_backoff(
     func: Callable,
     *args,
@@ -13,6 +27,8 @@ async def retry_with_backoff(
     max_delay: float = 30.0,
     exponential_base: float = 2.0,
     jitter: bool = True,
+    no_retry_on: tuple = (),
+    timing_label: Optional[str] = None,
     **kwargs
 ) -> Any:
     """
@@ -26,6 +42,8 @@ async def retry_with_backoff(
         max_delay: Maximum delay between retries in seconds
         exponential_base: Base for exponential backoff calculation
         jitter: Whether to add random jitter to delays
+        no_retry_on: Exception types that are raised immediately without retrying
+        timing_label: Stage name prefix for attempt timings (defaults to the function name)
         **kwargs: Keyword arguments to pass to the function
     
     Returns:
@@ -35,14 +53,16 @@ async def retry_with_backoff(
         The last exception if all retries fail
     """
     last_exception = None
+    attempt_stage = f"{timing_label or getattr(func, '__name__', 'call')}.attempt"
     
     for attempt in range(max_retries + 1):
         try:
-            # Try to execute the function
-            if asyncio.iscoroutinefunction(func):
-                result = await func(*args, **kwargs)
-            else:
-                result = func(*args, **kwargs)
+            # Try to execute the function, timing each attempt separately
+            with timed_stage(attempt_stage):
+                if asyncio.iscoroutinefunction(func):
+                    result = await func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
             
             # Success! Log if this wasn't the first attempt
             if attempt > 0:
@@ -53,6 +73,10 @@ async def retry_with_backoff(
         except Exception as e:
             last_exception = e
             
+            # Some failures (e.g. an open circuit) will not succeed on retry
+            if no_retry_on and isinstance(e, no_retry_on):
+                raise
+            
             # If this was the last attempt, don't delay
             if attempt == max_retries:
                 logger.error(f"Function {func.__name__} failed after {max_retries} retries. Last error: {str(e)}")
@@ -65,6 +89,12 @@ async def retry_with_backoff(
             if jitter:
                 delay *= (0.5 + random.random() * 0.5)
             
+            # Never sleep past the request deadline
+            remaining = remaining_time()
+            if remaining is not None and remaining <= delay:
+                logger.error(f"Function {func.__name__} failed and the request deadline leaves no time to retry. Last error: {str(e)}")
+                break
+            
             logger.warning(f"Function {func.__name__} failed on attempt {attempt + 1}, retrying in {delay:.2f}s. Error: {str(e)}")
             
             # Wait before retrying
@@ -151,23 +181,77 @@ async def retry_with_conditions(
 class CircuitBreaker:
     """Simple circuit breaker implementation for retry logic"""
     
-    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 60.0):
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 60.0,
+                 excluded_exceptions: tuple = (DeadlineExceededError,)):
         self.failure_threshold = failure_threshold
         self.recovery_timeout = recovery_timeout
+        # Failures caused by the caller (e.g. its own deadline) say nothing about the service
+        self.excluded_exceptions = excluded_exceptions
         self.failure_count = 0
         self.last_failure_time = None
         self.state = "closed"  # closed, open, half-open
+        # Wall-clock time of the last open/close transition, used to share state between workers
+        self.changed_at = 0.0
     
-    async def call(self, func: Callable, *args, **kwargs) -> Any:
-        """Call a function through the circuit breaker"""
-        
-        # Check if circuit should be closed or half-open
+    def check(self):
+        """Raise CircuitBreakerOpenError if calls are currently rejected"""
         if self.state == "open":
-            if self.last_failure_time and (asyncio.get_event_loop().time() - self.last_failure_time) > self.recovery_timeout:
+            if self.last_failure_time and (time.monotonic() - self.last_failure_time) > self.recovery_timeout:
                 self.state = "half-open"
                 logger.info("Circuit breaker moving to half-open state")
             else:
-                raise Exception("Circuit breaker is open - too many recent failures")
+                raise CircuitBreakerOpenError("Circuit breaker is open - too many recent failures")
+    
+    def record_success(self):
+        """Record a successful call"""
+        if self.state != "closed":
+            logger.info("Circuit breaker closed after successful call")
+            self.changed_at = time.time()
+        self.state = "closed"
+        self.failure_count = 0
+    
+    def record_failure(self):
+        """Record a failed call, opening the circuit past the threshold"""
+        self.failure_count += 1
+        self.last_failure_time = time.monotonic()
+        
+        if self.state == "half-open" or self.failure_count >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit breaker opened after {self.failure_count} failures")
+                self.changed_at = time.time()
+            self.state = "open"
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Shareable state: open or closed, with wall-clock times (half-open is local)"""
+        opened_at = None
+        if self.last_failure_time is not None:
+            opened_at = time.time() - (time.monotonic() - self.last_failure_time)
+        return {
+            "state": "closed" if self.state == "closed" else "open",
+            "opened_at": opened_at,
+            "changed_at": self.changed_at
+        }
+    
+    def adopt(self, state: str, opened_at: Optional[float], changed_at: float):
+        """Take over a newer transition published by another worker"""
+        if changed_at <= self.changed_at:
+            return
+        self.changed_at = changed_at
+        if state == "open":
+            if self.state == "closed":
+                logger.warning("Circuit breaker opened by another worker")
+            self.state = "open"
+            if opened_at is not None:
+                self.last_failure_time = time.monotonic() - max(0.0, time.time() - opened_at)
+        else:
+            self.state = "closed"
+            self.failure_count = 0
+    
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        """Call a function through the circuit breaker"""
+        
+        # Check if circuit should be closed or half-open
+        self.check()
         
         try:
             # Try to execute the function
@@ -177,24 +261,136 @@ class CircuitBreaker:
                 result = func(*args, **kwargs)
             
             # Success - reset circuit breaker
-            if self.state == "half-open":
-                self.state = "closed"
-                self.failure_count = 0
-                logger.info("Circuit breaker closed after successful call")
-            
+            self.record_success()
             return result
             
         except Exception as e:
             # Failure - update circuit breaker state
-            self.failure_count += 1
-            self.last_failure_time = asyncio.get_event_loop().time()
-            
-            if self.failure_count >= self.failure_threshold:
-                self.state = "open"
-                logger.warning(f"Circuit breaker opened after {self.failure_count} failures")
-            
+            if not isinstance(e, self.excluded_exceptions):
+                self.record_failure()
             raise e
 
+class TokenBucketRateLimiter:
+    """Token bucket rate limiter shared by all callers of a service"""
+    
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = None
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens without waiting; return False if not available"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    async def try_acquire_async(self, tokens: float = 1.0) -> bool:
+        """try_acquire for async callers; same interface as the database-backed bucket"""
+        return self.try_acquire(tokens)
+    
+    async def acquire(self, tokens: float = 1.0, max_wait: Optional[float] = None):
+        """Wait for tokens, raising RateLimitExceededError if the wait would exceed max_wait"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        # Serialize waiters so tokens are handed out in arrival order
+        async with self._lock:
+            self._refill()
+            if self.tokens < tokens:
+                wait_time = (tokens - self.tokens) / self.rate
+                if max_wait is not None and wait_time > max_wait:
+                    raise RateLimitExceededError(f"Rate limit wait of {wait_time:.1f}s exceeds {max_wait:.1f}s")
+                await asyncio.sleep(wait_time)
+                self._refill()
+            self.tokens -= tokens
+
+class LatencyTracker:
+    """Tracks recent call latencies online to derive percentiles such as the hedge threshold"""
+    
+    def __init__(self, window_size: int = 1000, min_samples: int = 50, refresh_every: int = 25):
+        self.samples = deque(maxlen=window_size)
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self._since_refresh = 0
+        self._sorted = []
+    
+    def record(self, seconds: float):
+        """Record the latency of one completed call"""
+        self.samples.append(seconds)
+        self._since_refresh += 1
+    
+    def percentile(self, p: float) -> Optional[float]:
+        """Get a latency percentile (0-100), or None until enough samples exist"""
+        if len(self.samples) < self.min_samples:
+            return None
+        
+        # Re-sort the window periodically rather than on every lookup
+        if self._since_refresh >= self.refresh_every or not self._sorted:
+            self._sorted = sorted(self.samples)
+            self._since_refresh = 0
+        
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100.0))
+        return self._sorted[index]
+
+async def hedged_request(
+    func: Callable,
+    *args,
+    hedge_after: Optional[float] = None,
+    allow_hedge: Optional[Callable[[], Awaitable[bool]]] = None,
+    **kwargs
+) -> Any:
+    """
+    Run an async call and, if it is still pending after hedge_after seconds,
+    fire a duplicate and return whichever finishes successfully first
+    
+    Args:
+        func: The coroutine function to call
+        *args: Arguments to pass to the function
+        hedge_after: Delay before sending the duplicate; None disables hedging
+        allow_hedge: Awaited before hedging (e.g. to take a rate limit token)
+        **kwargs: Keyword arguments to pass to the function
+    
+    Returns:
+        The result of the first successful call
+    """
+    primary = asyncio.ensure_future(func(*args, **kwargs))
+    if hedge_after is None:
+        return await primary
+    
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done:
+        return primary.result()
+    
+    remaining = remaining_time()
+    if (remaining is not None and remaining <= 0) or (allow_hedge is not None and not await allow_hedge()):
+        return await primary
+    
+    logger.info(f"Hedging {getattr(func, '__name__', 'call')} after {hedge_after:.2f}s")
+    hedge = asyncio.ensure_future(func(*args, **kwargs))
+    pending = {primary, hedge}
+    
+    try:
+        last_exception = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_exception = task.exception()
+        raise last_exception
+    finally:
+        for task in pending:
+            task.cancel()
+
 # Global circuit breakers for different services
 circuit_breakers = {
     "gemini_api": CircuitBreaker(failure_threshold=3, recovery_timeout=30.0),
@@ -202,22 +398,79 @@ circuit_breakers = {
     "database": CircuitBreaker(failure_threshold=3, recovery_timeout=30.0)
 }
 
+# Global rate limiters matching upstream quotas
+rate_limiters = {
+    "gemini_api": TokenBucketRateLimiter(
+        rate_per_second=float(os.getenv("GEMINI_RATE_LIMIT_RPM", "60")) / 60.0,
+        capacity=float(os.getenv("GEMINI_RATE_LIMIT_BURST", "10"))
+    )
+}
+
+# Global latency trackers used to set hedge thresholds
+latency_trackers = {
+    "gemini_api": LatencyTracker()
+}
+
+# Circuit breaker states exported at scrape time
+CIRCUIT_STATE_VALUES = {"closed": 0, "half-open": 1, "open": 2}
+
+CallbackMetric(
+    "circuit_breaker_state", "Circuit breaker state per service (0=closed, 1=half-open, 2=open)", ("service",),
+    lambda: (((service,), CIRCUIT_STATE_VALUES[breaker.state]) for service, breaker in circuit_breakers.items())
+)
+CallbackMetric(
+    "circuit_breaker_failures", "Consecutive failures counted by each circuit breaker", ("service",),
+    lambda: (((service,), breaker.failure_count) for service, breaker in circuit_breakers.items())
+)
+
+# Longest a caller waits for a rate limit token before taking the fallback path
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+
 async def retry_with_circuit_breaker(
     func: Callable,
     service_name: str,
     *args,
     max_retries: int = 3,
+    base_delay: float = 1.0,
     **kwargs
 ) -> Any:
-    """Retry a function with circuit breaker protection"""
+    """Retry a function with circuit breaker and rate limit protection
+    
+    An open circuit or an exhausted rate limit fails fast without retry sleeps,
+    so callers can switch to their fallback path immediately.
+    """
     
     circuit_breaker = circuit_breakers.get(service_name)
-    if not circuit_breaker:
-        # No circuit breaker configured, use regular retry
-        return await retry_with_backoff(func, *args, max_retries=max_retries, **kwargs)
+    rate_limiter = rate_limiters.get(service_name)
+    if not circuit_breaker and not rate_limiter:
+        # No protection configured, use regular retry
+        return await retry_with_backoff(func, *args, max_retries=max_retries, base_delay=base_delay, **kwargs)
     
     # Use circuit breaker with retry
     async def protected_func(*args, **kwargs):
-        return await circuit_breaker.call(func, *args, **kwargs)
+        if circuit_breaker:
+            circuit_breaker.check()
+        if rate_limiter:
+            # Waiting beyond the request deadline is pointless
+            max_wait = RATE_LIMIT_MAX_WAIT
+            remaining = remaining_time()
+            if remaining is not None:
+                max_wait = min(max_wait, remaining)
+            await rate_limiter.acquire(max_wait=max_wait)
+        if circuit_breaker:
+            return await circuit_breaker.call(func, *args, **kwargs)
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        return func(*args, **kwargs)
+    
+    protected_func.__name__ = getattr(func, "__name__", "protected_func")
     
-    return await retry_with_backoff(protected_func, *args, max_retries=max_retries, **kwargs)
+    return await retry_with_backoff(
+        protected_func,
+        *args,
+        max_retries=max_retries,
+        base_delay=base_delay,
+        no_retry_on=(CircuitBreakerOpenError, RateLimitExceededError, DeadlineExceededError),
+        timing_label=service_name,
+        **kwargs
+    )
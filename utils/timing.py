@@ -0,0 +1,193 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+# Histogram resolution: 2**SUB_BUCKET_BITS linear sub-buckets per power of two,
+# i.e. every recorded value is accurate to within 1 / 2**SUB_BUCKET_BITS (~6%)
+SUB_BUCKET_BITS = 4
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+# Values are tracked in microseconds up to 2**MAX_MAGNITUDE_BITS (~18 minutes)
+MAX_MAGNITUDE_BITS = 30
+BUCKET_COUNT = (MAX_MAGNITUDE_BITS - SUB_BUCKET_BITS + 2) * SUB_BUCKET_COUNT
+
+# Label used when a stage runs outside an upload, or before its type is known
+ALL_LABEL = "*"
+
+class LatencyHistogram:
+    """Streaming log-linear (HDR-style) latency histogram with bounded relative error and fixed memory"""
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    @staticmethod
+    def _index(micros: int) -> int:
+        if micros < SUB_BUCKET_COUNT:
+            return micros
+        shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+        return min(BUCKET_COUNT - 1, (shift + 1) * SUB_BUCKET_COUNT + (micros >> shift) - SUB_BUCKET_COUNT)
+
+    @staticmethod
+    def _upper_bound_ms(index: int) -> float:
+        if index < SUB_BUCKET_COUNT:
+            return index / 1000.0
+        shift = index // SUB_BUCKET_COUNT - 1
+        sub_bucket = index % SUB_BUCKET_COUNT + SUB_BUCKET_COUNT
+        return (((sub_bucket + 1) << shift) - 1) / 1000.0
+
+    def record(self, ms: float):
+        """Record one duration in milliseconds"""
+        self.counts[self._index(max(0, int(ms * 1000)))] += 1
+        self.total += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentiles(self, ps: Tuple[float, ...] = (50, 95, 99)) -> Dict[str, float]:
+        """Percentiles (0-100) in milliseconds, each reported as its bucket's upper bound"""
+        results = {}
+        if not self.total:
+            return results
+        targets = sorted((max(1, int(self.total * p / 100.0 + 0.999999)), p) for p in ps)
+        seen = 0
+        position = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while position < len(targets) and seen >= targets[position][0]:
+                results[f"p{targets[position][1]:g}"] = round(min(self._upper_bound_ms(index), self.max_ms), 3)
+                position += 1
+            if position == len(targets):
+                break
+        return results
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum_ms / self.total, 3) if self.total else None,
+            "max_ms": round(self.max_ms, 3),
+            **self.percentiles()
+        }
+
+class LatencyRegistry:
+    """Histograms keyed by (stage, file_type, business_intent), plus per-stage rollups"""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+
+    def record(self, stage: str, ms: float, file_type: str = ALL_LABEL, business_intent: str = ALL_LABEL):
+        """Record a stage duration under its labels and under the all-documents rollup"""
+        self._get(stage, ALL_LABEL, ALL_LABEL).record(ms)
+        if file_type != ALL_LABEL or business_intent != ALL_LABEL:
+            self._get(stage, file_type, business_intent).record(ms)
+
+    def _get(self, stage: str, file_type: str, business_intent: str) -> LatencyHistogram:
+        key = (stage, file_type, business_intent)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def snapshot(self, stage: Optional[str] = None, file_type: Optional[str] = None,
+                 business_intent: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Summaries of all histograms, optionally filtered by label"""
+        rows = []
+        for (row_stage, row_type, row_intent), histogram in sorted(self._histograms.items()):
+            if stage is not None and row_stage != stage:
+                continue
+            if file_type is not None and row_type != file_type:
+                continue
+            if business_intent is not None and row_intent != business_intent:
+                continue
+            rows.append({
+                "stage": row_stage,
+                "file_type": row_type,
+                "business_intent": row_intent,
+                **histogram.summary()
+            })
+        return rows
+
+class StageTimer:
+    """Per-upload stage durations; fed into the latency histograms once the document is labelled"""
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._samples: List[Tuple[str, float]] = []
+        self.file_type = ALL_LABEL
+        self.business_intent = ALL_LABEL
+        self._flushed = 0
+
+    def add(self, stage: str, ms: float):
+        """Add a duration; repeated stages (e.g. retry attempts) are summed"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self._samples.append((stage, ms))
+        if self.file_type != ALL_LABEL:
+            self.flush()
+
+    def label(self, file_type: str, business_intent: str):
+        """Attach the classification labels and record everything timed so far"""
+        self.file_type = file_type or ALL_LABEL
+        self.business_intent = business_intent or ALL_LABEL
+        self.flush()
+
+    def flush(self):
+        """Record samples not yet recorded into the global histograms"""
+        for stage, ms in self._samples[self._flushed:]:
+            latency_registry.record(stage, ms, self.file_type, self.business_intent)
+        self._flushed = len(self._samples)
+
+    def as_metadata(self) -> Dict[str, Any]:
+        """Timings for processing_metadata"""
+        metadata: Dict[str, Any] = {"stage_timings_ms": {stage: round(ms, 2) for stage, ms in self.stages.items()}}
+        repeated = {stage: count for stage, count in self.counts.items() if count > 1}
+        if repeated:
+            metadata["stage_counts"] = repeated
+        return metadata
+
+_current_timer: contextvars.ContextVar[Optional[StageTimer]] = contextvars.ContextVar("stage_timer", default=None)
+
+# Global latency histograms for this worker
+latency_registry = LatencyRegistry()
+
+def get_stage_timer() -> Optional[StageTimer]:
+    """The stage timer of the upload being processed, if any"""
+    return _current_timer.get()
+
+def set_stage_timer(timer: Optional[StageTimer]):
+    """Attach a stage timer to the current context (e.g. a detached batch task)"""
+    _current_timer.set(timer)
+
+@contextmanager
+def timing_scope():
+    """Collect stage timings for everything run within the block, including awaited tasks"""
+    timer = StageTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+        timer.flush()
+
+def record_stage(stage: str, ms: float):
+    """Record a duration measured elsewhere"""
+    timer = _current_timer.get()
+    if timer is None:
+        latency_registry.record(stage, ms)
+    else:
+        timer.add(stage, ms)
+
+@contextmanager
+def timed_stage(stage: str):
+    """Time a block (sync or containing awaits) as one pipeline stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, (time.perf_counter() - started) * 1000)
@@ -0,0 +1,119 @@
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from typing import BinaryIO, Optional
+from utils.file_sniffer import SNIFF_PREFIX_SIZE, sniffer_registry
+
+logger = logging.getLogger(__name__)
+
+# Uploads above this size spill from memory to a temp file
+SPOOL_MEMORY_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))
+
+# Bytes read per chunk while streaming an upload
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Leading bytes kept in memory for type sniffing and classification
+HEAD_SIZE = 64 * 1024
+
+class UploadTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured maximum size"""
+    pass
+
+class SpooledUpload:
+    """An upload streamed in chunks, hashed and sniffed on the way in, spilling to disk above a threshold"""
+
+    def __init__(self, filename: str, max_size: int, spill_threshold: int = SPOOL_MEMORY_THRESHOLD):
+        self.filename = filename
+        self.max_size = max_size
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self.head = b""
+        self.sniffed_type: Optional[str] = None
+        self.path: Optional[str] = None
+
+        self._hash = hashlib.sha256()
+        self._buffer: BinaryIO = io.BytesIO()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def on_disk(self) -> bool:
+        return self.path is not None
+
+    async def write_from(self, upload, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        """Stream an UploadFile (or any object with an async read(n)) into the spool"""
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+        self.finish()
+
+    def finish(self):
+        """Complete a spool filled through write()"""
+        self._buffer.flush()
+
+        # Small uploads never filled the sniffing window
+        if self.size < SNIFF_PREFIX_SIZE:
+            self.sniffed_type = sniffer_registry.sniff(self.head)
+
+    def write(self, chunk: bytes):
+        """Append one chunk, updating the hash, size and sniffed head"""
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadTooLargeError(f"File too large. Maximum size is {self.max_size // (1024 * 1024)}MB")
+
+        self._hash.update(chunk)
+
+        if len(self.head) < HEAD_SIZE:
+            sniff_pending = len(self.head) < SNIFF_PREFIX_SIZE
+            self.head += chunk[:HEAD_SIZE - len(self.head)]
+            if sniff_pending and len(self.head) >= SNIFF_PREFIX_SIZE:
+                self.sniffed_type = sniffer_registry.sniff(self.head)
+
+        if not self.on_disk and self.size > self.spill_threshold:
+            self._spill()
+
+        self._buffer.write(chunk)
+
+    def ensure_on_disk(self) -> str:
+        """Make sure the content is backed by a named file (e.g. for parsers needing a path) and return it"""
+        if not self.on_disk:
+            self._spill()
+            self._buffer.flush()
+        return self.path
+
+    def open(self) -> BinaryIO:
+        """Open the spooled content for reading from the start"""
+        if self.on_disk:
+            self._buffer.flush()
+            return open(self.path, "rb")
+        return io.BytesIO(self._buffer.getvalue())
+
+    def read_text(self, errors: str = "ignore") -> str:
+        """Decode the content as UTF-8 without holding an extra full-size bytes copy"""
+        with self.open() as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", errors=errors) as text:
+                return text.read()
+
+    def close(self):
+        """Release memory and remove any temp file"""
+        try:
+            self._buffer.close()
+        finally:
+            if self.path and os.path.exists(self.path):
+                os.unlink(self.path)
+            self.path = None
+
+    def _spill(self):
+        """Move the in-memory buffer to a named temp file"""
+        safe_name = os.path.basename(self.filename or "upload")
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f"_{safe_name}")
+        temp_file.write(self._buffer.getvalue())
+        self._buffer.close()
+        self._buffer = temp_file
+        self.path = temp_file.name